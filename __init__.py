@@ -1,4 +1,11 @@
 """
 This package provides common functionality for all DRS robots
 """
-from common.core.robot_id import ROBOT
+
+
+def __getattr__(name):
+    # ROBOT is loaded lazily so that importing common does not read the RobotID project from disk
+    if name == "ROBOT":
+        from common.core.robot_id import ROBOT
+        return ROBOT
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,179 @@
+"""
+Provides asyncio versions of the blocking movement, light and motor functions so that several of them can run
+together on a single thread. Every loop is paced by a LoopScheduler, which uses the same monotonic clock as the event
+loop.
+
+Example:
+    async def routine():
+        await gather(
+            straight_drive_distance(80, 24),
+            move_motor(Motors.ARM, 1200),
+        )
+
+    run(routine())
+"""
+import asyncio
+from typing import Optional
+from common import gyro_movements, hardware, light
+from common.cancellation import CancellationToken
+from common.drive_controller import DriveController, _check_speed, _straight_drive_speeds
+from common.inputs import inputs
+from common.scheduler import LoopScheduler
+from common.multitasker import DEFAULT_MOTOR_GAIN, DEFAULT_MOTOR_TOLERANCE
+
+gather = asyncio.gather
+
+
+def run(*coroutines):
+    """
+    Runs coroutines together on one event loop and returns their results
+    """
+    async def main():
+        return await asyncio.gather(*coroutines)
+
+    return asyncio.run(main())
+
+
+async def gyro_turn(left_speed, right_speed, angle, stop_when_finished=True,
+                    cancel_token: Optional[CancellationToken] = None, controller: Optional[DriveController] = None):
+    """
+        The same as gyro_movements.gyro_turn(), but yields to the event loop between iterations. Runs on controller,
+        or the default controller of gyro_movements if it is None.
+    """
+    gm = controller or gyro_movements.controller
+    gm.check_init()
+    scheduler = LoopScheduler(gm.loop_rate, "async_gyro_turn")
+    scheduler.start()
+    gm.drive(left_speed, right_speed)
+    current_turned_angle = 0
+    fixed_angle = gm._fixed_turn_angle(left_speed, right_speed, angle)
+    sampler = gm.gyro_sampler
+    start_heading = sampler.heading() if sampler else 0.0
+    turn_scale = gm._turn_scale
+    while abs(current_turned_angle) < fixed_angle:
+        if sampler:
+            await scheduler.wait_async()
+            current_turned_angle = turn_scale * (sampler.heading() - start_heading)
+        else:
+            current_turned_angle += turn_scale * gm.gyroscope() * await scheduler.wait_async()
+        if cancel_token and cancel_token.cancelled:
+            gm.stop()
+            cancel_token.raise_if_cancelled()
+        if scheduler.elapsed() > 10:
+            gm.stop()
+            raise Exception(f"Gyro Turn Timer Expired after {scheduler.iterations} iterations "
+                            f"({scheduler.overruns} overruns).")
+    if stop_when_finished:
+        gm.stop()
+        await hardware.async_sleep(0.5)
+
+
+async def straight_drive(speed, condition, stop_when_finished=True, condition_is=True,
+                         cancel_token: Optional[CancellationToken] = None,
+                         controller: Optional[DriveController] = None):
+    """
+        The same as gyro_movements.straight_drive(), but yields to the event loop between iterations. Runs on
+        controller, or the default controller of gyro_movements if it is None.
+    """
+    gm = controller or gyro_movements.controller
+    gm.check_init()
+    speed = _check_speed(speed)
+    scheduler = LoopScheduler(gm.loop_rate, "async_straight_drive")
+    scheduler.start()
+    marginal_time = 0.0
+    integral_error_adjustment = 0.0
+    sampler = gm.gyro_sampler
+    start_heading = sampler.heading() if sampler else 0.0
+    while True:
+        snapshot = gm.sensor_hub.tick()
+        if condition() != condition_is:
+            break
+        if cancel_token and cancel_token.cancelled:
+            gm.stop()
+            cancel_token.raise_if_cancelled()
+        current_gyro = snapshot.gyroscope()
+        gyro_error_adjustment = gm.error_proportion * current_gyro
+        if sampler:
+            integral_error_adjustment = gm.error_integral_multiplier * (sampler.heading() - start_heading)
+        else:
+            integral_error_adjustment += gm.error_integral_multiplier * current_gyro * marginal_time
+        gm.drive(*_straight_drive_speeds(speed, gyro_error_adjustment + integral_error_adjustment))
+        marginal_time = await scheduler.wait_async()
+    if stop_when_finished:
+        gm.stop()
+        await hardware.async_sleep(0.5)
+
+
+async def straight_drive_distance(speed, inches, stop_when_finished=True,
+                                  cancel_token: Optional[CancellationToken] = None,
+                                  controller: Optional[DriveController] = None):
+    """
+        The same as gyro_movements.straight_drive_distance(), but yields to the event loop between iterations. Runs on
+        controller, or the default controller of gyro_movements if it is None.
+    """
+    controller = controller or gyro_movements.controller
+    condition = controller._distance_condition(speed, inches)
+    controller.sensor_hub.subscribe_motor_positions()
+    try:
+        await straight_drive(speed, condition, stop_when_finished, cancel_token=cancel_token, controller=controller)
+    finally:
+        controller.sensor_hub.unsubscribe_motor_positions()
+
+
+async def wait_4_light(port, ignore=False, cancel_token: Optional[CancellationToken] = None, rate_hz=100):
+    """
+        The same as light.wait_4_light(), but yields to the event loop while waiting for the light. Calibration is
+        interactive, so it runs on a worker thread.
+    """
+    loop = asyncio.get_running_loop()
+    if ignore:
+        await loop.run_in_executor(None, light.wait_for_button)
+        return
+    if not light.USE_BUTTON_INSTEAD:
+        while not await loop.run_in_executor(None, light._calibrate, port):
+            pass
+    scheduler = LoopScheduler(rate_hz, "async_wait_4_light")
+    scheduler.start()
+    print("waiting for light!!")
+    i = 10
+    while i > 0:
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+        if (hardware.analog(port) < light.START_LIGHT_THRESHOLD
+                or (light.USE_BUTTON_INSTEAD and inputs.is_pressed("push"))):
+            i = i - 1
+        else:
+            i = 10
+        await scheduler.wait_async()
+
+
+async def move_motor(port, position, gain=DEFAULT_MOTOR_GAIN, tolerance=DEFAULT_MOTOR_TOLERANCE, hold=False,
+                     rate_hz=100):
+    """
+        Drives a motor to a position with the same control law as MultitaskedMotor.
+
+
+        :param port: The motor port.
+
+        :param position: The motor position counter value to move to.
+
+        :param gain: The motor power applied per tick of position error.
+
+        :param tolerance: How many ticks away from the target still count as being at the target.
+
+        :param hold: If False, returns once the motor is within tolerance. If True, keeps holding the position until
+            the task is cancelled.
+
+        :param rate_hz: The number of times per second the motor power is updated. Defaults to 100.
+    """
+    scheduler = LoopScheduler(rate_hz, f"async_motor_{port}")
+    scheduler.start()
+    try:
+        while True:
+            error = position - hardware.get_motor_position_counter(port)
+            if not hold and abs(error) <= tolerance:
+                return
+            hardware.motor_power(port, max(min(int(gain * error), 100), -100))
+            await scheduler.wait_async()
+    finally:
+        hardware.freeze(port)
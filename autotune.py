@@ -0,0 +1,439 @@
+"""
+Fits the gyro_init tuning coefficients from recorded telemetry traces instead of tuning them by hand. Runs offline,
+usually on a laptop, and needs NumPy.
+
+Usage:
+    # On the robot, with telemetry enabled, drive and turn at several speeds
+    telemetry.enable()
+    gyro_turn(-30, 30, 90)
+    gyro_turn(-90, 90, 90)
+    straight_drive_distance(40, 24)
+    straight_drive_distance(90, 24)
+    telemetry.recorder.dump("tuning.trace")
+
+    # Offline
+    result = autotune.fit([telemetry.load("tuning.trace")], actual_angles=[91, 97], ticks_per_inch=180)
+    autotune.report(result)
+    autotune.save(result, "calibration.json", robot="BLUE")
+
+or from the command line:
+    python -m common.autotune tuning.trace --actual-angles 91 97 --ticks-per-inch 180 \
+        --save calibration.json --robot BLUE
+
+Then copy calibration.json to the robot's home directory. If the file already exists, for example because it was
+copied from the robot first, the other values in it are kept.
+"""
+import sys
+from typing import NamedTuple, Dict, List, Optional, Sequence
+from common import telemetry
+from common.calibration_store import COEFFICIENT_NAMES, CalibrationStore
+from common.core.robot_id import Robot
+
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError("The autotuner needs NumPy, install it with: pip install numpy") from e
+
+# The gyro_init defaults, which are assumed to be the coefficients the traces were recorded with
+DEFAULT_COEFFICIENTS = {
+    "gyro_turn_error_adjustment": 1.0,
+    "gyro_turn_momentum_adjustment": 0.0,
+    "straight_drive_error_adjustment": 0.13,
+    "straight_drive_integral_adjustment": 0.3,
+    "straight_drive_distance_momentum_adjustment": 0.0,
+}
+
+# Samples further apart than this belong to different movements
+RUN_GAP = 0.25
+
+DEFAULT_ERROR_GAINS = np.linspace(0.0, 0.5, 26)
+DEFAULT_INTEGRAL_GAINS = np.linspace(0.0, 1.5, 31)
+
+
+class Run(NamedTuple):
+    """
+    One gyro turn or straight drive cut out of a trace
+    """
+    source: int
+    target: float
+    speed: float
+    samples: Dict[str, "np.ndarray"]
+    coast: Optional[Dict[str, "np.ndarray"]]
+
+
+class SpeedError(NamedTuple):
+    """
+    The error of the runs at one speed with the recorded coefficients and the error predicted with the fitted ones
+    """
+    speed: float
+    runs: int
+    current: float
+    predicted: float
+
+
+class TuningResult(NamedTuple):
+    coefficients: Dict[str, float]
+    turn_errors: List[SpeedError]
+    drive_heading_errors: List[SpeedError]
+    distance_errors: List[SpeedError]
+
+
+def _columns(trace):
+    # Wraps the array columns of a trace or recorder as NumPy arrays without copying them
+    if isinstance(trace, telemetry.Recorder):
+        columns = zip(telemetry.FIELDS, trace._ordered_columns())
+        trace = telemetry.Trace({name: column for (name, code), column in columns})
+    return {name: np.frombuffer(column, dtype=np.dtype(column.typecode)) if len(column) else
+            np.zeros(0, dtype=np.dtype(column.typecode)) for name, column in trace.columns.items()}
+
+
+def split_runs(trace):
+    """
+    Cuts a trace into gyro turns and straight drives, each with the settle samples recorded right after it
+
+    :param trace: A Trace from telemetry.load() or a telemetry Recorder.
+    """
+    columns = _columns(trace)
+    # The motor engine records from its own thread, so its samples are interleaved with the movement samples
+    keep = columns["source"] != telemetry.SOURCE_MOTOR
+    columns = {name: column[keep] for name, column in columns.items()}
+    if not len(columns["time"]):
+        return []
+    source = columns["source"]
+    heading = np.abs(columns["heading"])
+    new_run = np.zeros(len(source), dtype=bool)
+    new_run[1:] = ((source[1:] != source[:-1])
+                   | (np.diff(columns["time"]) > RUN_GAP)
+                   # Back to back turns have no gap, but the heading of each one starts again from zero
+                   | ((source[1:] == telemetry.SOURCE_GYRO_TURN) & (columns["target"][1:] != columns["target"][:-1]))
+                   | ((source[1:] == telemetry.SOURCE_GYRO_TURN) & (heading[1:] < heading[:-1] / 2 - 1)))
+    starts = np.flatnonzero(new_run)
+    blocks = [{name: column[start:end] for name, column in columns.items()}
+              for start, end in zip(np.concatenate(([0], starts)), np.concatenate((starts, [len(source)])))]
+    runs = []
+    for index, block in enumerate(blocks):
+        kind = int(block["source"][0])
+        if kind == telemetry.SOURCE_SETTLE:
+            continue
+        following = blocks[index + 1] if index + 1 < len(blocks) else None
+        coast = None
+        if (following is not None and following["source"][0] == telemetry.SOURCE_SETTLE
+                and following["time"][0] - block["time"][-1] <= RUN_GAP):
+            coast = following
+        if kind == telemetry.SOURCE_GYRO_TURN:
+            speed = abs(int(block["right_command"][0]) - int(block["left_command"][0]))
+        else:
+            speed = abs(float(block["target"][-1]))
+        runs.append(Run(kind, float(block["target"][0]), speed, block, coast))
+    return runs
+
+
+def _integral(columns):
+    # The raw gyro readings integrated over time, in the units the movement loops use before scaling by 8
+    return float(np.dot(columns["gyro"].astype(np.float64), columns["period"].astype(np.float64)))
+
+
+def _by_speed(speeds, current, predicted):
+    speeds = np.round(np.asarray(speeds, dtype=np.float64))
+    current = np.asarray(current, dtype=np.float64)
+    predicted = np.asarray(predicted, dtype=np.float64)
+    errors = []
+    for speed in np.unique(speeds):
+        selected = speeds == speed
+        errors.append(SpeedError(float(speed), int(selected.sum()), float(current[selected].mean()),
+                                 float(predicted[selected].mean())))
+    return errors
+
+
+def _through_origin(x, y):
+    # Least squares slope of y = slope * x
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    denominator = np.dot(x, x)
+    return float(np.dot(x, y) / denominator) if denominator else 0.0
+
+
+def fit_turns(runs, recorded, actual_angles=None):
+    """
+    Fits gyro_turn_error_adjustment and gyro_turn_momentum_adjustment. Returns the coefficients and the turn errors by
+    speed difference, or None if there are no turns followed by settle samples.
+
+    The gyro scale is fitted by least squares against the measured angles, and the momentum adjustment by least squares
+    of the overshoot against the speed difference between the wheels, which is how gyro_turn scales it.
+
+    :param runs: Runs from split_runs().
+
+    :param recorded: The coefficients the runs were recorded with.
+
+    :param actual_angles: The measured angle of each turn, in order, or None for turns that were not measured. Without
+        them the gyro scale the turns were recorded with is assumed to be right.
+    """
+    turns = [run for run in runs if run.source == telemetry.SOURCE_GYRO_TURN and run.coast is not None]
+    if not turns:
+        return None
+    recorded_error = recorded["gyro_turn_error_adjustment"]
+    recorded_momentum = recorded["gyro_turn_momentum_adjustment"]
+    targets = np.array([abs(run.target) for run in turns])
+    speeds = np.array([run.speed for run in turns], dtype=np.float64)
+    # Integrals are signed along the direction of each turn
+    directions = np.array([np.sign(_integral(run.samples)) or 1.0 for run in turns])
+    turned = np.array([_integral(run.samples) for run in turns]) * directions / 8
+    coasted = np.array([_integral(run.coast) for run in turns]) * directions / 8
+
+    scale = recorded_error
+    if actual_angles is not None:
+        measured = np.array([np.nan if angle is None else abs(angle) for angle in actual_angles[:len(turns)]]
+                            + [np.nan] * max(len(turns) - len(actual_angles), 0))
+        known = ~np.isnan(measured)
+        if known.any():
+            scale = _through_origin((turned + coasted)[known], measured[known])
+
+    # In true degrees: how far each turn went past the point where the loop decided to stop, and how far it coasted
+    stop_point = (scale / recorded_error) * (targets - speeds * recorded_momentum)
+    overshoot = scale * turned - stop_point
+    coast = scale * coasted
+    momentum = _through_origin(speeds, overshoot + coast)
+    current = scale * (turned + coasted) - targets
+    predicted = overshoot + coast - momentum * speeds
+    coefficients = {"gyro_turn_error_adjustment": scale, "gyro_turn_momentum_adjustment": momentum}
+    return coefficients, _by_speed(speeds, current, predicted)
+
+
+def fit_distance(runs, recorded, ticks_per_inch):
+    """
+    Fits straight_drive_distance_momentum_adjustment from how far the robot coasted after each straight drive. Returns
+    the coefficient and the distance errors by speed, or None if there are no drives followed by settle samples.
+
+    :param runs: Runs from split_runs().
+
+    :param recorded: The coefficients the runs were recorded with.
+
+    :param ticks_per_inch: The straight drive distance proportion, in motor ticks of both wheels per inch.
+    """
+    drives = [run for run in runs if run.source == telemetry.SOURCE_STRAIGHT_DRIVE and run.coast is not None]
+    if not drives:
+        return None
+    speeds = np.array([run.speed for run in drives], dtype=np.float64)
+    coasted = np.array([
+        abs((int(run.coast["left_position"][-1]) + int(run.coast["right_position"][-1]))
+            - (int(run.samples["left_position"][-1]) + int(run.samples["right_position"][-1])))
+        for run in drives]) / ticks_per_inch
+    adjustment = _through_origin(speeds / 100, coasted)
+    current = coasted - recorded["straight_drive_distance_momentum_adjustment"] * speeds / 100
+    predicted = coasted - adjustment * speeds / 100
+    return {"straight_drive_distance_momentum_adjustment": adjustment}, _by_speed(speeds, current, predicted)
+
+
+def identify_drive(runs):
+    """
+    Fits a first order model of how the gyroscope responds to the difference between the wheel commands during
+    straight drives: gyro[t + 1] = decay * gyro[t] + gain * (right[t] - left[t]) + drift, with one drift per drive.
+    Returns (decay, gain, drifts, period), or None if there are not enough samples.
+    """
+    drives = [run for run in runs if run.source == telemetry.SOURCE_STRAIGHT_DRIVE and len(run.samples["gyro"]) > 3]
+    if not drives:
+        return None
+    rows = []
+    targets = []
+    for index, run in enumerate(drives):
+        gyro = run.samples["gyro"].astype(np.float64)
+        command = (run.samples["right_command"].astype(np.float64) - run.samples["left_command"].astype(np.float64))
+        design = np.zeros((len(gyro) - 1, 2 + len(drives)))
+        design[:, 0] = gyro[:-1]
+        design[:, 1] = command[:-1]
+        design[:, 2 + index] = 1.0
+        rows.append(design)
+        targets.append(gyro[1:])
+    design = np.concatenate(rows)
+    if len(design) < design.shape[1] * 3:
+        return None
+    solution = np.linalg.lstsq(design, np.concatenate(targets), rcond=None)[0]
+    periods = np.concatenate([run.samples["period"][1:] for run in drives]).astype(np.float64)
+    return solution[0], solution[1], solution[2:], float(np.median(periods))
+
+
+def simulate_drive(error_gains, integral_gains, decay, gain, drifts, period, scale, steps):
+    """
+    Simulates straight drives on the identified model for every combination of gains at once. Returns the RMS heading
+    error in degrees and the RMS change in the correction per iteration, each shaped (error gains, integral gains,
+    drifts).
+    """
+    error_gains = np.asarray(error_gains, dtype=np.float64)[:, None, None]
+    integral_gains = np.asarray(integral_gains, dtype=np.float64)[None, :, None]
+    drifts = np.asarray(drifts, dtype=np.float64)[None, None, :]
+    shape = np.broadcast_shapes(error_gains.shape, integral_gains.shape, drifts.shape)
+    gyro = np.zeros(shape)
+    heading = np.zeros(shape)
+    previous = np.zeros(shape)
+    heading_error = np.zeros(shape)
+    shaking = np.zeros(shape)
+    with np.errstate(over="ignore", invalid="ignore"):
+        for x in range(steps):
+            correction = np.clip(error_gains * gyro + integral_gains * heading, -100, 100)
+            gyro = decay * gyro + gain * correction + drifts
+            heading = heading + gyro * period
+            heading_error += (scale * heading / 8) ** 2
+            shaking += (correction - previous) ** 2
+            previous = correction
+    heading_error = np.sqrt(heading_error / steps)
+    shaking = np.sqrt(shaking / steps)
+    unstable = ~np.isfinite(heading_error) | ~np.isfinite(shaking)
+    heading_error[unstable] = np.inf
+    shaking[unstable] = np.inf
+    return heading_error, shaking
+
+
+def fit_drive_gains(runs, recorded, scale, shake_weight=0.5, error_gains=DEFAULT_ERROR_GAINS,
+                    integral_gains=DEFAULT_INTEGRAL_GAINS, seconds=3.0):
+    """
+    Fits straight_drive_error_adjustment and straight_drive_integral_adjustment with a grid search over simulated
+    drives. Returns the coefficients and the RMS heading error by speed, or None if there are not enough samples.
+
+    :param runs: Runs from split_runs().
+
+    :param recorded: The coefficients the runs were recorded with.
+
+    :param scale: The gyro_turn_error_adjustment, used to convert headings to degrees.
+
+    :param shake_weight: How many degrees of heading error are worth one unit of RMS change in the correction per
+        iteration. Higher values give smoother but less straight drives.
+
+    :param error_gains: The straight_drive_error_adjustment values searched.
+
+    :param integral_gains: The straight_drive_integral_adjustment values searched.
+
+    :param seconds: The length of each simulated drive.
+    """
+    model = identify_drive(runs)
+    if model is None:
+        return None
+    decay, gain, drifts, period = model
+    steps = max(int(seconds / period), 1)
+    heading_error, shaking = simulate_drive(error_gains, integral_gains, decay, gain, drifts, period, scale, steps)
+    cost = (heading_error + shake_weight * shaking).mean(axis=2)
+    best_error, best_integral = np.unravel_index(np.argmin(cost), cost.shape)
+    if best_error == len(error_gains) - 1 or best_integral == len(integral_gains) - 1:
+        print("Warning, the best straight drive gains are at the edge of the search grid, consider widening it.")
+    coefficients = {"straight_drive_error_adjustment": float(error_gains[best_error]),
+                    "straight_drive_integral_adjustment": float(integral_gains[best_integral])}
+    current = simulate_drive([recorded["straight_drive_error_adjustment"]],
+                             [recorded["straight_drive_integral_adjustment"]],
+                             decay, gain, drifts, period, scale, steps)[0][0, 0]
+    speeds = [run.speed for run in runs if run.source == telemetry.SOURCE_STRAIGHT_DRIVE and
+              len(run.samples["gyro"]) > 3]
+    return coefficients, _by_speed(speeds, current, heading_error[best_error, best_integral])
+
+
+def fit(traces, actual_angles: Optional[Sequence[Optional[float]]] = None, ticks_per_inch=None,
+        recorded_coefficients=None, shake_weight=0.5):
+    """
+    Fits the gyro_init tuning coefficients from telemetry traces. Coefficients without enough data are left out of the
+    result.
+
+
+    :param traces: Traces from telemetry.load() or telemetry Recorders.
+
+    :param actual_angles: The measured angle of each recorded gyro turn, in order, or None for turns that were not
+        measured. Without them the gyro scale the turns were recorded with is assumed to be right.
+
+    :param ticks_per_inch: The straight drive distance proportion. Defaults to the value in the calibration store.
+
+    :param recorded_coefficients: The coefficients the traces were recorded with. Missing ones default to the gyro_init
+        defaults.
+
+    :param shake_weight: Passed to fit_drive_gains().
+    """
+    recorded = dict(DEFAULT_COEFFICIENTS)
+    recorded.update(recorded_coefficients or {})
+    runs = [run for trace in traces for run in split_runs(trace)]
+    coefficients = {}
+    turn_errors = drive_heading_errors = distance_errors = []
+
+    turns = fit_turns(runs, recorded, actual_angles)
+    if turns:
+        coefficients.update(turns[0])
+        turn_errors = turns[1]
+
+    drive = fit_drive_gains(runs, recorded, coefficients.get("gyro_turn_error_adjustment",
+                                                             recorded["gyro_turn_error_adjustment"]), shake_weight)
+    if drive:
+        coefficients.update(drive[0])
+        drive_heading_errors = drive[1]
+
+    if ticks_per_inch is None:
+        from common.calibration_store import calibration_store
+        try:
+            ticks_per_inch = calibration_store.get("ticks_per_inch")
+        except OSError as e:
+            print(f"Not fitting the distance adjustment, ticks per inch is unknown: {e}")
+    if ticks_per_inch:
+        distance = fit_distance(runs, recorded, ticks_per_inch)
+        if distance:
+            coefficients.update(distance[0])
+            distance_errors = distance[1]
+
+    return TuningResult({name: coefficients[name] for name in COEFFICIENT_NAMES if name in coefficients},
+                        turn_errors, drive_heading_errors, distance_errors)
+
+
+def report(result: TuningResult):
+    """
+    Prints the fitted coefficients and the error at each speed with the recorded and the fitted coefficients
+    """
+    for name in COEFFICIENT_NAMES:
+        print(f"{name:<44} {result.coefficients[name]:8.4f}" if name in result.coefficients else
+              f"{name:<44} not enough data")
+    for title, unit, errors in (("Turn error by wheel speed difference", "degrees", result.turn_errors),
+                                ("Straight drive RMS heading error by speed", "degrees", result.drive_heading_errors),
+                                ("Straight drive distance error by speed", "inches", result.distance_errors)):
+        if not errors:
+            continue
+        print(f"{title} ({unit}):")
+        print(f"    {'speed':>6} {'runs':>5} {'current':>9} {'predicted':>9}")
+        for error in errors:
+            print(f"    {error.speed:6.0f} {error.runs:5d} {error.current:9.2f} {error.predicted:9.2f}")
+
+
+def save(result: TuningResult, path, robot):
+    """
+    Saves the fitted coefficients to a calibration file for a robot. Once the file is copied to the robot,
+    gyro_init(use_stored_coefficients=True) loads them.
+
+    :param result: The result of fit().
+
+    :param path: The calibration file to write. Other values already in it are kept.
+
+    :param robot: The name of the robot the coefficients belong to, as in its whoami.txt, for example BLUE. The case is
+        ignored. Raises ValueError for unknown robots.
+    """
+    try:
+        name = Robot(robot.upper()).value
+    except ValueError:
+        names = ", ".join(known.value for known in Robot)
+        raise ValueError(f"Unknown robot {robot!r}, expected one of {names}") from None
+    CalibrationStore(path, name).set_coefficients(**result.coefficients)
+
+
+def main(arguments):
+    import argparse
+    parser = argparse.ArgumentParser(description="Fits the gyro_init tuning coefficients from telemetry traces")
+    parser.add_argument("traces", nargs="+")
+    parser.add_argument("--actual-angles", nargs="*", type=float)
+    parser.add_argument("--ticks-per-inch", type=float)
+    parser.add_argument("--shake-weight", type=float, default=0.5)
+    parser.add_argument("--save", metavar="PATH", help="Saves the coefficients to a calibration file for the robot")
+    parser.add_argument("--robot", type=str.upper, choices=[robot.value for robot in Robot],
+                        help="The name of the robot the coefficients are saved for, needed with --save")
+    options = parser.parse_args(arguments)
+    if options.save and not options.robot:
+        parser.error("--save needs --robot")
+    result = fit([telemetry.load(path) for path in options.traces], options.actual_angles, options.ticks_per_inch,
+                 shake_weight=options.shake_weight)
+    report(result)
+    if options.save:
+        save(result, options.save, options.robot)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
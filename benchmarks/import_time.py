@@ -0,0 +1,100 @@
+"""
+Measures how long each common module takes to import in a fresh interpreter, and checks that importing stays within
+the time budget, does not read any data files from disk and does not pull in slow standard library modules.
+
+Usage:
+    python -m common.benchmarks.import_time [repeats] [--budget-ms 100]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# The modules measured, with the slow modules each one is allowed to import
+MODULES = {
+    "common": (),
+    "common.core.robot_id": (),
+    "common.gyro_movements": (),
+    "common.light": (),
+    # The worker pool is built on concurrent.futures, which imports logging
+    "common.multitasker": ("concurrent.futures", "logging"),
+    "common.post": ("concurrent.futures", "logging"),
+}
+
+# Modules that take tens of milliseconds to import on the robot, so they must only be imported when they are used
+SLOW_MODULES = ("asyncio", "concurrent.futures", "logging", "numpy")
+
+# The longest time any module may take to import, measured on the robot
+DEFAULT_BUDGET_MS = 100.0
+
+# Runs in the child interpreter: records every file opened during the import, ignoring Python sources and bytecode,
+# and the slow modules it imported
+_PROBE = """
+import sys, time
+opened = []
+def hook(event, args):
+    if event == "open" and isinstance(args[0], str) and not args[0].endswith((".py", ".pyc", ".so")):
+        opened.append(args[0])
+sys.addaudithook(hook)
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+files = [path for path in opened if not path.startswith(sys.prefix) and "__pycache__" not in path]
+slow = [name for name in {slow_modules!r} if name in sys.modules]
+import json
+print(elapsed)
+print(json.dumps({{"files": files, "slow": slow}}))
+"""
+
+
+def _package_parent():
+    # The directory that contains the common package
+    return os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def measure(module, repeats=5):
+    """
+    Returns the fastest import time of a module in seconds, the data files it opened and the slow modules it imported
+    """
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join(filter(None, [_package_parent(), environment.get("PYTHONPATH")]))
+    best = float("inf")
+    found = {"files": [], "slow": []}
+    for x in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(module=module, slow_modules=SLOW_MODULES)],
+            env=environment, capture_output=True, text=True, check=True,
+        ).stdout.splitlines()
+        best = min(best, float(output[-2]))
+        found = json.loads(output[-1])
+    return best, found["files"], found["slow"]
+
+
+def main(repeats=5, budget_ms=DEFAULT_BUDGET_MS):
+    failed = False
+    for module, allowed in MODULES.items():
+        try:
+            elapsed, files, slow = measure(module, repeats)
+        except subprocess.CalledProcessError as e:
+            print(f"{module:<28} failed to import:\n{e.stderr}")
+            failed = True
+            continue
+        problems = []
+        if elapsed * 1000 > budget_ms:
+            problems.append(f"over the {budget_ms:.0f} ms budget")
+        problems.extend(f"imports {name}" for name in slow if name not in allowed)
+        if files:
+            problems.append("reads " + ", ".join(files))
+        print(f"{module:<28} {elapsed * 1000:8.2f} ms  {', '.join(problems) or 'ok'}")
+        failed = failed or bool(problems)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the import time of the common modules")
+    parser.add_argument("repeats", nargs="?", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS,
+                        help="The longest time any module may take to import")
+    options = parser.parse_args()
+    sys.exit(main(options.repeats, options.budget_ms))
@@ -0,0 +1,344 @@
+"""
+Benchmarks the movement control loops and the Multitasker against a stub hardware backend with zero-latency I/O, and
+saves the results as JSON so regressions show up between versions.
+
+Usage:
+    python -m common.benchmarks.movement [--output results.json] [--compare previous.json]
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from statistics import quantiles
+from common import hardware
+from common.calibration_store import CalibrationStore
+from common.drive_controller import DriveController
+from common.multitasker import MotorEngine, Multitasker
+from common.scheduler import LoopScheduler
+
+RESULTS_VERSION = 1
+
+
+class StubBackend(hardware.KiprBackend):
+    """
+    Answers every hardware call immediately. Sleeps return at once unless real_sleep is set, so the control loops run
+    as fast as the CPU allows.
+    """
+
+    def __init__(self, gyro_value=0, real_sleep=False):
+        # Does not call KiprBackend.__init__, which imports kipr
+        self.gyro_value = gyro_value
+        self.gyro_reads = 0
+        # Called on every gyroscope read if set
+        self.on_gyro_read = None
+        self.monotonic = time.monotonic
+        self.time = time.time
+        self.sleep = time.sleep if real_sleep else self._no_sleep
+
+    @staticmethod
+    def _no_sleep(seconds):
+        pass
+
+    def msleep(self, milliseconds):
+        self.sleep(milliseconds / 1000)
+
+    def gyro_z(self):
+        self.gyro_reads += 1
+        if self.on_gyro_read is not None:
+            self.on_gyro_read()
+        return self.gyro_value
+
+    @staticmethod
+    def analog(port):
+        return 0
+
+    @staticmethod
+    def digital(port):
+        return 0
+
+    @staticmethod
+    def push_button():
+        return 0
+
+    a_button = b_button = c_button = push_button
+
+    @staticmethod
+    def motor_power(port, power):
+        pass
+
+    @staticmethod
+    def get_motor_position_counter(port):
+        return 0
+
+    @staticmethod
+    def freeze(port):
+        pass
+
+    @staticmethod
+    def console_clear():
+        pass
+
+    @staticmethod
+    def set_servo_position(port, position):
+        pass
+
+    @staticmethod
+    def get_servo_position(port):
+        return 1024
+
+    @staticmethod
+    def enable_servo(port):
+        pass
+
+
+def _init_movements(backend, directory):
+    hardware.use(backend)
+    # Keeps the benchmark from reading or writing the robot's calibration file
+    store = CalibrationStore(os.path.join(directory, "calibration.json"), robot="benchmark")
+    return DriveController(store, os.path.join(directory, "straight.txt")).init(
+        lambda left, right: None, lambda: None, lambda: (0, 0), lambda: False, warm_start=False,
+        track_gyro_bias=False)
+
+
+class _AllocationMeter:
+    """
+    Measures the memory each iteration allocates while tracemalloc is tracing. tick() is called once per iteration and
+    adds up how far the traced memory rose above where it was at the previous tick, so memory that an iteration
+    allocates and frees again is counted as well.
+    """
+
+    def __init__(self):
+        self.allocated = 0
+        self.ticks = 0
+        self._level = None
+
+    def tick(self):
+        current, peak = tracemalloc.get_traced_memory()
+        if self._level is not None:
+            self.allocated += peak - self._level
+            self.ticks += 1
+        # The tuple returned above is already counted in current, so it does not count against the next iteration
+        tracemalloc.reset_peak()
+        self._level = tracemalloc.get_traced_memory()[0]
+
+    def per_tick(self):
+        return self.allocated / self.ticks if self.ticks else 0.0
+
+
+def _meter_overhead(ticks=1000):
+    # The memory tick() itself shows as allocated, subtracted from the measurements
+    meter = _AllocationMeter()
+    tracemalloc.start()
+    for x in range(ticks):
+        meter.tick()
+    tracemalloc.stop()
+    return meter.per_tick()
+
+
+def _measure(run):
+    """
+    Runs a benchmark once for timing and once under tracemalloc. run takes a function to call once per iteration, or
+    None, and returns its iteration count. Returns the iterations per second, the CPU time per iteration, the bytes
+    allocated per iteration, the peak traced memory, and the blocks and bytes still allocated per iteration after the
+    run.
+    """
+    gc.collect()
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    iterations = run(None)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - start_cpu
+
+    overhead = _meter_overhead()
+    meter = _AllocationMeter()
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    traced_iterations = run(meter.tick)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.collect()
+    retained = sys.getallocatedblocks() - blocks
+    return {
+        "iterations": iterations,
+        "iterations_per_second": iterations / elapsed,
+        "cpu_us_per_iteration": cpu / iterations * 1e6,
+        "allocated_bytes_per_iteration": max(meter.per_tick() - overhead, 0.0),
+        "peak_traced_bytes": peak,
+        "retained_blocks_per_iteration": retained / traced_iterations,
+        "retained_bytes_per_iteration": current / traced_iterations,
+    }
+
+
+def bench_gyro_turn(seconds=0.5):
+    """
+    Runs a 90 degree gyro turn that the stub gyroscope finishes in the given number of seconds
+    """
+    backend = StubBackend()
+    with tempfile.TemporaryDirectory() as directory:
+        controller = _init_movements(backend, directory)
+        # Set after calibrating, which would otherwise measure it as the gyro offset
+        backend.gyro_value = 8 * 90 / seconds
+
+        def run(tick):
+            backend.gyro_reads = 0
+            # The turn reads the gyroscope once per iteration
+            backend.on_gyro_read = tick
+            controller.gyro_turn(-50, 50, 90, stop_when_finished=False)
+            backend.on_gyro_read = None
+            return backend.gyro_reads
+
+        return _measure(run)
+
+
+def bench_straight_drive(iterations=20000):
+    with tempfile.TemporaryDirectory() as directory:
+        controller = _init_movements(StubBackend(), directory)
+
+        def run(tick):
+            remaining = [iterations]
+
+            def condition():
+                remaining[0] -= 1
+                return remaining[0] > 0
+
+            def ticking_condition():
+                tick()
+                return condition()
+
+            controller.straight_drive(80, ticking_condition if tick else condition, stop_when_finished=False)
+            return iterations - 1
+
+        return _measure(run)
+
+
+def bench_motor_engine(motors=4, iterations=20000):
+    hardware.use(StubBackend())
+    engine = MotorEngine()
+    # Marked as running so registering does not start the control thread, the benchmark calls the update directly
+    engine.running = True
+    for port in range(motors):
+        engine.register(port, 1000)
+
+    def run(tick):
+        for x in range(iterations):
+            if tick:
+                tick()
+            engine._move_motors()
+        return iterations
+
+    result = _measure(run)
+    result["motors"] = motors
+    return result
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if len(values) < 2:
+        return {"p50": values[0] if values else 0.0, "p99": values[0] if values else 0.0,
+                "max": values[-1] if values else 0.0}
+    cuts = quantiles(values, n=100, method="inclusive")
+    return {"p50": cuts[49], "p99": cuts[98], "max": values[-1]}
+
+
+def bench_multitasker(tasks, rate_hz=200, iterations=100, work_us=200):
+    """
+    Runs several fixed-rate loops as Multitasker tasks at once, each busy for work_us per iteration, and measures how
+    long tasks take to start and how late each loop wakes up
+    """
+    hardware.use(StubBackend(real_sleep=True))
+    start_latencies = []
+    wake_latencies = []
+    overruns = []
+
+    def task(submitted):
+        start_latencies.append(time.perf_counter() - submitted)
+        scheduler = LoopScheduler(rate_hz, "benchmark_task")
+        start = scheduler.start()
+        for iteration in range(1, iterations + 1):
+            scheduler.wait()
+            wake_latencies.append(max(scheduler.last_tick - (start + iteration * scheduler.period), 0.0))
+            end = time.perf_counter() + work_us / 1e6
+            while time.perf_counter() < end:
+                pass
+        overruns.append(scheduler.overruns)
+
+    begin = time.perf_counter()
+    with Multitasker() as multitasker:
+        for x in range(tasks):
+            multitasker.do(task, (time.perf_counter(),))
+    elapsed = time.perf_counter() - begin
+    return {
+        "tasks": tasks,
+        "elapsed_s": elapsed,
+        "expected_s": iterations / rate_hz,
+        "start_latency_ms": {name: value * 1000 for name, value in _percentiles(start_latencies).items()},
+        "wake_latency_ms": {name: value * 1000 for name, value in _percentiles(wake_latencies).items()},
+        "overruns": sum(overruns),
+    }
+
+
+def run_all():
+    results = {
+        "gyro_turn": bench_gyro_turn(),
+        "straight_drive": bench_straight_drive(),
+        "motor_engine": bench_motor_engine(),
+    }
+    for tasks in (5, 10):
+        results[f"multitasker_{tasks}_tasks"] = bench_multitasker(tasks)
+    return results
+
+
+def _flatten(results, prefix=""):
+    flat = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{name}."))
+        else:
+            flat[f"{prefix}{name}"] = value
+    return flat
+
+
+def compare(previous, current):
+    """
+    Prints every metric that is in both result sets with its relative change
+    """
+    old = _flatten(previous["results"])
+    new = _flatten(current["results"])
+    for name in sorted(set(old) & set(new)):
+        change = f"{(new[name] - old[name]) / old[name] * 100:+7.1f}%" if old[name] else "      -"
+        print(f"{name:<52} {old[name]:14.3f} {new[name]:14.3f} {change}")
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Benchmarks the movement control loops and the Multitasker")
+    parser.add_argument("--output", default="movement_benchmark.json", help="Where to save the results")
+    parser.add_argument("--compare", help="A previous results file to compare with")
+    options = parser.parse_args(arguments)
+    current = {
+        "version": RESULTS_VERSION,
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "results": run_all(),
+    }
+    with open(options.output, "w") as f:
+        json.dump(current, f, indent=2)
+    for name, value in _flatten(current["results"]).items():
+        print(f"{name:<52} {value:14.3f}")
+    if options.compare:
+        with open(options.compare) as f:
+            previous = json.load(f)
+        print(f"\nCompared with {options.compare}:")
+        compare(previous, current)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,128 @@
+"""
+Provides a persistent, versioned calibration cache keyed by robot
+"""
+import json
+import os
+from time import time
+from common.core.properties import atomic_write_json
+
+CALIBRATION_VERSION = 1
+CALIBRATION_PATH = os.path.expanduser("~/calibration.json")
+
+# Gyro bias drifts with temperature, so it goes stale much sooner than the drive calibration
+GYRO_OFFSET_MAX_AGE = 24 * 60 * 60
+TICKS_PER_INCH_MAX_AGE = None
+
+COEFFICIENT_NAMES = (
+    "gyro_turn_error_adjustment",
+    "gyro_turn_momentum_adjustment",
+    "straight_drive_error_adjustment",
+    "straight_drive_integral_adjustment",
+    "straight_drive_distance_momentum_adjustment",
+)
+
+
+class CalibrationStore:
+    """
+    Stores calibration values for each robot in a JSON file. Every value is saved with the time it was measured so
+    that stale values can be ignored, and the whole file is ignored if it was written by an incompatible version.
+    """
+
+    def __init__(self, path=CALIBRATION_PATH, robot=None):
+        """
+        :param path: The path of the calibration file.
+
+        :param robot: The name of the robot the values belong to. Defaults to the robot in the RobotID project.
+        """
+        self.path = path
+        self._robot = robot
+        self._data = None
+
+    @property
+    def robot(self):
+        if self._robot is None:
+            from common.core.robot_id import ROBOT
+            self._robot = ROBOT.value
+        return self._robot
+
+    def _load(self):
+        if self._data is None:
+            self._data = {"version": CALIBRATION_VERSION, "robots": {}}
+            try:
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == CALIBRATION_VERSION:
+                    self._data = data
+                else:
+                    print(f"Ignoring calibration file with version {data.get('version')}")
+            except FileNotFoundError:
+                pass
+            except (ValueError, AttributeError):
+                print("Error reading calibration file, ignoring it...")
+        return self._data["robots"].setdefault(self.robot, {})
+
+    def get(self, name, max_age=None):
+        """
+        Returns a stored value, or None if it is missing or older than max_age seconds
+
+        :param name: The name of the value.
+
+        :param max_age: The largest age in seconds a value can have to still be valid. Defaults to None, no limit.
+        """
+        entry = self._load().get(name)
+        if not isinstance(entry, dict) or "value" not in entry:
+            return None
+        if max_age is not None and time() - entry.get("time", 0) > max_age:
+            return None
+        return entry["value"]
+
+    def age(self, name):
+        """
+        Returns how many seconds ago a value was stored, or None if it is missing
+        """
+        entry = self._load().get(name)
+        if not isinstance(entry, dict):
+            return None
+        return time() - entry.get("time", 0)
+
+    def set(self, name, value, save=True):
+        """
+        Stores a value with the current time
+
+        :param name: The name of the value.
+
+        :param value: A JSON serializable value.
+
+        :param save: Writes the file immediately. Defaults to True.
+        """
+        self._load()[name] = {"value": value, "time": time()}
+        if save:
+            self.save()
+
+    def save(self):
+        """
+        Writes the calibration file, replacing it atomically so a power loss cannot corrupt it
+        """
+        self._load()
+        atomic_write_json(self.path, self._data)
+
+    def coefficients(self):
+        """
+        Returns the stored gyro_init tuning coefficients as a dictionary of keyword arguments
+        """
+        stored = self.get("coefficients") or {}
+        return {name: stored[name] for name in COEFFICIENT_NAMES if name in stored}
+
+    def set_coefficients(self, **coefficients):
+        """
+        Stores gyro_init tuning coefficients, keeping any that are not given
+        """
+        unknown = set(coefficients) - set(COEFFICIENT_NAMES)
+        if unknown:
+            raise ValueError(f"Unknown coefficients: {', '.join(sorted(unknown))}")
+        stored = self.get("coefficients") or {}
+        stored.update(coefficients)
+        self.set("coefficients", stored)
+
+
+calibration_store = CalibrationStore()
@@ -0,0 +1,45 @@
+"""
+Provides cooperative cancellation for long-running movements and waits
+"""
+from threading import Event
+from common import hardware
+
+
+class Cancelled(Exception):
+    """
+    Raised inside a task when its cancellation token has been cancelled
+    """
+    pass
+
+
+class CancellationToken:
+    """
+    A flag that can be shared between threads to ask running loops to stop. Loops call raise_if_cancelled() once per
+    iteration, and the caller calls cancel() from anywhere.
+    """
+
+    def __init__(self):
+        self._event = Event()
+
+    def cancel(self):
+        """
+        Asks every loop checking this token to stop
+        """
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        """
+        Raises Cancelled if the token has been cancelled
+        """
+        if self._event.is_set():
+            raise Cancelled()
+
+    def wait(self, timeout=None):
+        """
+        Waits until the token is cancelled. Returns False if the timeout expired first.
+        """
+        return hardware.wait_event(self._event, timeout)
@@ -0,0 +1,201 @@
+"""
+Provides a persistent property store with batched, atomic background writes
+"""
+import atexit
+import json
+import os
+from threading import Thread, Condition, Lock
+from time import sleep
+from typing import Any, Callable, Optional
+
+# The longest time the background flusher waits before retrying a failed write
+MAX_RETRY_DELAY = 30.0
+
+
+def atomic_write_json(path, data):
+    """
+    Writes data as JSON to a temporary file and renames it over path, so a power loss leaves either the old or the new
+    file but never a partial one
+    """
+    temporary_path = path + ".tmp"
+    try:
+        with open(temporary_path, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+class PropertyStore:
+    """
+    Stores properties in a JSON file. set() only updates memory and wakes a background flusher, which waits flush_delay
+    seconds so that several writes are coalesced into one atomic file write. Call flush() to write immediately.
+    """
+
+    def __init__(self, path, flush_delay=0.5):
+        """
+        :param path: The path of the JSON file.
+
+        :param flush_delay: How many seconds to wait after a change before writing, so that changes made close
+            together are written once.
+        """
+        self.path = path
+        self.flush_delay = flush_delay
+        self._data = None
+        self._dirty = False
+        self._condition = Condition()
+        self._write_lock = Lock()
+        self._flusher = None
+        self.writes = 0
+
+    @property
+    def data(self):
+        """
+        The dictionary of every property, loaded from disk the first time it is needed
+        """
+        with self._condition:
+            if self._data is None:
+                self._data = self._read()
+            return self._data
+
+    def _read(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                try:
+                    return json.load(f)
+                except Exception:
+                    print("Error reading properties, assuming none...")
+        return {}
+
+    def get(self, name, default=None, type: Optional[Callable[[Any], Any]] = None):
+        """
+        Returns a property, or default if it is missing
+
+        :param name: The name of the property.
+
+        :param default: The value returned if the property is missing or cannot be converted.
+
+        :param type: An optional type, such as int or float, the value is converted to.
+        """
+        value = self.data.get(name, default)
+        if type is None or value is None or value is default:
+            return value
+        try:
+            return type(value)
+        except (TypeError, ValueError):
+            print(f"Property {name} is not a valid {getattr(type, '__name__', type)}, using {default}")
+            return default
+
+    def set(self, name, value):
+        """
+        Changes a property and schedules it to be written in the background. Raises TypeError if the value cannot be
+        saved as JSON.
+        """
+        # Checked here so the caller gets the error instead of the background flusher
+        json.dumps(value)
+        data = self.data
+        with self._condition:
+            data[name] = value
+            self._mark_dirty()
+
+    def delete(self, name):
+        """
+        Removes a property and schedules the change to be written in the background
+        """
+        data = self.data
+        with self._condition:
+            if name in data:
+                del data[name]
+                self._mark_dirty()
+
+    def _mark_dirty(self):
+        # Must be called while holding self._condition
+        self._dirty = True
+        if self._flusher is None:
+            self._flusher = Thread(target=self._flush_in_background, daemon=True)
+            self._flusher.start()
+            atexit.register(self.flush)
+        self._condition.notify()
+
+    def namespace(self, prefix):
+        """
+        Returns a view of the properties whose names start with prefix and a dot
+        """
+        return PropertyNamespace(self, prefix)
+
+    def flush(self):
+        """
+        Writes any pending changes immediately. Returns False if the write failed, in which case the changes stay
+        pending.
+        """
+        with self._write_lock:
+            with self._condition:
+                if not self._dirty:
+                    return True
+                snapshot = dict(self._data)
+                self._dirty = False
+            if self._write(snapshot):
+                return True
+            with self._condition:
+                self._dirty = True
+            return False
+
+    def _write(self, snapshot):
+        try:
+            atomic_write_json(self.path, snapshot)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Error writing properties: {e}")
+            return False
+        self.writes += 1
+        return True
+
+    def _flush_in_background(self):
+        delay = self.flush_delay
+        while True:
+            with self._condition:
+                while not self._dirty:
+                    self._condition.wait()
+            # Let more changes arrive so they are written together, and back off while writes keep failing
+            sleep(delay)
+            try:
+                written = self.flush()
+            except Exception as e:
+                print(f"Error writing properties: {e}")
+                written = False
+            delay = self.flush_delay if written else min(delay * 2, MAX_RETRY_DELAY)
+
+
+class PropertyNamespace:
+    """
+    A group of properties stored under a common prefix, such as "calibration.gyro_offset"
+    """
+
+    def __init__(self, store, prefix):
+        self.store = store
+        self.prefix = prefix
+
+    def _key(self, name):
+        return f"{self.prefix}.{name}"
+
+    def get(self, name, default=None, type: Optional[Callable[[Any], Any]] = None):
+        return self.store.get(self._key(name), default, type)
+
+    def set(self, name, value):
+        self.store.set(self._key(name), value)
+
+    def delete(self, name):
+        self.store.delete(self._key(name))
+
+    def namespace(self, prefix):
+        return PropertyNamespace(self.store, self._key(prefix))
+
+    def items(self):
+        """
+        Returns the (name, value) pairs in this namespace, without the prefix
+        """
+        start = self.prefix + "."
+        return [(key[len(start):], value) for key, value in list(self.store.data.items()) if key.startswith(start)]
@@ -1,10 +1,15 @@
 """
 Provides the ROBOT constant to be used to identify the robot in use
+
+ROBOT and the persistent properties are read from the RobotID project the first time they are used, so importing this
+module does not touch the disk.
 """
-import json
-import os.path
 from enum import Enum
-from typing import Union, Tuple
+from typing import Union, Tuple, Optional, Callable, Any
+from common.core.properties import PropertyStore
+
+WHOAMI_PATH = "/home/root/Documents/KISS/DRS/RobotID/bin/whoami.txt"
+PROPS_PATH = "/home/root/Documents/KISS/DRS/RobotID/bin/props.json"
 
 
 class Robot(Enum):
@@ -56,14 +61,21 @@ class Robot(Enum):
         return self is Robot.YELLOW
 
     @staticmethod
-    def load(property_name):
-        return props.get(property_name)
+    def load(property_name, default=None, type: Optional[Callable[[Any], Any]] = None):
+        return property_store.get(property_name, default, type)
 
     @staticmethod
     def store(property_name, value):
-        props[property_name] = value
-        with open("/home/root/Documents/KISS/DRS/RobotID/bin/props.json", "w+") as f:
-            json.dump(props, f)
+        # Written in the background, call Robot.flush() to write immediately
+        property_store.set(property_name, value)
+
+    @staticmethod
+    def flush():
+        property_store.flush()
+
+    @staticmethod
+    def properties(namespace):
+        return property_store.namespace(namespace)
 
 
 def _get_robot_id_from_file(path):
@@ -76,15 +88,16 @@ def _get_robot_id_from_file(path):
         raise ValueError('A valid robot was not found in the RobotID project whoami.txt')
 
 
-ROBOT = _get_robot_id_from_file("/home/root/Documents/KISS/DRS/RobotID/bin/whoami.txt")
+# Persistent robot properties, loaded on first use
+property_store = PropertyStore(PROPS_PATH)
+
 
-# Persistent robot properties
-if os.path.exists("/home/root/Documents/KISS/DRS/RobotID/bin/props.json"):
-    with open("/home/root/Documents/KISS/DRS/RobotID/bin/props.json", 'r') as f:
-        try:
-            props = json.load(f)
-        except Exception:
-            print("Error reading properties, assuming none...")
-            props = {}
-else:
-    props = {}
+def __getattr__(name):
+    # Loads ROBOT and props the first time they are accessed, then caches them as ordinary module attributes
+    global ROBOT
+    if name == "ROBOT":
+        ROBOT = _get_robot_id_from_file(WHOAMI_PATH)
+        return ROBOT
+    if name == "props":
+        return property_store.data
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
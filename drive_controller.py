@@ -0,0 +1,897 @@
+"""
+Provides the DriveController, which holds one drive configuration (the drive functions, the gyroscope calibration and
+the tuning coefficients) and runs gyro turns and straight drives with it. gyro_movements wraps a default controller.
+"""
+import os
+from math import copysign
+from typing import Optional, Callable, Tuple, NamedTuple
+from common.scheduler import LoopScheduler, DEFAULT_RATE_HZ
+from common.gyro_sampler import GyroSampler
+from common.cancellation import CancellationToken
+from common.sensors import SensorHub
+from common.inputs import inputs
+from common import telemetry
+from common import profiling
+from common import hardware
+from common.motion_profile import MotionProfile
+from common.gyro_calibration import RunningStatistics, BiasTracker
+from common.calibration_store import calibration_store as default_calibration_store, GYRO_OFFSET_MAX_AGE
+from common.stop_watcher import StopWatcher, until_ticks
+
+# The attributes that configure() may change
+SETTINGS = (
+    "drive", "stop", "get_motor_positions", "push_sensor", "error_multiplier", "momentum_multiplier",
+    "error_proportion", "error_integral_multiplier", "distance_adjustment", "loop_rate", "full_speed_velocity",
+    "straight_drive_distance_proportion",
+)
+
+# Where calibrate_straight_drive_distance() saves the straight drive distance proportion
+STRAIGHT_PATH = os.path.expanduser("~/straight.txt")
+
+_NOT_LOADED = object()
+
+
+class TurnResult(NamedTuple):
+    """
+        The outcome of a closed loop gyro turn. Angles are in degrees and time is in seconds.
+    """
+    target: float
+    turned: float
+    error: float
+    elapsed: float
+
+
+def msleep(milliseconds):
+    hardware.sleep(milliseconds/1000)
+
+
+class DriveController:
+    """
+    Runs gyro turns and straight drives for one drive configuration. Several controllers can exist side by side, for
+    example one for the create base and one for a lego chassis, or a copy with different tuning for carrying a load.
+
+    Tuning values are attributes, but change them through configure() so that the constants derived from them are
+    recomputed.
+
+    Usage:
+        controller = DriveController()
+        controller.init(drive, stop, get_motor_positions, push_sensor)
+        loaded = controller.copy(error_proportion=0.2)
+        loaded.straight_drive_distance(80, 24)
+    """
+
+    __slots__ = (
+        "drive", "stop", "get_motor_positions", "push_sensor", "error_multiplier", "momentum_multiplier",
+        "error_proportion", "error_integral_multiplier", "distance_adjustment", "loop_rate", "full_speed_velocity",
+        "gyro_offset", "gyro_noise", "gyro_sampler", "bias_tracker", "sensor_hub", "calibration_store", "is_init",
+        "straight_path", "last_stop_latency_ms", "_straight_drive_distance_proportion", "_turn_scale",
+        "_velocity_per_speed",
+    )
+
+    def __init__(self, calibration_store=None, straight_path=STRAIGHT_PATH):
+        """
+        :param calibration_store: The CalibrationStore that gyro offsets and calibrations are loaded from and saved to.
+            Defaults to the store of this robot.
+
+        :param straight_path: The file the straight drive distance proportion is loaded from and saved to. Defaults to
+            ~/straight.txt.
+        """
+        self.drive: Optional[Callable[[int, int], None]] = None
+        self.stop: Optional[Callable[[], None]] = None
+        self.get_motor_positions: Optional[Callable[[], Tuple[int, int]]] = None
+        self.push_sensor: Optional[Callable[[], bool]] = None
+        self.error_multiplier = 1.0
+        self.momentum_multiplier = 1.0
+        self.error_proportion = 1.0
+        self.error_integral_multiplier = 1.0
+        self.distance_adjustment = 0.0
+        self.loop_rate = DEFAULT_RATE_HZ
+        self.full_speed_velocity = 20.0
+        self.gyro_offset = 0.0
+        # The standard deviation of the gyroscope while still, measured when calibrating
+        self.gyro_noise = 1.0
+        self.gyro_sampler: Optional[GyroSampler] = None
+        self.bias_tracker: Optional[BiasTracker] = None
+        self.sensor_hub = SensorHub()
+        self.calibration_store = calibration_store if calibration_store is not None else default_calibration_store
+        self.is_init = False
+        self.straight_path = straight_path
+        self.last_stop_latency_ms = None
+        # straight_drive_distance_proportion is loaded lazily so that creating a controller does not touch the disk
+        self._straight_drive_distance_proportion = _NOT_LOADED
+        self._precompute()
+
+    def _precompute(self):
+        # Degrees turned per raw gyroscope unit second
+        self._turn_scale = self.error_multiplier / 8
+        # Inches per second per unit of motor speed
+        self._velocity_per_speed = self.full_speed_velocity / 100.0
+
+    def configure(self, **settings):
+        """
+        Changes settings, such as tuning coefficients or drive functions, and returns the controller. Accepts the names
+        in SETTINGS.
+        """
+        for name, value in settings.items():
+            if name not in SETTINGS:
+                raise TypeError(f"Unknown drive setting {name!r}")
+            setattr(self, name, value)
+        self._precompute()
+        return self
+
+    def copy(self, **settings):
+        """
+        Returns a new controller with the same drive functions, gyro calibration and tuning, with the given settings
+        changed by configure(). The copy shares the gyro sampler, calibration store and straight.txt path, and has its
+        own sensor hub and bias tracker.
+        """
+        other = DriveController(self.calibration_store, self.straight_path)
+        for name in SETTINGS:
+            if name != "straight_drive_distance_proportion":
+                setattr(other, name, getattr(self, name))
+        # Copied without the property so that an unloaded proportion stays unloaded
+        other._straight_drive_distance_proportion = self._straight_drive_distance_proportion
+        other.gyro_offset = self.gyro_offset
+        other.gyro_noise = self.gyro_noise
+        other.gyro_sampler = self.gyro_sampler
+        other.bias_tracker = BiasTracker(self.gyro_offset, self.gyro_noise) if self.bias_tracker else None
+        other.is_init = self.is_init
+        other.sensor_hub.gyro_function = other.gyroscope
+        other.sensor_hub.motor_positions_function = other.get_motor_positions
+        return other.configure(**settings)
+
+    @property
+    def straight_drive_distance_proportion(self):
+        """
+        The number of motor ticks (left plus right) per inch, loaded from disk the first time it is needed
+        """
+        if self._straight_drive_distance_proportion is _NOT_LOADED:
+            self._straight_drive_distance_proportion = self._load_straight_drive_distance_proportion()
+        return self._straight_drive_distance_proportion
+
+    @straight_drive_distance_proportion.setter
+    def straight_drive_distance_proportion(self, proportion):
+        self._straight_drive_distance_proportion = proportion
+
+    def get_straight_drive_distance_proportion(self):
+        """
+            Returns the number of motor ticks (left plus right) per inch, loading it from disk the first time it is
+            needed
+        """
+        return self.straight_drive_distance_proportion
+
+    def _load_straight_drive_distance_proportion(self):
+        try:
+            # Reads the straight_drive_distance_proportion from straight.txt if straight.txt exists.
+            with open(self.straight_path, "r") as straight_file:
+                return float(straight_file.read())
+        except FileNotFoundError:
+            # Falls back to the calibration store, and prints a warning if neither has a value. If this happens, run
+            # calibrate_straight_drive_distance().
+            proportion = self.calibration_store.get("ticks_per_inch")
+            if proportion is None:
+                print("Warning, straight drive distance not calibrated")
+            return proportion
+
+    def wait_for_button(self, text="waiting for button"):
+        self.stop()
+        print(text)
+        self.settle(200)
+        while not inputs.is_pressed("push"):
+            self.settle(50, coast_ms=0)
+        msleep(1000)
+
+    def settle(self, milliseconds, coast_ms=150):
+        """
+            Waits while the robot is stopped. If gyro bias tracking is enabled, the gyroscope is sampled during the wait
+            to keep the gyro offset up to date once it shows that the robot has stopped coasting. If telemetry is
+            enabled, the samples are recorded so that coasting shows up in the trace.
+
+
+            :param milliseconds: The number of milliseconds to wait.
+
+            :param coast_ms: Samples taken during the first coast_ms milliseconds are never used for bias tracking.
+                Defaults to 150.
+        """
+        bias_tracker = self.bias_tracker
+        if not bias_tracker and telemetry.recorder is None:
+            msleep(milliseconds)
+            return
+        start = previous = hardware.monotonic()
+        end = start + milliseconds / 1000
+        while hardware.monotonic() < end:
+            raw_gyro = hardware.gyro_z()
+            now = hardware.monotonic()
+            if bias_tracker and now - start >= coast_ms / 1000:
+                self._set_gyro_offset(bias_tracker.update(raw_gyro, now))
+            if telemetry.recorder is not None:
+                self._record(telemetry.SOURCE_SETTLE, now, now - previous, raw_gyro - self.gyro_offset, 0.0, 0, 0,
+                             0.0)
+                previous = now
+            msleep(min(10.0, max((end - hardware.monotonic()) * 1000, 0.0)))
+
+    def _record(self, source, now, period, gyro, heading, left_speed, right_speed, target, positions=None):
+        """
+            Records a telemetry sample, reading the motor positions if they were not already read this iteration
+        """
+        if positions is None:
+            positions = self.get_motor_positions() if self.get_motor_positions else (0, 0)
+        telemetry.recorder.record(now, period, source, 0, gyro, heading, left_speed, right_speed, positions[0],
+                                  positions[1], target)
+
+    def calibrate_gyro(self, min_samples=10, max_samples=50, tolerance=0.5, outlier_sigma=4.0):
+        """
+            Measures and saves the gyro offset value. Sampling stops early once the mean has converged, and samples that
+            are far from the mean (for example if the table is bumped) are rejected.
+
+
+            :param min_samples: The smallest number of samples to average. Defaults to 10.
+
+            :param max_samples: The largest number of samples to take. Defaults to 50.
+
+            :param tolerance: Sampling stops once the standard error of the mean is below this, in raw gyroscope units.
+                Defaults to 0.5.
+
+            :param outlier_sigma: Samples more than this many standard deviations from the mean are rejected. Defaults
+                to 4.
+        """
+        statistics = RunningStatistics(outlier_sigma, min_samples)
+        for x in range(max_samples):
+            statistics.add(hardware.gyro_z())
+            if statistics.converged(tolerance):
+                break
+            msleep(10)
+        self._set_gyro_offset(statistics.mean)
+        self.gyro_noise = statistics.standard_deviation
+        if self.bias_tracker:
+            self.bias_tracker.bias = self.gyro_offset
+        print(f"Gyro offset {self.gyro_offset:.2f} from {statistics.count} samples ({statistics.rejected} rejected)")
+
+    def warm_start_gyro(self, check_samples=10, tolerance=0.5, sigmas=3.0):
+        """
+            Loads the gyro offset from the calibration store if it is fresh and a quick check of the gyroscope agrees
+            with it. Returns True if the stored offset was used, and False if it is missing, stale or the store cannot
+            be read.
+
+
+            :param check_samples: The number of samples used to check the stored offset. Defaults to 10.
+
+            :param tolerance: How far, in raw gyroscope units, the quick check may always be from the stored offset.
+                Defaults to 0.5, the same as the tolerance of calibrate_gyro().
+
+            :param sigmas: The quick check may also be this many standard errors of its mean from the stored offset,
+                since a few noisy samples cannot measure the offset to within tolerance. Defaults to 3.
+        """
+        try:
+            stored = self.calibration_store.get("gyro_offset", GYRO_OFFSET_MAX_AGE)
+        except (OSError, ValueError) as e:
+            print(f"Could not read the stored gyro offset: {e}")
+            return False
+        if stored is None:
+            return False
+        statistics = RunningStatistics(min_samples=check_samples)
+        for x in range(check_samples):
+            statistics.add(hardware.gyro_z())
+            msleep(5)
+        if abs(statistics.mean - stored) > max(tolerance, sigmas * statistics.standard_error):
+            print(f"Stored gyro offset {stored:.2f} is stale, measured {statistics.mean:.2f}")
+            return False
+        self._set_gyro_offset(stored)
+        self.gyro_noise = statistics.standard_deviation
+        print(f"Gyro offset {self.gyro_offset:.2f} loaded from calibration store")
+        return True
+
+    def _store_calibration(self, name, value):
+        try:
+            self.calibration_store.set(name, value)
+        except (OSError, ValueError) as e:
+            print(f"Could not save {name} calibration: {e}")
+
+    def _set_gyro_offset(self, offset):
+        self.gyro_offset = offset
+        if self.gyro_sampler:
+            self.gyro_sampler.offset = offset
+
+    def start_gyro_sampler(self, rate_hz=1000):
+        """
+            Starts sampling the gyroscope in the background. Once it is running, gyro turns and straight drives read the
+            integrated heading from the sampler instead of integrating the gyroscope themselves.
+
+
+            :param rate_hz: The number of gyroscope samples taken per second. Defaults to 1000.
+        """
+        self.stop_gyro_sampler()
+        self.gyro_sampler = GyroSampler(rate_hz, offset=self.gyro_offset).start()
+
+    def stop_gyro_sampler(self):
+        """
+            Stops the background gyroscope sampler if it is running
+        """
+        if self.gyro_sampler:
+            self.gyro_sampler.stop()
+            self.gyro_sampler = None
+
+    def gyroscope(self):
+        """
+            Returns the adjusted gyro value
+        """
+        sampler = self.gyro_sampler
+        if sampler:
+            return sampler.rate()
+        return hardware.gyro_z() - self.gyro_offset
+
+    def check_init(self):
+        """
+            Prints "GYRO NOT INITIALIZED!" and exits the program if the gyro has not been initialized.
+            init() must be run to avoid this error.
+        """
+        if not self.is_init:
+            print("GYRO NOT INITIALIZED!")
+            exit(0)
+
+    def init(self, drive_function, stop_function, get_motor_positions_function, push_sensor_function,
+             gyro_turn_error_adjustment=1.0, gyro_turn_momentum_adjustment=0.0,
+             straight_drive_error_adjustment=0.13, straight_drive_integral_adjustment=0.3,
+             straight_drive_distance_momentum_adjustment=0.0, control_loop_rate=DEFAULT_RATE_HZ,
+             gyro_sample_rate=None, full_speed_inches_per_second=20.0, track_gyro_bias=True, warm_start=True,
+             use_stored_coefficients=False):
+        """
+            Calibrates the gyroscope and sets the values of various constants that are used for gyro turns and straight
+            drives.
+            This method must have been called before any gyro turns or straight drives are performed.
+
+
+            :param drive_function: A function that drives the robot. It takes the left motor speed and right motor speed
+                as parameters.
+
+            :param stop_function: A function that stops the robot. It takes no parameters.
+
+            :param get_motor_positions_function: A function that returns a tuple of the left and right motor position.
+                It takes no parameters.
+
+            :param push_sensor_function: A function that returns true if the push sensor of the robot is being pressed.
+                It takes no parameters.
+
+            :param gyro_turn_error_adjustment: Used in gyro turns to inversely scale the angle that the robot is trying
+                to turn to account for regular error in the gyroscope. To calibrate, have the robot execute slow gyro
+                turns. If the robot turns too far, increase the value, and if the robot does not turn enough, decrease
+                the value.
+
+            :param gyro_turn_momentum_adjustment: Used in gyro turns to reduce the angle that the robot is trying to
+                turn in order to account for momentum. The effect of this value scales with speed, so it has almost no
+                effect on slower turns. To calibrate, make sure the gyro_turn_error_adjustment parameter is calibrated
+                and then have the robot turn at high speeds. If the robot overturns at high speeds, increase the value,
+                and if the robot doesn't turn enough at high speeds, decrease the value. If this value is significantly
+                changed, check that the turns are still accurate at lower speeds. If they are not accurate at lower
+                speeds, recalibrate the gyro_turn_error_adjustment.
+
+            :param straight_drive_error_adjustment: Used in straight drives to adjust the amount that the robot corrects
+                its motor speeds based on the current gyroscope value. To calibrate, set the
+                straight_drive_integral_multiplier to zero and set it to the lowest point at which increasing it makes
+                no noteworthy difference. Setting it too high will make the drives shaky. The robot will arc while
+                calibrating this, but that will be fixed when the straight_drive_integral_multiplier is changed back
+                from zero to its previous value.
+
+            :param straight_drive_integral_adjustment: Used in straight drives to adjust how much the robot corrects its
+                motor speeds based on the amount that it has turned throughout the drive so far. Increase this value
+                if the robot is not driving adequately straight, but setting it too high will cause the drive to become
+                shaky.
+
+            :param straight_drive_distance_momentum_adjustment: Used for distance straight drives to reduce the distance
+                that the robot tries to drive based on how fast it's moving. If the robot is driving the correct
+                distances at low speeds and driving too far at high speeds, increase this value to fix the problem.
+                Setting this value too high will cause the robot to undershoot its drive distances at high speeds.
+
+            :param control_loop_rate: The number of times per second that gyro turns and straight drives update.
+                Defaults to 200.
+
+            :param gyro_sample_rate: If set, starts a background gyroscope sampler at this many samples per second after
+                calibrating. Gyro turns and straight drives will then use its trapezoidal heading integration. Defaults
+                to None, which reads the gyroscope directly inside the movement loops.
+
+            :param full_speed_inches_per_second: How fast the robot drives at speed 100. Used to convert motion profiles
+                into motor speeds. calibrate_straight_drive_distance() prints a measured value.
+
+            :param track_gyro_bias: Keeps re-estimating the gyro offset whenever the robot is stopped and settling, so
+                long runs drift less. Defaults to True.
+
+            :param warm_start: Uses the gyro offset saved for this robot in the calibration store if it is recent and
+                agrees with a quick measurement, instead of recalibrating. Defaults to True.
+
+            :param use_stored_coefficients: Replaces the five tuning adjustments above with any values saved for this
+                robot in the calibration store. Defaults to False.
+        """
+        print("Calibrating gyroscope. DO NOT MOVE ROBOT!")
+        msleep(100)
+        if not (warm_start and self.warm_start_gyro()):
+            self.calibrate_gyro()
+            self._store_calibration("gyro_offset", self.gyro_offset)
+        print("Done calibrating gyro")
+        if use_stored_coefficients:
+            try:
+                stored = self.calibration_store.coefficients()
+            except (OSError, ValueError) as e:
+                print(f"Could not read the stored coefficients: {e}")
+                stored = {}
+            gyro_turn_error_adjustment = stored.get("gyro_turn_error_adjustment", gyro_turn_error_adjustment)
+            gyro_turn_momentum_adjustment = stored.get("gyro_turn_momentum_adjustment", gyro_turn_momentum_adjustment)
+            straight_drive_error_adjustment = stored.get("straight_drive_error_adjustment",
+                                                         straight_drive_error_adjustment)
+            straight_drive_integral_adjustment = stored.get("straight_drive_integral_adjustment",
+                                                            straight_drive_integral_adjustment)
+            straight_drive_distance_momentum_adjustment = stored.get("straight_drive_distance_momentum_adjustment",
+                                                                     straight_drive_distance_momentum_adjustment)
+        self.bias_tracker = BiasTracker(self.gyro_offset, self.gyro_noise) if track_gyro_bias else None
+        self.configure(
+            drive=drive_function,
+            stop=stop_function,
+            get_motor_positions=get_motor_positions_function,
+            push_sensor=push_sensor_function,
+            error_multiplier=gyro_turn_error_adjustment,
+            momentum_multiplier=gyro_turn_momentum_adjustment,
+            error_proportion=straight_drive_error_adjustment,
+            error_integral_multiplier=straight_drive_integral_adjustment,
+            distance_adjustment=straight_drive_distance_momentum_adjustment,
+            loop_rate=control_loop_rate,
+            full_speed_velocity=full_speed_inches_per_second,
+        )
+        self.is_init = True
+        self.sensor_hub.gyro_function = self.gyroscope
+        self.sensor_hub.motor_positions_function = self.get_motor_positions
+        if gyro_sample_rate:
+            self.start_gyro_sampler(gyro_sample_rate)
+        return self
+
+    def gyro_turn(self, left_speed, right_speed, angle, stop_when_finished=True,
+                  cancel_token: Optional[CancellationToken] = None, adjust_for_momentum=True):
+        """
+            Drives with the motor speed parameters until the robot has turned angle degrees
+
+
+            :param left_speed: Speed of the left motor. Accepts integers in the range from -100 to 100,
+            inclusive.
+
+            :param right_speed: Speed of the right motor. Accepts integers in the range from -100 to 100,
+            inclusive.
+
+            :param angle: The amount of degrees to be turned. Accepts any integers or floats, but sign does not matter.
+
+            :param stop_when_finished: Determines if the robot should stop when it finishes turning. Defaults to True.
+
+            :param cancel_token: An optional CancellationToken. If it is cancelled, the robot stops and Cancelled is
+                raised.
+
+            :param adjust_for_momentum: Stops short by gyro_turn_momentum_adjustment to allow for coasting. Set it to
+                False if the robot keeps moving after the turn. Defaults to True.
+        """
+        self.check_init()
+        stop = self.stop
+        scheduler = LoopScheduler(self.loop_rate, "gyro_turn")
+        scheduler.start()
+        self.drive(left_speed, right_speed)
+        current_turned_angle = 0
+        fixed_angle = self._fixed_turn_angle(left_speed, right_speed, angle) if adjust_for_momentum else abs(angle)
+        profiler = profiling.profiler
+        tracker = _TurnTracker(self)
+        while abs(current_turned_angle) < fixed_angle:
+            period = scheduler.wait()
+            if profiler is not None:
+                mark = profiler.start()
+            current_turned_angle = tracker.update(period)
+            if profiler is not None:
+                profiler.lap("gyro_turn.gyroscope", mark)
+            if telemetry.recorder is not None:
+                self._record(telemetry.SOURCE_GYRO_TURN, scheduler.last_tick, period, tracker.rate(),
+                             current_turned_angle, left_speed, right_speed, angle)
+            if cancel_token and cancel_token.cancelled:
+                stop()
+                cancel_token.raise_if_cancelled()
+            if scheduler.elapsed() > 10:
+                stop()
+                raise Exception(f"Gyro Turn Timer Expired after {scheduler.iterations} iterations "
+                                f"({scheduler.overruns} overruns).")
+        if stop_when_finished:
+            stop()
+            self.settle(500)
+
+    def closed_loop_turn(self, left_speed, right_speed, angle, tolerance=1.0, slowdown_angle=45.0, min_speed=15,
+                         stop_when_finished=True, cancel_token: Optional[CancellationToken] = None):
+        """
+            Turns angle degrees like gyro_turn, but scales the motor speeds down as the remaining angle shrinks and
+            stops once the robot is within tolerance of the target. It does not rely on gyro_turn_momentum_adjustment or
+            a fixed settle delay, so fast turns stay accurate without per-speed tuning.
+
+
+            :param left_speed: Speed of the left motor at the start of the turn. Accepts integers in the range from -100
+                to 100, inclusive.
+
+            :param right_speed: Speed of the right motor at the start of the turn. Accepts integers in the range from
+                -100 to 100, inclusive.
+
+            :param angle: The amount of degrees to be turned. Accepts any integers or floats, but sign does not matter.
+
+            :param tolerance: How many degrees short of the target the robot may stop. Defaults to 1.
+
+            :param slowdown_angle: The number of degrees before the target at which the robot starts slowing down.
+                Defaults to 45.
+
+            :param min_speed: The speed of the faster motor is never reduced below this, so the robot does not stall.
+                Defaults to 15.
+
+            :param stop_when_finished: Determines if the robot should stop when it finishes turning. Defaults to True.
+                If True, the final angle is measured once the robot has stopped rotating.
+
+            :param cancel_token: An optional CancellationToken. If it is cancelled, the robot stops and Cancelled is
+                raised.
+
+            :return: A TurnResult with the target angle, the angle turned, the final error and the elapsed time.
+        """
+        self.check_init()
+        drive, stop = self.drive, self.stop
+        target = abs(angle)
+        fastest = max(abs(left_speed), abs(right_speed))
+        min_scale = min(min_speed / fastest, 1.0) if fastest else 1.0
+        scheduler = LoopScheduler(self.loop_rate, "closed_loop_turn")
+        scheduler.start()
+        tracker = _TurnTracker(self)
+        drive(left_speed, right_speed)
+        remaining = target
+        profiler = profiling.profiler
+        while remaining > tolerance:
+            period = scheduler.wait()
+            if profiler is not None:
+                mark = profiler.start()
+            remaining = target - abs(tracker.update(period))
+            if profiler is not None:
+                mark = profiler.lap("closed_loop_turn.gyroscope", mark)
+            scale = max(min(remaining / slowdown_angle, 1.0), min_scale) if slowdown_angle > 0 else 1.0
+            left_command, right_command = int(round(left_speed * scale)), int(round(right_speed * scale))
+            drive(left_command, right_command)
+            if profiler is not None:
+                profiler.lap("closed_loop_turn.drive", mark)
+            if telemetry.recorder is not None:
+                self._record(telemetry.SOURCE_GYRO_TURN, scheduler.last_tick, period, tracker.rate(), tracker.angle,
+                             left_command, right_command, angle)
+            if cancel_token and cancel_token.cancelled:
+                stop()
+                cancel_token.raise_if_cancelled()
+            if scheduler.elapsed() > 10:
+                stop()
+                raise Exception(f"Closed Loop Turn Timer Expired with {remaining:.1f} degrees remaining.")
+        if stop_when_finished:
+            stop()
+            # Keep integrating until the robot stops rotating so the result includes any coasting
+            settle_deadline = scheduler.elapsed() + 0.25
+            while scheduler.elapsed() < settle_deadline:
+                tracker.update(scheduler.wait())
+                if abs(self.gyroscope()) < 8:
+                    break
+        turned = abs(tracker.angle)
+        return TurnResult(target, turned, turned - target, scheduler.elapsed())
+
+    def _fixed_turn_angle(self, left_speed, right_speed, angle):
+        return abs(angle) - abs(right_speed - left_speed) * self.momentum_multiplier
+
+    def gyro_turn_test(self, left_speed, right_speed, angle=90, iterations=1):
+        """
+            Executes a given number of gyro turns with set motor speeds and angles. There is a one-second pause between
+            each turn.
+
+
+            :param left_speed: Speed of the left motor. Accepts integers in the range 0-100, inclusive.
+
+            :param right_speed: Speed of the right motor. Accepts integers in the range 0-100, inclusive.
+
+            :param angle: The amount of degrees to be turned. Accepts any integers or floats, but sign does not matter.
+
+            :param iterations: The number of gyro turns to be performed.
+        """
+        for x in range(iterations):
+            self.gyro_turn(left_speed, right_speed, angle)
+            msleep(1000)
+
+    def straight_drive(self, speed, condition, stop_when_finished=True, condition_is=True,
+                       cancel_token: Optional[CancellationToken] = None,
+                       speed_profile: Optional[Callable[[float], float]] = None, watch_rate=None):
+        """
+        Drives straight at a given speed while an input condition is True.
+
+
+        :param speed: The speed at which the robot should be driving. Accepts integers in the range from -100 to 100,
+            inclusive.
+
+        :param condition: A function that returns a boolean value. The robot will continue driving until the function
+            returns false. The sensor hub is ticked right before each call, so the condition can read
+            sensor_hub.current instead of the hardware. Conditions that read the motor positions from it should
+            subscribe with sensor_hub.subscribe_motor_positions().
+
+        :param stop_when_finished: Determines if the robot should stop when it finishes driving. Defaults to True.
+
+        :param condition_is: Drive while the condition is `condition_is`
+
+        :param cancel_token: An optional CancellationToken. If it is cancelled, the robot stops and Cancelled is raised.
+
+        :param speed_profile: An optional function that is called every iteration with the seconds since the previous
+            iteration and returns the speed to drive at. Replaces the constant speed when set.
+
+        :param watch_rate: If set, the condition is checked this many times per second on a StopWatcher thread instead
+            of once per iteration, and the motors are stopped the moment it changes, even if stop_when_finished is
+            False. The condition should then read the hardware directly, since the sensor hub only updates once per
+            iteration. If stop_when_finished is True, the time from the condition changing to the wheels standing
+            still is measured in the background and saved in last_stop_latency_ms once the wheels have stopped.
+        """
+        self.check_init()
+        speed = _check_speed(speed)
+        # Looked up once, since the loop below runs hundreds of times per second
+        drive, stop, tick = self.drive, self.stop, self.sensor_hub.tick
+        error_proportion, error_integral_multiplier = self.error_proportion, self.error_integral_multiplier
+        sampler = self.gyro_sampler
+        # The stop is only measured if the motors stay stopped, since the next movement would otherwise move them
+        watcher = (StopWatcher(condition, stop, watch_rate, condition_is,
+                               self.get_motor_positions if stop_when_finished else None, self._report_stop).start()
+                   if watch_rate else None)
+        scheduler = LoopScheduler(self.loop_rate, "straight_drive")
+        scheduler.start()
+        marginal_time = 0.0
+        heading_total = 0.0
+        start_heading = sampler.heading() if sampler else 0.0
+        profiler = profiling.profiler
+        while True:
+            if profiler is not None:
+                mark = profiler.start()
+            snapshot = tick()
+            if profiler is not None:
+                mark = profiler.lap("straight_drive.sensors", mark)
+            if watcher is not None:
+                if watcher.triggered.is_set():
+                    break
+            elif condition() != condition_is:
+                break
+            if profiler is not None:
+                mark = profiler.lap("straight_drive.condition", mark)
+            if cancel_token and cancel_token.cancelled:
+                if watcher is not None:
+                    watcher.stop()
+                stop()
+                cancel_token.raise_if_cancelled()
+
+            # Calculate adjustment values
+            if speed_profile:
+                speed = speed_profile(marginal_time)
+            current_gyro = snapshot.gyroscope()
+            gyro_error_adjustment = error_proportion * current_gyro
+            if sampler:
+                heading_total = sampler.heading() - start_heading
+            else:
+                heading_total += current_gyro * marginal_time
+            integral_error_adjustment = error_integral_multiplier * heading_total
+
+            # Drive
+            left_speed, right_speed = _straight_drive_speeds(speed, gyro_error_adjustment + integral_error_adjustment)
+            if profiler is not None:
+                mark = profiler.lap("straight_drive.speed_math", mark)
+            if watcher is None:
+                drive(left_speed, right_speed)
+            elif not watcher.guard(drive, left_speed, right_speed):
+                break
+            if profiler is not None:
+                profiler.lap("straight_drive.drive", mark)
+            if telemetry.recorder is not None:
+                self._record(telemetry.SOURCE_STRAIGHT_DRIVE, scheduler.last_tick, marginal_time, current_gyro,
+                             self._turn_scale * heading_total, left_speed, right_speed, speed,
+                             snapshot.motor_positions)
+            marginal_time = scheduler.wait()
+        if watcher is not None:
+            watcher.stop()
+        if stop_when_finished:
+            stop()
+            self.settle(500)
+
+    def _report_stop(self, watcher):
+        # Called on the StopWatcher thread once the wheels have stopped
+        self.last_stop_latency_ms = watcher.latency_ms
+        print(f"Wheels stopped at most {self.last_stop_latency_ms:.1f} ms after the stop condition changed, "
+              f"{watcher.overrun_ticks} ticks after it was detected")
+
+    def calibrate_straight_drive_distance(self, robot_length_inches, direction=1, speed=80, total_inches=94):
+        """
+            Straight drives and records the number of motor ticks that have passed until the push sensor is pressed.
+
+
+            :param robot_length_inches: The distance from the end of the push sensor (while it is being pressed) to the
+                opposite end of the robot.
+
+            :param direction: The direction for the robot to drive. Set to 1 to calibrate lego and -1 to calibrate
+                create. Defaults to 1.
+
+            :param speed: The speed at which the robot should drive during calibration.
+
+            :param total_inches: The distance in inches being used to calibrate the drive distance. Defaults to the 94,
+                the full length of the game board.
+        """
+        start_position = sum(self.get_motor_positions())
+        push_sensor = self.push_sensor
+
+        def condition():
+            return not push_sensor()
+
+        start_time = hardware.monotonic()
+        self.straight_drive(int(copysign(speed, direction)), condition, stop_when_finished=False)
+        elapsed = hardware.monotonic() - start_time
+        self.stop()
+        print(f"Measured {(total_inches - robot_length_inches) / elapsed * 100 / speed:.1f} inches per second at "
+              f"full speed (including acceleration).")
+        msleep(500)
+        with open(self.straight_path, "w+") as file:
+            file.write(
+                str(abs((sum(self.get_motor_positions()) - start_position)
+                        / (total_inches - robot_length_inches))))
+        msleep(500)
+        with open(self.straight_path) as file:
+            proportion = file.read()
+        print(f"Straight drive distance calibrated. {proportion} ticks per inch.")
+        self.straight_drive_distance_proportion = float(proportion)
+        self._store_calibration("ticks_per_inch", self.straight_drive_distance_proportion)
+        self.wait_for_button("Press button to drive halfway back")
+        self.straight_drive_distance(-1 * copysign(speed, direction), (total_inches - robot_length_inches) / 2)
+        self.wait_for_button()
+        self.gyro_turn(-80, 80, 180)
+
+    def straight_drive_distance(self, speed, inches, stop_when_finished=True,
+                                cancel_token: Optional[CancellationToken] = None, max_acceleration=None, max_jerk=None,
+                                start_speed=0, end_speed=0, watch_rate=None, adjust_for_momentum=True):
+        """
+            Drives straight at a given speed for a given distance.
+
+            If max_acceleration is set, the drive follows a motion profile instead: it accelerates to speed, cruises,
+            and decelerates onto the target using the encoders, so no momentum adjustment or settle pause is needed.
+
+
+            :param speed: The speed at which the robot should be driving. Accepts integers in the range from -100 to
+                100, inclusive.
+
+            :param inches: The number of inches for the robot to drive.
+
+            :param stop_when_finished: Determines if the robot should stop when it finishes driving. Defaults to True.
+
+            :param cancel_token: An optional CancellationToken. If it is cancelled, the robot stops and Cancelled is
+                raised.
+
+            :param max_acceleration: The largest acceleration and deceleration in inches per second squared. Defaults
+                to None, which drives at a constant speed.
+
+            :param max_jerk: The largest change in acceleration in inches per second cubed. Only used with
+                max_acceleration. Defaults to None, which gives a trapezoidal profile instead of an S-curve.
+
+            :param start_speed: The speed the robot is already moving at. Only used with max_acceleration. Defaults to
+                0.
+
+            :param end_speed: The speed the profile should finish at, so the next movement can continue without
+                stopping. Only used with max_acceleration. Defaults to 0.
+
+            :param watch_rate: If set, the encoders are checked this many times per second on a StopWatcher thread,
+                which stops the motors as soon as the distance is reached. Not used with max_acceleration, where the
+                profile already slows down onto the target.
+
+            :param adjust_for_momentum: Stops short by straight_drive_distance_momentum_adjustment to allow for
+                coasting. Set it to False if the robot keeps moving after the drive. Not used with max_acceleration.
+                Defaults to True.
+        """
+        if max_acceleration is None and watch_rate:
+            condition = self._distance_condition(speed, inches, adjust_for_momentum, read_directly=True)
+            self.straight_drive(speed, condition, stop_when_finished, cancel_token=cancel_token, watch_rate=watch_rate)
+            return
+
+        # The condition and the profile read the motor positions from the sensor hub
+        self.sensor_hub.subscribe_motor_positions()
+        try:
+            if max_acceleration is None:
+                condition = self._distance_condition(speed, inches, adjust_for_momentum)
+                self.straight_drive(speed, condition, stop_when_finished, cancel_token=cancel_token)
+                return
+            condition = self._distance_condition(speed, inches, adjust_for_momentum=False)
+            self.straight_drive(speed, condition, False, cancel_token=cancel_token,
+                                speed_profile=self._profile_speed(speed, inches, max_acceleration, max_jerk,
+                                                                  start_speed, end_speed))
+        finally:
+            self.sensor_hub.unsubscribe_motor_positions()
+        if stop_when_finished:
+            self.stop()
+
+    def _profile_speed(self, speed, inches, max_acceleration, max_jerk=None, start_speed=0.0, end_speed=0.0):
+        """
+            Returns a speed_profile function for straight_drive that follows a motion profile over the given distance
+        """
+        start_position = sum(self.get_motor_positions())
+        ticks_per_inch = self.straight_drive_distance_proportion
+        velocity_per_speed = self._velocity_per_speed
+        profile = MotionProfile(
+            abs(inches),
+            abs(speed) * velocity_per_speed,
+            max_acceleration,
+            max_jerk,
+            start_velocity=abs(start_speed) * velocity_per_speed,
+            end_velocity=abs(end_speed) * velocity_per_speed,
+            min_velocity=15 * velocity_per_speed,
+        )
+        sensor_hub = self.sensor_hub
+
+        def speed_profile(dt):
+            left, right = sensor_hub.current.positions()
+            remaining = abs(inches) - abs(left + right - start_position) / ticks_per_inch
+            return copysign(profile.update(remaining, dt) / velocity_per_speed, speed)
+
+        return speed_profile
+
+    def _distance_condition(self, speed, inches, adjust_for_momentum=True, read_directly=False):
+        """
+            Returns a condition that is True until the robot has driven the given number of inches from where it is
+            now. The condition reads the motor positions from the current sensor hub snapshot, which should be
+            subscribed to them, or from the motors if read_directly is set.
+        """
+        start_position = sum(self.get_motor_positions())
+        momentum = abs(self.distance_adjustment * (speed / 100.0)) if adjust_for_momentum else 0.0
+        target_ticks = (abs(inches) - momentum) * self.straight_drive_distance_proportion
+        if read_directly:
+            return until_ticks(self.get_motor_positions, target_ticks, start_position)
+        sensor_hub = self.sensor_hub
+
+        def condition():
+            left, right = sensor_hub.current.positions()
+            return abs(left + right - start_position) < target_ticks
+
+        return condition
+
+
+class _TurnTracker:
+    """
+        Tracks how many degrees the robot has turned, using the gyro sampler when it is running
+    """
+    __slots__ = ("sampler", "gyroscope", "scale", "start_heading", "angle", "_rate")
+
+    def __init__(self, controller: DriveController):
+        self.sampler = controller.gyro_sampler
+        self.gyroscope = controller.gyroscope
+        self.scale = controller._turn_scale
+        self.start_heading = self.sampler.heading() if self.sampler else 0.0
+        self.angle = 0.0
+        self._rate = 0.0
+
+    def update(self, dt):
+        if self.sampler:
+            self.angle = self.scale * (self.sampler.heading() - self.start_heading)
+        else:
+            self._rate = self.gyroscope()
+            self.angle += self.scale * self._rate * dt
+        return self.angle
+
+    def rate(self):
+        """
+            Returns the most recent gyroscope value
+        """
+        return self.sampler.rate() if self.sampler else self._rate
+
+
+def _check_speed(speed):
+    if abs(speed) < 15:
+        speed = 15 if speed > 0 else -15
+        print("Warning, speed is too slow, defaulting to 15.")
+    return speed
+
+
+def _straight_drive_speeds(speed, adjustment):
+    """
+        Returns the left and right motor speeds for a straight drive given the total gyro correction
+    """
+    left_speed = right_speed = speed
+    if abs(speed + adjustment) <= 100:
+        right_speed = speed + adjustment
+    else:
+        left_speed = speed - adjustment
+
+    # Make sure speeds are not too small
+    if abs(right_speed) < 5:
+        right_speed = speed
+    if abs(left_speed) < 5:
+        left_speed = speed
+    return int(round(left_speed, 0)), int(round(right_speed, 0))
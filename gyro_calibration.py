@@ -0,0 +1,113 @@
+"""
+Provides adaptive gyroscope bias estimation
+"""
+from math import sqrt
+
+# Readings are whole numbers, so a quiet gyroscope can report no spread at all
+MIN_GYRO_NOISE = 0.5
+
+
+class RunningStatistics:
+    """
+    Tracks the running mean and variance of samples with Welford's algorithm and rejects outliers, such as someone
+    bumping the table during calibration
+    """
+
+    def __init__(self, outlier_sigma=4.0, min_samples=10):
+        """
+        :param outlier_sigma: Samples more than this many standard deviations from the mean are rejected.
+
+        :param min_samples: Outliers are only rejected once this many samples have been accepted.
+        """
+        self.outlier_sigma = outlier_sigma
+        self.min_samples = min_samples
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.rejected = 0
+
+    @property
+    def variance(self):
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def standard_deviation(self):
+        return sqrt(self.variance)
+
+    @property
+    def standard_error(self):
+        """
+        The uncertainty of the mean
+        """
+        return self.standard_deviation / sqrt(self.count) if self.count > 1 else float("inf")
+
+    def add(self, sample):
+        """
+        Adds a sample and returns False if it was rejected as an outlier
+        """
+        if self.count >= self.min_samples:
+            spread = self.standard_deviation
+            if spread > 0 and abs(sample - self.mean) > self.outlier_sigma * spread:
+                self.rejected += 1
+                return False
+        self.count += 1
+        delta = sample - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (sample - self.mean)
+        return True
+
+    def converged(self, tolerance):
+        """
+        Returns True once enough samples have been accepted and the standard error of the mean is below tolerance
+        """
+        return self.count >= self.min_samples and self.standard_error <= tolerance
+
+
+class BiasTracker:
+    """
+    Keeps re-estimating the gyroscope bias from samples taken while the robot is stationary. A robot that has just
+    stopped may still be coasting, so samples are only used once every sample for still_time seconds has been within a
+    few noise standard deviations of the bias.
+    """
+
+    def __init__(self, bias, noise=1.0, smoothing=0.02, sigmas=4.0, still_time=0.3, max_gap=0.1):
+        """
+        :param bias: The starting bias.
+
+        :param noise: The standard deviation of the gyroscope while the robot is still, as measured by calibration.
+
+        :param smoothing: How much each sample moves the bias, from 0 to 1.
+
+        :param sigmas: Samples more than this many noise standard deviations from the bias mean the robot is moving.
+
+        :param still_time: How many seconds the gyroscope must stay near the bias before samples are used.
+
+        :param max_gap: If more than this many seconds pass between samples, the robot may have moved in between, so
+            the still time starts over.
+        """
+        self.bias = bias
+        self.smoothing = smoothing
+        self.max_deviation = sigmas * max(noise, MIN_GYRO_NOISE)
+        self.still_time = still_time
+        self.max_gap = max_gap
+        self.updates = 0
+        self._still_since = None
+        self._last_sample = None
+
+    def update(self, sample, now):
+        """
+        Moves the bias towards a sample taken at time now, in seconds, if the robot has been still long enough, and
+        returns the bias
+        """
+        if self._last_sample is None or now - self._last_sample > self.max_gap:
+            self._still_since = None
+        self._last_sample = now
+        if abs(sample - self.bias) > self.max_deviation:
+            self._still_since = None
+            return self.bias
+        if self._still_since is None:
+            self._still_since = now
+        if now - self._still_since >= self.still_time:
+            self.bias += self.smoothing * (sample - self.bias)
+            self.updates += 1
+        return self.bias
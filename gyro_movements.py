@@ -1,303 +1,169 @@
-import time
-import os
-from math import copysign
-from kipr import gyro_z, push_button
-from typing import Optional, Callable, Tuple
-from time import sleep
-
-error_multiplier = 1.0
-momentum_multiplier = 1.0
-gyro_offset = 0.0
-drive: Optional[Callable[[int, int], None]] = None
-stop: Optional[Callable[[], None]] = None
-is_init = False
-error_proportion = 1.0
-error_integral_multiplier = 1.0
-get_motor_positions: Optional[Callable[[], Tuple[int, int]]] = None
-push_sensor: Optional[Callable[[], bool]] = None
-distance_adjustment = 0.0
+"""
+Provides gyro turns and straight drives as module functions that run on a default DriveController. Use use() to switch
+every function to another controller, for example one tuned for carrying a load.
 
+The old module variables, such as gyro_movements.error_proportion or gyro_movements.sensor_hub, still read the default
+controller's values, and assigning to them changes the default controller through configure().
+"""
+import sys
+from types import ModuleType
+from typing import Optional, Callable
+from common.scheduler import DEFAULT_RATE_HZ
+from common.cancellation import CancellationToken
+from common.drive_controller import DriveController, TurnResult, SETTINGS, msleep  # noqa: F401
 
-def wait_for_button(text="waiting for button"):
-    stop()
-    print(text)
-    while not push_button():
-        msleep(50)
-    msleep(1000)
-
+controller = DriveController()
 
-def msleep(milliseconds):
-    sleep(milliseconds/1000)
+# Read from and written to the default controller by __getattr__ and _GyroMovementsModule below
+_CONTROLLER_ATTRIBUTES = SETTINGS + (
+    "gyro_offset", "gyro_sampler", "bias_tracker", "sensor_hub", "calibration_store", "is_init", "last_stop_latency_ms",
+)
 
 
-def calibrate_gyro():
+def use(new_controller: DriveController):
     """
-        Measures and saves the gyro offset value
+    Makes every function in this module run on new_controller and returns it
     """
-    total = 0
-    for x in range(50):
-        total = total + gyro_z()
-        msleep(10)
-    global gyro_offset
-    gyro_offset = total / 50
+    global controller
+    controller = new_controller
+    return new_controller
 
 
-def gyroscope():
-    """
-        Returns the adjusted gyro value
-    """
-    return gyro_z() - gyro_offset
-
+def drive(left_speed, right_speed):
+    controller.drive(left_speed, right_speed)
 
-def gyro_turn(left_speed, right_speed, angle, stop_when_finished=True):
-    """
-        Drives with the motor speed parameters until the robot has turned angle degrees
 
+def stop():
+    controller.stop()
 
-        :param left_speed: Speed of the left motor. Accepts integers in the range from -100 to 100,
-        inclusive.
 
-        :param right_speed: Speed of the right motor. Accepts integers in the range from -100 to 100,
-        inclusive.
+def wait_for_button(text="waiting for button"):
+    controller.wait_for_button(text)
 
-        :param angle: The amount of degrees to be turned. Accepts any integers or floats, but sign does not matter.
 
-        :param stop_when_finished: Determines if the robot should stop when it finishes turning. Defaults to True.
+def settle(milliseconds, coast_ms=150):
+    """
+        The same as DriveController.settle() on the default controller
     """
-    check_init()
-    start_time_ = old_time = time.time()
-    drive(left_speed, right_speed)
-    current_turned_angle = 0
-    fixed_angle = abs(angle) - abs(right_speed - left_speed) * momentum_multiplier
-    while abs(current_turned_angle) < fixed_angle:
-        current_turned_angle += error_multiplier * gyroscope() * (time.time() - old_time) / 8
-        old_time = time.time()
-        if old_time - start_time_ > 10:
-            stop()
-            raise Exception(f"Gyro Turn Timer Expired.\n{start_time_}\n{old_time}\n{time.time()}")
-        msleep(10)
-    if stop_when_finished:
-        stop()
-        msleep(500)
+    controller.settle(milliseconds, coast_ms)
 
 
-def check_init():
+def calibrate_gyro(min_samples=10, max_samples=50, tolerance=0.5, outlier_sigma=4.0):
     """
-        Prints "GYRO NOT INITIALIZED!" and exits the program if the gyro has not been initialized.
-        gyro_init() must be run to avoid this error.
+        The same as DriveController.calibrate_gyro() on the default controller
     """
-    if not is_init:
-        print("GYRO NOT INITIALIZED!")
-        exit(0)
+    controller.calibrate_gyro(min_samples, max_samples, tolerance, outlier_sigma)
 
 
-def gyro_init(drive_function, stop_function, get_motor_positions_function, push_sensor_function,
-              gyro_turn_error_adjustment=1.0, gyro_turn_momentum_adjustment=0.0,
-              straight_drive_error_adjustment=0.13, straight_drive_integral_adjustment=0.3,
-              straight_drive_distance_momentum_adjustment=0.0):
+def warm_start_gyro(check_samples=10, tolerance=0.5, sigmas=3.0):
     """
-        Calibrates the gyroscope and sets the values of various constants that are used for gyro turns and straight
-        drives.
-        This function must have been called before any gyro turns or straight drives are performed.
+        The same as DriveController.warm_start_gyro() on the default controller
+    """
+    return controller.warm_start_gyro(check_samples, tolerance, sigmas)
 
 
-        :param drive_function: A function that drives the robot. It takes the left motor speed and right motor speed as
-            parameters.
-
-        :param stop_function: A function that stops the robot. It takes no parameters.
-
-        :param get_motor_positions_function: A function that returns a tuple of the left and right motor position. It
-            takes no parameters.
-
-        :param push_sensor_function: A function that returns true if the push sensor of the robot is being pressed. It
-            takes no parameters.
-
-        :param gyro_turn_error_adjustment: Used in gyro turns to inversely scale the angle that the robot is trying to
-            turn to account for regular error in the gyroscope. To calibrate, have the robot execute slow gyro turns.
-            If the robot turns too far, increase the value, and if the robot does not turn enough, decrease the value.
-
-        :param gyro_turn_momentum_adjustment: Used in gyro turns to reduce the angle that the robot is trying to turn
-            in order to account for momentum. The effect of this value scales with speed, so it has almost no effect on
-            slower turns. To calibrate, make sure the gyro_turn_error_adjustment parameter is calibrated and then have
-            the robot turn at high speeds. If the robot overturns at high speeds, increase the value, and if the robot
-            doesn't turn enough at high speeds, decrease the value. If this value is significantly changed, check that
-            the turns are still accurate at lower speeds. If they are not accurate at lower speeds, recalibrate the
-            gyro_turn_error_adjustment.
-
-        :param straight_drive_error_adjustment: Used in straight drives to adjust the amount that the robot corrects
-            its motor speeds based on the current gyroscope value. To calibrate, set the
-            straight_drive_integral_multiplier to zero and set it to the lowest point at which increasing it makes no
-            noteworthy difference. Setting it too high will make the drives shaky. The robot will arc while calibrating
-            this, but that will be fixed when the straight_drive_integral_multiplier is changed back from zero to its
-            previous value.
-
-        :param straight_drive_integral_adjustment: Used in straight drives to adjust how much the robot corrects its
-            motor speeds based on the amount that it has turned throughout the drive so far. Increase this value
-            if the robot is not driving adequately straight, but setting it too high will cause the drive to become
-            shaky.
-
-        :param straight_drive_distance_momentum_adjustment: Used for distance straight drives to reduce the distance
-            that the robot tries to drive based on how fast it's moving. If the robot is driving the correct distances
-            at low speeds and driving too far at high speeds, increase this value to fix the problem. Setting this value
-            too high will cause the robot to undershoot its drive distances at high speeds.
-    """
-    global error_multiplier
-    global momentum_multiplier
-    global drive
-    global stop
-    global is_init
-    global error_proportion
-    global error_integral_multiplier
-    global get_motor_positions
-    global push_sensor
-    global distance_adjustment
-    print("Calibrating gyroscope. DO NOT MOVE ROBOT!")
-    msleep(500)
-    calibrate_gyro()
-    msleep(500)
-    print("Done calibrating gyro")
-    drive = drive_function
-    stop = stop_function
-    error_multiplier = gyro_turn_error_adjustment
-    momentum_multiplier = gyro_turn_momentum_adjustment
-    is_init = True
-    error_proportion = straight_drive_error_adjustment
-    error_integral_multiplier = straight_drive_integral_adjustment
-    get_motor_positions = get_motor_positions_function
-    push_sensor = push_sensor_function
-    distance_adjustment = straight_drive_distance_momentum_adjustment
+def start_gyro_sampler(rate_hz=1000):
+    """
+        The same as DriveController.start_gyro_sampler() on the default controller
+    """
+    controller.start_gyro_sampler(rate_hz)
 
 
-def gyro_turn_test(left_speed, right_speed, angle=90, iterations=1):
+def stop_gyro_sampler():
     """
-        Executes a given number of gyro turns with set motor speeds and angles. There is a one-second pause between each
-        turn.
-
+        The same as DriveController.stop_gyro_sampler() on the default controller
+    """
+    controller.stop_gyro_sampler()
 
-        :param left_speed: Speed of the left motor. Accepts integers in the range 0-100, inclusive.
 
-        :param right_speed: Speed of the right motor. Accepts integers in the range 0-100, inclusive.
+def gyroscope():
+    """
+        Returns the adjusted gyro value
+    """
+    return controller.gyroscope()
 
-        :param angle: The amount of degrees to be turned. Accepts any integers or floats, but sign does not matter.
 
-        :param iterations: The number of gyro turns to be performed.
+def gyro_turn(left_speed, right_speed, angle, stop_when_finished=True,
+              cancel_token: Optional[CancellationToken] = None, adjust_for_momentum=True):
+    """
+        The same as DriveController.gyro_turn() on the default controller
     """
-    for x in range(iterations):
-        gyro_turn(left_speed, right_speed, angle)
-        msleep(1000)
+    controller.gyro_turn(left_speed, right_speed, angle, stop_when_finished, cancel_token, adjust_for_momentum)
 
 
-def straight_drive(speed, condition, stop_when_finished=True, condition_is=True):
+def closed_loop_turn(left_speed, right_speed, angle, tolerance=1.0, slowdown_angle=45.0, min_speed=15,
+                     stop_when_finished=True, cancel_token: Optional[CancellationToken] = None) -> TurnResult:
     """
-    Drives straight at a given speed while an input condition is True.
-
+        The same as DriveController.closed_loop_turn() on the default controller
+    """
+    return controller.closed_loop_turn(left_speed, right_speed, angle, tolerance, slowdown_angle, min_speed,
+                                       stop_when_finished, cancel_token)
 
-    :param speed: The speed at which the robot should be driving. Accepts integers in the range from -100 to 100,
-        inclusive.
 
-    :param condition: A function that returns a boolean value. The robot will continue driving until the function
-        returns false.
+def check_init():
+    """
+        Prints "GYRO NOT INITIALIZED!" and exits the program if the gyro has not been initialized.
+        gyro_init() must be run to avoid this error.
+    """
+    controller.check_init()
 
-    :param stop_when_finished: Determines if the robot should stop when it finishes driving. Defaults to True.
 
-    :param condition_is: Drive while the condition is `condition_is`
+def gyro_init(drive_function, stop_function, get_motor_positions_function, push_sensor_function,
+              gyro_turn_error_adjustment=1.0, gyro_turn_momentum_adjustment=0.0,
+              straight_drive_error_adjustment=0.13, straight_drive_integral_adjustment=0.3,
+              straight_drive_distance_momentum_adjustment=0.0, control_loop_rate=DEFAULT_RATE_HZ,
+              gyro_sample_rate=None, full_speed_inches_per_second=20.0, track_gyro_bias=True, warm_start=True,
+              use_stored_coefficients=False):
+    """
+        Initializes the default controller, see DriveController.init().
+        This function must have been called before any gyro turns or straight drives are performed.
     """
-    check_init()
-    if abs(speed) < 15:
-        speed = 15 if speed > 0 else -15
-        print("Warning, speed is too slow, defaulting to 15.")
-    previous_time = time.time()
-    integral_error_adjustment = 0.0
-    while condition() == condition_is:
+    controller.init(drive_function, stop_function, get_motor_positions_function, push_sensor_function,
+                    gyro_turn_error_adjustment, gyro_turn_momentum_adjustment, straight_drive_error_adjustment,
+                    straight_drive_integral_adjustment, straight_drive_distance_momentum_adjustment, control_loop_rate,
+                    gyro_sample_rate, full_speed_inches_per_second, track_gyro_bias, warm_start,
+                    use_stored_coefficients)
 
-        # Calculate adjustment values
-        current_gyro = gyroscope()
-        current_time = time.time()
-        marginal_time = current_time - previous_time
-        previous_time = current_time
-        gyro_error_adjustment = error_proportion * current_gyro
-        integral_error_adjustment += error_integral_multiplier * current_gyro * marginal_time
 
-        # Calculate new speeds
-        left_speed = right_speed = speed
-        if abs(speed + gyro_error_adjustment + integral_error_adjustment) <= 100:
-            right_speed = speed + gyro_error_adjustment + integral_error_adjustment
-        else:
-            left_speed = speed - gyro_error_adjustment - integral_error_adjustment
+def gyro_turn_test(left_speed, right_speed, angle=90, iterations=1):
+    """
+        The same as DriveController.gyro_turn_test() on the default controller
+    """
+    controller.gyro_turn_test(left_speed, right_speed, angle, iterations)
 
-        # Make sure speeds are not too small
-        if abs(right_speed) < 5:
-            right_speed = speed
-        if abs(left_speed) < 5:
-            left_speed = speed
 
-        # Drive
-        drive(int(round(left_speed, 0)), int(round(right_speed, 0)))
-        msleep(10)
-    if stop_when_finished:
-        stop()
-        msleep(500)
+def straight_drive(speed, condition, stop_when_finished=True, condition_is=True,
+                   cancel_token: Optional[CancellationToken] = None,
+                   speed_profile: Optional[Callable[[float], float]] = None, watch_rate=None):
+    """
+        The same as DriveController.straight_drive() on the default controller
+    """
+    controller.straight_drive(speed, condition, stop_when_finished, condition_is, cancel_token, speed_profile,
+                              watch_rate)
 
 
 def calibrate_straight_drive_distance(robot_length_inches, direction=1, speed=80, total_inches=94):
     """
-        Straight drives and records the number of motor ticks that have passed until the push sensor is pressed.
-
-
-        :param robot_length_inches: The distance from the end of the push sensor (while it is being pressed) to the
-            opposite end of the robot.
-
-        :param direction: The direction for the robot to drive. Set to 1 to calibrate lego and -1 to calibrate create.
-            Defaults to 1.
-
-        :param speed: The speed at which the robot should drive during calibration.
-
-        :param total_inches: The distance in inches being used to calibrate the drive distance. Defaults to the 94, the
-            full length of the game board.
+        The same as DriveController.calibrate_straight_drive_distance() on the default controller
     """
-    start_position = sum(get_motor_positions())
-
-    def condition():
-        return not push_sensor()
+    controller.calibrate_straight_drive_distance(robot_length_inches, direction, speed, total_inches)
 
-    straight_drive(int(copysign(speed, direction)), condition)
-    with open(os.path.expanduser("~/straight.txt"), "w+") as file:
-        file.write(
-            str(abs((sum(get_motor_positions()) - start_position)
-                    / (total_inches - robot_length_inches))))
-    msleep(500)
-    with open(os.path.expanduser("~/straight.txt")) as file:
-        proportion = file.read()
-    print(f"Straight drive distance calibrated. {proportion} ticks per inch.")
-    global straight_drive_distance_proportion
-    straight_drive_distance_proportion = float(proportion)
-    wait_for_button("Press button to drive halfway back")
-    straight_drive_distance(-1 * copysign(speed, direction), (total_inches - robot_length_inches) / 2)
-    wait_for_button()
-    gyro_turn(-80, 80, 180)
 
-
-def straight_drive_distance(speed, inches, stop_when_finished=True):
+def straight_drive_distance(speed, inches, stop_when_finished=True, cancel_token: Optional[CancellationToken] = None,
+                            max_acceleration=None, max_jerk=None, start_speed=0, end_speed=0, watch_rate=None,
+                            adjust_for_momentum=True):
     """
-        Drives straight at a given speed for a given distance.
-
-
-        :param speed: The speed at which the robot should be driving. Accepts integers in the range from -100 to 100,
-            inclusive.
-
-        :param inches: The number of inches for the robot to drive.
-
-        :param stop_when_finished: Determines if the robot should stop when it finishes driving. Defaults to True.
+        The same as DriveController.straight_drive_distance() on the default controller
     """
-    start_position = sum(get_motor_positions())
-    global distance_adjustment
+    controller.straight_drive_distance(speed, inches, stop_when_finished, cancel_token, max_acceleration, max_jerk,
+                                       start_speed, end_speed, watch_rate, adjust_for_momentum)
 
-    def condition():
-        left, right = get_motor_positions()
-        return abs(left + right - start_position) \
-            < (abs(inches) - abs(distance_adjustment * (speed / 100.0))) * straight_drive_distance_proportion
 
-    straight_drive(speed, condition, stop_when_finished)
+def get_straight_drive_distance_proportion():
+    """
+        Returns the number of motor ticks (left plus right) per inch, loading it from disk the first time it is needed
+    """
+    return controller.straight_drive_distance_proportion
 
 
 def gyro_demo():
@@ -314,10 +180,23 @@ def gyro_demo():
     gyro_turn_test(-25, 25, 90, 4)
 
 
-try:
-    # Reads the straight_drive_distance_proportion from straight.txt if straight.txt exists.
-    with open(os.path.expanduser("~/straight.txt"), "r") as straight_file:
-        straight_drive_distance_proportion = float(straight_file.read())
-except FileNotFoundError:
-    # Prints a warning if straight.txt is not found. If this happens, run calibrate_straight_drive_distance().
-    print("Warning, straight drive distance not calibrated")
+def __getattr__(name):
+    # The old module variables are read from the default controller. drive and stop are functions above, since they
+    # are called more often than read.
+    if name in _CONTROLLER_ATTRIBUTES:
+        return getattr(controller, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class _GyroMovementsModule(ModuleType):
+    # Assigning to an old module variable changes the default controller instead of hiding its value
+    def __setattr__(self, name, value):
+        if name in SETTINGS:
+            controller.configure(**{name: value})
+        elif name in _CONTROLLER_ATTRIBUTES:
+            setattr(controller, name, value)
+        else:
+            super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _GyroMovementsModule
@@ -0,0 +1,113 @@
+"""
+Provides a background gyroscope sampler that integrates heading at a fixed high rate
+"""
+from array import array
+from threading import Lock
+from common.scheduler import LoopScheduler
+from common import hardware
+
+
+class GyroSampler:
+    """
+    Reads gyro_z() at a fixed rate on a background thread and stores timestamped samples in a preallocated ring buffer.
+    Heading is integrated with the trapezoidal rule, so it does not depend on how often the movement loops run.
+
+    Headings and rates are in raw gyroscope units (offset corrected). Divide headings by 8 to get degrees, the same way
+    gyro_movements does.
+    """
+
+    def __init__(self, rate_hz=1000, capacity=1024, offset=0.0):
+        """
+        :param rate_hz: The number of samples taken per second.
+
+        :param capacity: The number of samples kept in the ring buffer.
+
+        :param offset: The gyroscope offset subtracted from every sample.
+        """
+        self.rate_hz = rate_hz
+        self.capacity = capacity
+        self.offset = offset
+        self._times = array('d', bytes(8 * capacity))
+        self._values = array('d', bytes(8 * capacity))
+        self._count = 0
+        self._heading = 0.0
+        self._lock = Lock()
+        self.scheduler = LoopScheduler(rate_hz, "gyro_sampler")
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """
+        Starts the sampling thread if it is not already running
+        """
+        if self.running:
+            return self
+        self.running = True
+        self.thread = hardware.start_thread(self._sample, "gyro_sampler")
+        return self
+
+    def stop(self):
+        """
+        Stops the sampling thread and waits for it to finish
+        """
+        self.running = False
+        if self.thread is not None:
+            hardware.join(self.thread)
+            self.thread = None
+
+    def _sample(self):
+        times = self._times
+        values = self._values
+        capacity = self.capacity
+        previous_time = self.scheduler.start()
+        previous_value = hardware.gyro_z() - self.offset
+        while self.running:
+            self.scheduler.wait()
+            value = hardware.gyro_z() - self.offset
+            now = self.scheduler.last_tick
+            with self._lock:
+                index = self._count % capacity
+                times[index] = now
+                values[index] = value
+                self._heading += (previous_value + value) * 0.5 * (now - previous_time)
+                self._count += 1
+            previous_time = now
+            previous_value = value
+
+    def heading(self):
+        """
+        Returns the integrated heading since the sampler started, in raw gyroscope units
+        """
+        return self._heading
+
+    def reset_heading(self, heading=0.0):
+        """
+        Sets the integrated heading to the given value
+        """
+        with self._lock:
+            self._heading = heading
+
+    def rate(self, window=1):
+        """
+        Returns the mean of the most recent samples
+
+        :param window: The number of samples to average. Defaults to 1, the latest sample.
+        """
+        with self._lock:
+            count = min(window, self._count, self.capacity)
+            if count == 0:
+                return hardware.gyro_z() - self.offset
+            end = self._count
+            return sum(self._values[i % self.capacity] for i in range(end - count, end)) / count
+
+    def samples(self, count=None):
+        """
+        Returns a list of (timestamp, value) tuples, oldest first
+
+        :param count: The number of samples to return. Defaults to every sample in the buffer.
+        """
+        with self._lock:
+            available = min(self._count, self.capacity)
+            count = available if count is None else min(count, available)
+            end = self._count
+            return [(self._times[i % self.capacity], self._values[i % self.capacity]) for i in range(end - count, end)]
@@ -0,0 +1,120 @@
+"""
+Provides the hardware backend that every module reads sensors, drives motors, keeps time and waits through, so the same
+code can run on the robot or on a simulation.
+
+The functions of the current backend are module attributes, so call them through the module, for example
+hardware.gyro_z() or hardware.sleep(0.1), instead of importing them by name. The kipr backend is installed the first
+time one is used, unless another backend was installed with use() first.
+
+Usage:
+    from common import hardware
+    hardware.use(simulation.SimulatedBackend())
+"""
+from threading import Thread
+
+# The functions every backend provides
+NAMES = (
+    # Sensors and motors, with the same signatures as in kipr
+    "gyro_z", "analog", "digital", "push_button", "a_button", "b_button", "c_button",
+    "motor_power", "get_motor_position_counter", "freeze", "console_clear",
+    "set_servo_position", "get_servo_position", "enable_servo",
+    # Time
+    "monotonic", "time", "sleep", "msleep", "async_sleep",
+    # Threads and waits. Waiting on anything other than the backend's clock must go through these, so that a
+    # simulated clock knows the thread is waiting.
+    "start_thread", "wait_event", "wait_for", "wait_futures", "join", "hand_off", "take_over", "release",
+)
+
+backend = None
+
+
+class KiprBackend:
+    """
+    Runs on the robot using the kipr library and the system clock
+    """
+
+    def __init__(self):
+        import time
+        import kipr
+        for name in ("gyro_z", "analog", "digital", "push_button", "a_button", "b_button", "c_button", "motor_power",
+                     "get_motor_position_counter", "freeze", "console_clear", "set_servo_position",
+                     "get_servo_position", "enable_servo", "msleep"):
+            setattr(self, name, getattr(kipr, name))
+        self.monotonic = time.monotonic
+        self.time = time.time
+        self.sleep = time.sleep
+
+    @staticmethod
+    async def async_sleep(seconds):
+        # Imported here because asyncio is slow to import and only async loops need it
+        import asyncio
+        await asyncio.sleep(seconds)
+
+    @staticmethod
+    def start_thread(target, name=None):
+        """
+        Starts a daemon thread running target and returns it
+        """
+        thread = Thread(target=target, name=name, daemon=True)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def wait_event(event, timeout=None):
+        return event.wait(timeout)
+
+    @staticmethod
+    def wait_for(condition, predicate, timeout=None):
+        """
+        Waits until predicate returns a true value, which is returned, checking it whenever condition is notified. The
+        condition must not already be held. Returns the last value of predicate if the timeout expires first.
+        """
+        with condition:
+            return condition.wait_for(predicate, timeout)
+
+    @staticmethod
+    def wait_futures(futures, timeout=None):
+        # Imported here because concurrent.futures is slow to import and only waiting on futures needs it
+        from concurrent.futures import wait
+        return wait(futures, timeout)
+
+    @staticmethod
+    def join(thread, timeout=None):
+        thread.join(timeout)
+
+    @staticmethod
+    def hand_off():
+        """
+        Called before queueing work for another thread. Only a simulated clock needs this.
+        """
+
+    @staticmethod
+    def take_over():
+        """
+        Called by the thread that picks up work queued after hand_off()
+        """
+
+    @staticmethod
+    def release():
+        """
+        Called before a thread blocks on something other than the backend, such as an idle queue
+        """
+
+
+def use(new_backend):
+    """
+    Installs a backend and returns it. Modules see the change immediately, since they call through this module.
+    """
+    global backend
+    backend = new_backend
+    for name in NAMES:
+        globals()[name] = getattr(new_backend, name)
+    return new_backend
+
+
+def __getattr__(name):
+    # The kipr backend is installed on first use, so importing a module does not import kipr
+    if name in NAMES:
+        use(KiprBackend())
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
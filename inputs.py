@@ -0,0 +1,185 @@
+"""
+Provides a shared, debounced input service for buttons and digital sensors
+"""
+from math import ceil
+from threading import Condition
+from common import hardware
+from common.scheduler import LoopScheduler
+
+
+class _Input:
+    __slots__ = ("read", "raw", "stable_count", "pressed", "presses", "releases", "on_press", "on_release")
+
+    def __init__(self, read):
+        self.read = read
+        self.raw = False
+        self.stable_count = 0
+        self.pressed = False
+        self.presses = 0
+        self.releases = 0
+        self.on_press = []
+        self.on_release = []
+
+
+class InputService:
+    """
+    Polls buttons and digital sensors at a fixed low rate on one background thread and debounces them. Code that waits
+    for input blocks on the service instead of spinning, so it does not starve other threads.
+
+    The push button and the A, B and C buttons are watched as "push", "a", "b" and "c". Digital ports can be added with
+    watch_digital(), and any other boolean function with watch().
+    """
+
+    def __init__(self, rate_hz=50, debounce_ms=40):
+        """
+        :param rate_hz: The number of times per second every input is read. Defaults to 50.
+
+        :param debounce_ms: How long an input must read the same value before it changes state. Defaults to 40.
+        """
+        self.rate_hz = rate_hz
+        self.debounce_samples = max(1, ceil(debounce_ms / 1000 * rate_hz))
+        self._inputs = {}
+        self._condition = Condition()
+        self.running = False
+        self.thread = None
+        # Read through the hardware module on every poll, so a backend installed later is used
+        self.watch("push", lambda: hardware.push_button())
+        self.watch("a", lambda: hardware.a_button())
+        self.watch("b", lambda: hardware.b_button())
+        self.watch("c", lambda: hardware.c_button())
+
+    def watch(self, name, read_function):
+        """
+        Starts watching an input
+
+        :param name: The name used to refer to the input.
+
+        :param read_function: A function that takes no parameters and returns True while the input is active.
+        """
+        with self._condition:
+            if name not in self._inputs:
+                self._inputs[name] = _Input(read_function)
+        return name
+
+    def watch_digital(self, port):
+        """
+        Starts watching a digital port and returns its input name, "digital<port>"
+        """
+        return self.watch(f"digital{port}", lambda: bool(hardware.digital(port)))
+
+    def on_press(self, name, callback):
+        """
+        Calls callback with the input name every time the input is pressed. Callbacks run on the service thread, so
+        they should return quickly.
+        """
+        self.start()
+        with self._condition:
+            self._inputs[name].on_press.append(callback)
+
+    def on_release(self, name, callback):
+        """
+        Calls callback with the input name every time the input is released
+        """
+        self.start()
+        with self._condition:
+            self._inputs[name].on_release.append(callback)
+
+    def start(self):
+        """
+        Starts the polling thread if it is not already running
+        """
+        with self._condition:
+            if self.running:
+                return
+            self.running = True
+            for state in self._inputs.values():
+                state.raw = state.pressed = bool(state.read())
+            self.thread = hardware.start_thread(self._run, "inputs")
+
+    def stop(self):
+        """
+        Stops the polling thread
+        """
+        self.running = False
+        if self.thread is not None:
+            hardware.join(self.thread)
+            self.thread = None
+
+    def is_pressed(self, name):
+        """
+        Returns the debounced state of an input
+        """
+        self.start()
+        return self._inputs[name].pressed
+
+    def presses(self, name):
+        """
+        Returns the number of times an input has been pressed since it started being watched
+        """
+        return self._inputs[name].presses
+
+    def wait_for_press(self, *names, timeout=None):
+        """
+        Waits until any of the inputs is pressed, returning immediately if one already is. Returns the name of the
+        pressed input, or None if the timeout expired.
+        """
+        self.start()
+        pressed = hardware.wait_for(self._condition, lambda: self._first(names, True), timeout)
+        return pressed or None
+
+    def wait_for_release(self, *names, timeout=None):
+        """
+        Waits until every one of the inputs is released. Returns False if the timeout expired first.
+        """
+        self.start()
+        return hardware.wait_for(self._condition, lambda: not self._first(names, True), timeout)
+
+    def wait_for_click(self, *names, timeout=None):
+        """
+        Waits until one of the inputs is pressed and then released. Returns its name, or None if the timeout expired.
+        """
+        end = None if timeout is None else hardware.monotonic() + timeout
+        pressed = self.wait_for_press(*names, timeout=timeout)
+        if pressed is None:
+            return None
+        if not self.wait_for_release(pressed, timeout=None if end is None else max(end - hardware.monotonic(), 0.0)):
+            return None
+        return pressed
+
+    def _first(self, names, pressed):
+        for name in names:
+            if self._inputs[name].pressed is pressed:
+                return name
+        return None
+
+    def _run(self):
+        scheduler = LoopScheduler(self.rate_hz, "inputs")
+        scheduler.start()
+        while self.running:
+            callbacks = []
+            with self._condition:
+                changed = False
+                for name, state in self._inputs.items():
+                    raw = bool(state.read())
+                    if raw != state.raw:
+                        state.raw = raw
+                        state.stable_count = 1
+                    elif state.stable_count < self.debounce_samples:
+                        state.stable_count += 1
+                    if raw != state.pressed and state.stable_count >= self.debounce_samples:
+                        state.pressed = raw
+                        changed = True
+                        if raw:
+                            state.presses += 1
+                            callbacks.extend((callback, name) for callback in state.on_press)
+                        else:
+                            state.releases += 1
+                            callbacks.extend((callback, name) for callback in state.on_release)
+                if changed:
+                    self._condition.notify_all()
+            for callback, name in callbacks:
+                callback(name)
+            scheduler.wait()
+
+
+inputs = InputService()
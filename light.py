@@ -1,36 +1,47 @@
-from kipr import push_button, msleep, console_clear, analog
-from time import time
+from array import array
+from math import sqrt
+from statistics import NormalDist
+from common.cancellation import CancellationToken
+from common.inputs import inputs
+from common.scheduler import LoopScheduler
+from common import hardware
 
 START_LIGHT_THRESHOLD = 0
 USE_BUTTON_INSTEAD = False
+LIGHT_ON_VALUE = None
+LIGHT_OFF_VALUE = None
+last_start_latency_ms = None
+# The smallest drop from the light-off level that StartLightDetector triggers on, in analog counts. It only matters when
+# the sensor is so quiet that the noise-based trigger level would sit within the sensor's quantisation steps.
+DEFAULT_MIN_DROP = 20
 
 
 def _calibrate(port):
     global START_LIGHT_THRESHOLD
+    global LIGHT_ON_VALUE
+    global LIGHT_OFF_VALUE
     light_on = 0
-    while not push_button():
-        light_on = analog(port)
-        console_clear()
+    while not inputs.is_pressed("push"):
+        light_on = hardware.analog(port)
+        hardware.console_clear()
         print("Press button with light on")
         print("On value =", light_on)
-        msleep(100)
-    while push_button():
-        pass
+        inputs.wait_for_press("push", timeout=0.1)
+    inputs.wait_for_release("push")
 
     if light_on > 400:
         print("Bad calibration")
         return False
-    msleep(1000)
+    hardware.msleep(1000)
     light_off = 3000
-    while not push_button():
-        console_clear()
+    while not inputs.is_pressed("push"):
+        hardware.console_clear()
         print("Press button with light off")
         print("On value =", light_on)
-        light_off = analog(port)
+        light_off = hardware.analog(port)
         print("Off value =", light_off)
-        msleep(100)
-    while push_button():
-        pass
+        inputs.wait_for_press("push", timeout=0.1)
+    inputs.wait_for_release("push")
 
     if light_off < 1400:
         print("Bad calibration")
@@ -40,40 +51,182 @@ def _calibrate(port):
         print("Bad calibration")
         return False
     START_LIGHT_THRESHOLD = (light_off - light_on) / 2
+    LIGHT_ON_VALUE = light_on
+    LIGHT_OFF_VALUE = light_off
     print("Good calibration! ", START_LIGHT_THRESHOLD)
     return True
 
 
-def _wait_4(port, function=None, function_every=None):
+def _wait_4(port, function=None, function_every=None, cancel_token: CancellationToken = None):
     i = 10
     end_time = 0
     print("waiting for light!!", i)
     while i > 0:
-        if analog(port) < START_LIGHT_THRESHOLD or (push_button() and USE_BUTTON_INSTEAD):
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+        if hardware.analog(port) < START_LIGHT_THRESHOLD or (USE_BUTTON_INSTEAD and inputs.is_pressed("push")):
             i = i - 1
             print("Countdown:", i)
         else:
             i = 10
-        if function and function_every and time() - end_time > function_every and i == 10:
+        if function and function_every and hardware.time() - end_time > function_every and i == 10:
             function()
-            end_time = time()
+            end_time = hardware.time()
         else:
-            msleep(10)
+            hardware.msleep(10)
 
 
-def wait_4_light(port, ignore=False, function=None, function_every=None):
+class StartLightDetector:
+    """
+    Detects the start light by sampling the analog port at a high rate and comparing every sample with a running
+    estimate of the light-off level. The trigger level is set from the measured sensor noise so that noise alone
+    triggers at most false_trigger_rate times per second, which lets the detector fire on the leading edge of the light
+    instead of waiting for the reading to cross the midpoint.
+    """
+
+    def __init__(self, port, rate_hz=1000, false_trigger_rate=1e-4, confirm_samples=3, min_drop=DEFAULT_MIN_DROP,
+                 baseline_samples=500):
+        """
+        :param port: The analog port of the light sensor.
+
+        :param rate_hz: The number of samples per second. Defaults to 1000.
+
+        :param false_trigger_rate: The accepted number of false triggers per second caused by sensor noise. Defaults to
+            1e-4.
+
+        :param confirm_samples: The number of consecutive samples that must be past the trigger level. Defaults to 3.
+
+        :param min_drop: The smallest drop from the light-off level that can trigger, a floor for sensors with almost
+            no noise. Slow changes in ambient light are followed by the light-off estimate instead. Defaults to
+            DEFAULT_MIN_DROP.
+
+        :param baseline_samples: The number of samples in the ring buffer used to estimate the light-off level.
+        """
+        self.port = port
+        self.rate_hz = rate_hz
+        self.confirm_samples = confirm_samples
+        self.min_drop = min_drop
+        # Noise has to pass the threshold confirm_samples times in a row, so each sample may be past it more often
+        per_sample = (false_trigger_rate / rate_hz) ** (1 / confirm_samples)
+        self.sigmas = -NormalDist().inv_cdf(min(per_sample, 0.5))
+        self.capacity = baseline_samples
+        self._times = array('d', bytes(8 * baseline_samples))
+        self._values = array('d', bytes(8 * baseline_samples))
+        self._count = 0
+        self._sum = 0.0
+        self._sum_of_squares = 0.0
+        self.trigger_time = None
+        self.onset_time = None
+
+    @property
+    def latency_ms(self):
+        """
+        The number of milliseconds between the start of the light transition and the trigger
+        """
+        if self.trigger_time is None or self.onset_time is None:
+            return None
+        return (self.trigger_time - self.onset_time) * 1000
+
+    def _add_baseline(self, timestamp, value):
+        index = self._count % self.capacity
+        if self._count >= self.capacity:
+            old = self._values[index]
+            self._sum -= old
+            self._sum_of_squares -= old * old
+        self._times[index] = timestamp
+        self._values[index] = value
+        self._sum += value
+        self._sum_of_squares += value * value
+        self._count += 1
+
+    def _baseline(self):
+        count = min(self._count, self.capacity)
+        mean = self._sum / count
+        variance = max(self._sum_of_squares / count - mean * mean, 0.0)
+        return mean, sqrt(variance)
+
+    def wait(self, function=None, function_every=None, cancel_token: CancellationToken = None):
+        """
+        Blocks until the start light turns on and returns the trigger latency in milliseconds
+        """
+        scheduler = LoopScheduler(self.rate_hz, "start_light")
+        scheduler.start()
+        warmup = min(self.capacity, max(self.rate_hz // 10, 20))
+        below = 0
+        onset = None
+        end_time = 0
+        while True:
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            value = hardware.analog(self.port)
+            now = hardware.monotonic()
+            if USE_BUTTON_INSTEAD and inputs.is_pressed("push"):
+                self.onset_time = self.trigger_time = now
+                return 0.0
+            if self._count < warmup:
+                self._add_baseline(now, value)
+            else:
+                mean, deviation = self._baseline()
+                threshold = mean - max(self.sigmas * deviation, self.min_drop)
+                if value < mean - 3 * deviation:
+                    if onset is None:
+                        onset = now
+                else:
+                    onset = None
+                if value < threshold:
+                    below += 1
+                    if below >= self.confirm_samples:
+                        self.trigger_time = now
+                        self.onset_time = onset if onset is not None else now
+                        return self.latency_ms
+                else:
+                    below = 0
+                    if onset is None:
+                        # Only learn the light-off level from samples that are not part of a possible transition
+                        self._add_baseline(now, value)
+            if function and function_every and below == 0 and hardware.time() - end_time > function_every:
+                function()
+                end_time = hardware.time()
+            scheduler.wait()
+
+
+def wait_4_light(port, ignore=False, function=None, function_every=None, cancel_token: CancellationToken = None,
+                 fast=False, false_trigger_rate=1e-4):
+    """
+    Calibrates the start light and waits for it to turn on.
+
+
+    :param port: The analog port of the light sensor.
+
+    :param ignore: Waits for the button instead of the light. Defaults to False.
+
+    :param function: An optional function to call periodically while waiting.
+
+    :param function_every: The number of seconds between calls to function.
+
+    :param cancel_token: An optional CancellationToken. If it is cancelled, Cancelled is raised.
+
+    :param fast: Uses the StartLightDetector, which samples at 1 kHz and triggers on the leading edge of the light,
+        instead of waiting for 10 samples past the calibrated threshold. Defaults to False.
+
+    :param false_trigger_rate: The accepted number of false triggers per second caused by sensor noise in fast mode.
+    """
+    global last_start_latency_ms
     if ignore:
         wait_for_button()
         return
     if not USE_BUTTON_INSTEAD:
         while not _calibrate(port):
             pass
-    _wait_4(port, function=function, function_every=function_every)
+    if fast:
+        print("waiting for light!!")
+        detector = StartLightDetector(port, false_trigger_rate=false_trigger_rate)
+        last_start_latency_ms = detector.wait(function, function_every, cancel_token)
+        print(f"Start light detected {last_start_latency_ms:.1f} ms after the transition")
+        return
+    _wait_4(port, function=function, function_every=function_every, cancel_token=cancel_token)
 
 
 def wait_for_button():
     print('waiting for button')
-    while not push_button():
-        pass
-    while push_button():
-        pass
+    inputs.wait_for_click("push")
@@ -0,0 +1,100 @@
+"""
+Provides acceleration and jerk limited motion profiles for distance drives
+"""
+from math import sqrt
+
+
+class MotionProfile:
+    """
+    Plans an acceleration, cruise and deceleration velocity profile over a distance. The profile is generated online
+    from the measured remaining distance, so it closes on the target even if the robot slips or lags the command.
+
+    Setting max_jerk turns the trapezoidal profile into an S-curve by limiting how quickly the acceleration can change.
+    Any consistent units can be used, for example inches, inches per second and inches per second squared.
+    """
+
+    def __init__(self, distance, max_velocity, max_acceleration, max_jerk=None, start_velocity=0.0, end_velocity=0.0,
+                 min_velocity=0.0):
+        """
+        :param distance: The distance to travel. Must be positive.
+
+        :param max_velocity: The cruise velocity.
+
+        :param max_acceleration: The largest acceleration and deceleration allowed.
+
+        :param max_jerk: The largest change in acceleration per second allowed, or None for a trapezoidal profile.
+
+        :param start_velocity: The velocity at the start of the profile.
+
+        :param end_velocity: The velocity the profile should finish at. Use 0 to stop at the target.
+
+        :param min_velocity: The smallest velocity the profile will command before reaching the target, so that the
+            motors do not stall just short of it.
+        """
+        if max_acceleration <= 0:
+            raise ValueError(f"max_acceleration must be positive, got {max_acceleration}")
+        if max_jerk is not None and max_jerk <= 0:
+            raise ValueError(f"max_jerk must be positive, got {max_jerk}")
+        self.distance = abs(distance)
+        self.max_velocity = abs(max_velocity)
+        self.max_acceleration = max_acceleration
+        self.max_jerk = max_jerk
+        self.start_velocity = min(abs(start_velocity), self.max_velocity)
+        self.end_velocity = min(abs(end_velocity), self.max_velocity)
+        self.min_velocity = min(abs(min_velocity), self.max_velocity)
+        self.velocity = self.start_velocity
+        self.acceleration = 0.0
+
+    def braking_velocity(self, remaining):
+        """
+        Returns the fastest velocity from which the profile can still slow to end_velocity within the remaining
+        distance
+        """
+        if remaining <= 0:
+            return self.end_velocity
+        a = self.max_acceleration
+        if self.max_jerk is None:
+            return sqrt(self.end_velocity ** 2 + 2 * a * remaining)
+        # Stopping distance with a jerk limited ramp into the deceleration is v^2 / 2a + v * a / 2j
+        lag = a / (2 * self.max_jerk)
+        return sqrt(self.end_velocity ** 2 + a * a * lag * lag + 2 * a * remaining) - a * lag
+
+    def update(self, remaining, dt):
+        """
+        Advances the profile by dt seconds and returns the velocity to command
+
+        :param remaining: The distance left to the target, measured by the encoders.
+
+        :param dt: The number of seconds since the previous update.
+        """
+        if remaining <= 0:
+            self.velocity = self.end_velocity
+            self.acceleration = 0.0
+            return self.velocity
+        braking = self.braking_velocity(remaining)
+        target = min(self.max_velocity, braking)
+        if self.velocity >= braking:
+            # Follow the braking curve exactly so the profile never runs past the target
+            self.acceleration = -self.max_acceleration
+            self.velocity = braking
+        elif dt > 0:
+            acceleration = max(min((target - self.velocity) / dt, self.max_acceleration), -self.max_acceleration)
+            if self.max_jerk is not None:
+                step = self.max_jerk * dt
+                acceleration = max(min(acceleration, self.acceleration + step), self.acceleration - step)
+            self.acceleration = acceleration
+            self.velocity = min(max(self.velocity + acceleration * dt, 0.0), target)
+        return max(self.velocity, self.min_velocity)
+
+    def planned_duration(self):
+        """
+        Returns the time the trapezoidal profile would take to cover the distance, ignoring jerk limits
+        """
+        a = self.max_acceleration
+        v0, v1 = self.start_velocity, self.end_velocity
+        peak = min(self.max_velocity, sqrt((2 * a * self.distance + v0 * v0 + v1 * v1) / 2))
+        acceleration_time = (peak - v0) / a
+        deceleration_time = (peak - v1) / a
+        ramp_distance = (peak * peak - v0 * v0) / (2 * a) + (peak * peak - v1 * v1) / (2 * a)
+        cruise_time = max(self.distance - ramp_distance, 0.0) / peak if peak > 0 else 0.0
+        return acceleration_time + cruise_time + deceleration_time
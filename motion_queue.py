@@ -0,0 +1,141 @@
+"""
+Provides a movement queue that runs drive, turn and arc segments back to back without stopping between them
+"""
+from math import copysign
+from typing import NamedTuple, List, Optional, Union
+from common import gyro_movements
+from common.drive_controller import DriveController
+from common.cancellation import CancellationToken
+from common import hardware
+
+
+class Drive(NamedTuple):
+    """
+    A straight drive of a given number of inches
+    """
+    speed: int
+    inches: float
+
+
+class Turn(NamedTuple):
+    """
+    A gyro turn, usually with the wheels spinning in opposite directions
+    """
+    left_speed: int
+    right_speed: int
+    angle: float
+
+
+class Arc(NamedTuple):
+    """
+    A gyro turn with both wheels driving in the same direction at different speeds
+    """
+    left_speed: int
+    right_speed: int
+    angle: float
+
+
+Segment = Union[Drive, Turn, Arc]
+
+
+class SegmentResult(NamedTuple):
+    segment: Segment
+    elapsed: float
+
+
+def _forward_speed(segment):
+    """
+    Returns the forward speed of a segment, which is what the robot carries across a segment boundary
+    """
+    if isinstance(segment, Drive):
+        return segment.speed
+    return (segment.left_speed + segment.right_speed) / 2
+
+
+def _blend_speed(speed, neighbour):
+    """
+    Returns the speed a drive should start or finish at so that it matches its neighbouring segment
+    """
+    if neighbour is None:
+        return 0
+    other = _forward_speed(neighbour)
+    if other == 0 or copysign(1, other) != copysign(1, speed):
+        return 0
+    return min(abs(other), abs(speed))
+
+
+class MotionQueue:
+    """
+    Runs a list of segments back to back. Segments never stop or settle at their boundaries, so only the last segment
+    allows for momentum with the gyro_init momentum adjustments. When max_acceleration is set, drives follow motion
+    profiles that start at the speed of the previous segment and finish at the speed of the next one, so the velocity
+    blends across each boundary. Without it, the speed changes at once at each boundary.
+
+    Example:
+        MotionQueue(max_acceleration=40).run([
+            Drive(80, 24),
+            Arc(40, 80, 90),
+            Drive(80, 12),
+            Turn(-60, 60, 180),
+        ])
+    """
+
+    def __init__(self, max_acceleration=None, max_jerk=None, controller: Optional[DriveController] = None):
+        """
+        :param max_acceleration: The largest acceleration for drives in inches per second squared. Defaults to None,
+            which drives at constant speed and does not blend the velocity between segments.
+
+        :param max_jerk: The largest change in acceleration for drives in inches per second cubed.
+
+        :param controller: The DriveController that runs the segments. Defaults to the default controller of
+            gyro_movements at the time the queue runs.
+        """
+        self.max_acceleration = max_acceleration
+        self.max_jerk = max_jerk
+        self.controller = controller
+        self.results: List[SegmentResult] = []
+
+    def run(self, segments, stop_when_finished=True, cancel_token: Optional[CancellationToken] = None):
+        """
+        Runs the segments in order and returns the time spent in each one
+
+        :param segments: A list of Drive, Turn and Arc segments.
+
+        :param stop_when_finished: Determines if the robot should stop after the last segment. Defaults to True.
+
+        :param cancel_token: An optional CancellationToken. If it is cancelled, the robot stops and Cancelled is raised.
+        """
+        self.results = []
+        controller = self.controller or gyro_movements.controller
+        for index, segment in enumerate(segments):
+            previous = segments[index - 1] if index > 0 else None
+            following = segments[index + 1] if index + 1 < len(segments) else None
+            # Only a segment that stops has to allow for coasting afterwards
+            stops = stop_when_finished and following is None
+            start_time = hardware.monotonic()
+            if isinstance(segment, Drive):
+                if self.max_acceleration is None:
+                    controller.straight_drive_distance(segment.speed, segment.inches, stops,
+                                                       cancel_token=cancel_token, adjust_for_momentum=stops)
+                else:
+                    controller.straight_drive_distance(
+                        segment.speed, segment.inches, stops, cancel_token=cancel_token,
+                        max_acceleration=self.max_acceleration, max_jerk=self.max_jerk,
+                        start_speed=_blend_speed(segment.speed, previous),
+                        end_speed=_blend_speed(segment.speed, following),
+                    )
+            elif isinstance(segment, (Turn, Arc)):
+                controller.gyro_turn(segment.left_speed, segment.right_speed, segment.angle, stops,
+                                     cancel_token=cancel_token, adjust_for_momentum=stops)
+            else:
+                raise TypeError(f"Unknown segment {segment!r}")
+            self.results.append(SegmentResult(segment, hardware.monotonic() - start_time))
+        return self.results
+
+    def report(self):
+        """
+        Prints the time spent in each segment of the last run
+        """
+        for result in self.results:
+            print(f"{result.segment}: {result.elapsed:.3f} s")
+        print(f"Total: {sum(result.elapsed for result in self.results):.3f} s")
@@ -1,40 +1,326 @@
-import time
-from threading import Thread
-from kipr import get_motor_position_counter, motor_power, freeze
+from concurrent.futures import Future
+from queue import SimpleQueue
+from threading import Thread, Lock, Event
+from common import hardware
+from common.scheduler import LoopScheduler
+from common.cancellation import CancellationToken, Cancelled
+from common import telemetry
+from common import profiling
+
+DEFAULT_MOTOR_GAIN = 100 / 300
+DEFAULT_MOTOR_TOLERANCE = 10
+
+
+class WorkerPool:
+    """
+    Runs functions on a set of reusable daemon worker threads. Workers are created on demand, up to max_workers, and
+    are kept alive between tasks so that starting a task does not create a new thread.
+    """
+
+    def __init__(self, max_workers=16):
+        """
+        :param max_workers: The largest number of tasks that can run at the same time. Defaults to 16.
+        """
+        self.max_workers = max_workers
+        self._tasks = SimpleQueue()
+        self._workers = []
+        self._idle = 0
+        self._queued = 0
+        self._lock = Lock()
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queues a function to run on a worker and returns a Future for its result
+        """
+        future = Future()
+        # On a simulated clock, time must not move on until a worker has picked the task up
+        hardware.hand_off()
+        with self._lock:
+            self._queued += 1
+            self._tasks.put((future, function, args, kwargs))
+            if self._queued > self._idle and len(self._workers) < self.max_workers:
+                worker = Thread(target=self._work, daemon=True, name=f"worker-{len(self._workers)}")
+                self._workers.append(worker)
+                worker.start()
+        return future
+
+    def _work(self):
+        while True:
+            with self._lock:
+                self._idle += 1
+            future, function, args, kwargs = self._tasks.get()
+            hardware.take_over()
+            with self._lock:
+                self._idle -= 1
+                self._queued -= 1
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = function(*args, **kwargs)
+                except BaseException as exception:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(result)
+            hardware.release()
+
+
+worker_pool = WorkerPool()
 
 
 class Multitasker:
-    def __init__(self):
-        self.threads = []
-        # set up the storage for threads
+    """
+    Runs functions in the background on the shared worker pool. Leaving the with block waits for every task and
+    re-raises the first exception raised by a task.
+
+    Tasks that should be cancellable take the multitasker's token, for example:
+        with Multitasker() as tasks:
+            tasks.do(straight_drive, (80, condition), {"cancel_token": tasks.token})
+            ...
+            tasks.cancel()
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool or worker_pool
+        self.futures = []
+        self.token = CancellationToken()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        for thread in self.threads:
-            thread.join()
+        if exc_type is not None:
+            self.cancel()
+        hardware.wait_futures(self.futures)
+        if exc_type is None:
+            for future in self.futures:
+                if future.cancelled():
+                    continue
+                exception = future.exception()
+                if exception is not None and not isinstance(exception, Cancelled):
+                    raise exception
 
-    def do(self, function, args=None):
-        # create a mew thread, store it, and start it
-        thread = Thread(target=function, args=args or (), daemon=True)
-        self.threads.append(thread)
-        thread.start()
-        return thread
+    def do(self, function, args=None, kwargs=None):
+        """
+        Runs a function on the worker pool and returns a Future for its result
 
+        :param function: The function to run.
 
-class MultitaskedMotor:
-    def __init__(self, port, position):
+        :param args: A tuple of positional arguments for the function.
+
+        :param kwargs: A dictionary of keyword arguments for the function.
+        """
+        if profiling.profiler is not None:
+            function = profiling.timed(f"task.{getattr(function, '__name__', 'task')}", function)
+        future = self.pool.submit(function, *(args or ()), **(kwargs or {}))
+        self.futures.append(future)
+        return future
+
+    def cancel(self):
+        """
+        Cancels the token shared with this multitasker's tasks and drops any tasks that have not started yet
+        """
+        self.token.cancel()
+        for future in self.futures:
+            future.cancel()
+
+
+class _MotorState:
+    __slots__ = ("port", "target", "gain", "tolerance", "max_power", "at_target", "moved_at")
+
+    def __init__(self, port, target, gain, tolerance, max_power):
         self.port = port
-        self.position = position
-        self.running = True
-        self.thread = Thread(target=self._move_motors, daemon=True)
-        self.thread.start()
+        self.target = target
+        self.gain = gain
+        self.tolerance = tolerance
+        self.max_power = max_power
+        self.at_target = Event()
+        # When the target last changed, while profiling, so the time to reach it can be recorded
+        self.moved_at = profiling.profiler.start() if profiling.profiler is not None else None
 
-    def _move_motors(self):
+
+class MotorEngine:
+    """
+    Holds any number of motors at their target positions from a single fixed-rate control thread
+    """
+
+    def __init__(self, rate_hz=100):
+        """
+        :param rate_hz: The number of times per second every registered motor is updated. Defaults to 100.
+        """
+        self.rate_hz = rate_hz
+        self._motors = {}
+        self._lock = Lock()
+        self.running = False
+        self.thread = None
+
+    def register(self, port, target, gain=DEFAULT_MOTOR_GAIN, tolerance=DEFAULT_MOTOR_TOLERANCE, max_power=100):
+        """
+        Starts holding a motor at a target position, starting the control thread if needed. Returns the event that is
+        set while the motor is within tolerance of its target.
+
+        :param port: The motor port.
+
+        :param target: The motor position counter value to hold.
+
+        :param gain: The motor power applied per tick of position error.
+
+        :param tolerance: How many ticks away from the target still count as being at the target.
+
+        :param max_power: The largest motor power the engine will apply, from 0 to 100.
+        """
+        state = _MotorState(port, target, gain, tolerance, max_power)
+        with self._lock:
+            self._motors[port] = state
+        self.start()
+        return state.at_target
+
+    def unregister(self, port):
+        """
+        Stops holding a motor and freezes it
+        """
+        with self._lock:
+            state = self._motors.pop(port, None)
+        if state:
+            hardware.freeze(port)
+
+    def set_target(self, port, target):
+        """
+        Changes the target position of a registered motor
+        """
+        with self._lock:
+            state = self._motors[port]
+            state.target = target
+            state.at_target.clear()
+            if profiling.profiler is not None:
+                state.moved_at = profiling.profiler.start()
+
+    def set_gain(self, port, gain):
+        """
+        Changes the gain of a registered motor
+        """
+        with self._lock:
+            self._motors[port].gain = gain
+
+    def holds(self, port):
+        """
+        Returns True if the motor on the given port is registered with the engine
+        """
+        return port in self._motors
+
+    def at_target(self, port):
+        """
+        Returns the event that is set while a registered motor is within tolerance of its target
+        """
+        return self._motors[port].at_target
+
+    def start(self):
+        """
+        Starts the control thread if it is not already running
+        """
+        with self._lock:
+            if self.running:
+                return
+            self.running = True
+            self.thread = hardware.start_thread(self._run, "motor_engine")
+
+    def stop(self):
+        """
+        Stops the control thread, waits for it to finish and freezes every registered motor
+        """
+        with self._lock:
+            self.running = False
+            thread = self.thread
+            self.thread = None
+        if thread:
+            hardware.join(thread)
+        with self._lock:
+            ports = list(self._motors)
+            self._motors.clear()
+        for port in ports:
+            hardware.freeze(port)
+
+    def join(self, timeout=None):
+        """
+        Waits for the control thread to finish
+        """
+        thread = self.thread
+        if thread:
+            hardware.join(thread, timeout)
+
+    def _run(self):
+        scheduler = LoopScheduler(self.rate_hz, "motor_engine")
+        scheduler.start()
         while self.running:
-            current = get_motor_position_counter(self.port)
+            self._move_motors()
+            scheduler.wait()
+
+    def _move_motors(self):
+        recorder = telemetry.recorder
+        profiler = profiling.profiler
+        if profiler is not None:
+            mark = profiler.start()
+        # Held for the whole update, so that unregister() cannot freeze a motor that is then powered again
+        with self._lock:
+            for state in self._motors.values():
+                position = hardware.get_motor_position_counter(state.port)
+                error = state.target - position
+                limit = state.max_power
+                power = max(min(int(state.gain * error), limit), -limit)
+                hardware.motor_power(state.port, power)
+                if recorder is not None:
+                    recorder.record(hardware.monotonic(), 0.0, telemetry.SOURCE_MOTOR, state.port, 0.0, 0.0, power, 0,
+                                    position, 0, state.target)
+                if abs(error) <= state.tolerance:
+                    state.at_target.set()
+                    if state.moved_at is not None and profiler is not None:
+                        profiler.lap(f"motor{state.port}.move", state.moved_at)
+                        state.moved_at = None
+                else:
+                    state.at_target.clear()
+        if profiler is not None:
+            profiler.lap("motor_engine.update", mark)
+
+
+motor_engine = MotorEngine()
+
+
+class MultitaskedMotor:
+    """
+    Holds a motor at a position in the background using the shared motor engine
+    """
+
+    def __init__(self, port, position, gain=DEFAULT_MOTOR_GAIN, tolerance=DEFAULT_MOTOR_TOLERANCE, engine=None):
+        self.port = port
+        self.engine = engine or motor_engine
+        self._position = position
+        self.at_target = self.engine.register(port, position, gain, tolerance)
+
+    @property
+    def position(self):
+        return self._position
+
+    @position.setter
+    def position(self, position):
+        self._position = position
+        self.engine.set_target(self.port, position)
+
+    @property
+    def running(self):
+        return self.engine.running and self.engine.holds(self.port)
+
+    @running.setter
+    def running(self, running):
+        # Setting running to False was how the motor used to be stopped before the shared engine
+        if not running:
+            self.stop()
+
+    def wait(self, timeout=None):
+        """
+        Waits until the motor reaches its target. Returns False if the timeout expired first.
+        """
+        return hardware.wait_event(self.at_target, timeout)
 
-            motor_power(self.port, max(min(int(100 * (self.position - current) / 300), 100), -100))
-            time.sleep(0.1)
-        freeze(self.port)
+    def stop(self):
+        """
+        Stops holding the motor and freezes it
+        """
+        self.engine.unregister(self.port)
@@ -0,0 +1,173 @@
+"""
+Provides a background pose estimator that combines wheel encoders with the gyroscope
+"""
+from math import cos, sin, radians, degrees, atan2, hypot
+from threading import Lock
+from typing import NamedTuple, Optional
+from common import gyro_movements, hardware
+from common.drive_controller import DriveController
+from common.scheduler import LoopScheduler
+
+
+class Pose(NamedTuple):
+    """
+    A robot position in inches and heading in degrees. Heading increases counterclockwise, the direction the robot turns
+    when the right wheel is faster, which the gyroscope reads as negative.
+    """
+    x: float
+    y: float
+    heading: float
+
+
+def _normalize(angle):
+    """
+    Wraps an angle in degrees into the range -180 to 180
+    """
+    return (angle + 180.0) % 360.0 - 180.0
+
+
+class Odometry:
+    """
+    Tracks the robot's (x, y, heading) pose across every movement on a background thread. Distance comes from the wheel
+    encoder deltas and heading comes from the integrated gyroscope, which is far more accurate than wheel slip allows.
+
+    gyro_init() must have been called and straight drive distance must be calibrated before starting odometry.
+
+    Usage:
+        odometry = Odometry().start()
+        ...
+        odometry.drive_to(24, 12, 80)
+        odometry.turn_to(0, 60)
+    """
+
+    def __init__(self, rate_hz=200, controller: Optional[DriveController] = None):
+        """
+        :param rate_hz: The number of pose updates per second. Defaults to 200.
+
+        :param controller: The DriveController that reads the gyroscope and encoders and runs the movements. Defaults to
+            the default controller of gyro_movements at the time it is used.
+        """
+        self.rate_hz = rate_hz
+        self.controller = controller
+        self._pose = Pose(0.0, 0.0, 0.0)
+        self._lock = Lock()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """
+        Starts updating the pose in the background if it is not already running
+        """
+        if self.running:
+            return self
+        self._controller().check_init()
+        self.running = True
+        self.thread = hardware.start_thread(self._run, "odometry")
+        return self
+
+    def stop(self):
+        """
+        Stops updating the pose and waits for the thread to finish
+        """
+        self.running = False
+        if self.thread is not None:
+            hardware.join(self.thread)
+            self.thread = None
+
+    def reset(self, x=0.0, y=0.0, heading=0.0):
+        """
+        Sets the current pose, for example after squaring up on a known wall
+        """
+        with self._lock:
+            self._pose = Pose(x, y, heading)
+
+    def snapshot(self):
+        """
+        Returns the current pose
+        """
+        return self._pose
+
+    def _controller(self):
+        return self.controller or gyro_movements.controller
+
+    def _run(self):
+        gm = self._controller()
+        # straight_drive speeds up the right wheel when the gyroscope reads positive, so positive is clockwise
+        turn_scale = -gm._turn_scale
+        scheduler = LoopScheduler(self.rate_hz, "odometry")
+        scheduler.start()
+        ticks_per_inch = gm.get_straight_drive_distance_proportion() / 2
+        left, right = gm.get_motor_positions()
+        sampler = gm.gyro_sampler
+        gyro_total = sampler.heading() if sampler else 0.0
+        previous_rate = gm.gyroscope()
+        previous_heading = turn_scale * gyro_total
+        while self.running:
+            dt = scheduler.wait()
+            new_left, new_right = gm.get_motor_positions()
+            if sampler:
+                gyro_total = sampler.heading()
+            else:
+                rate = gm.gyroscope()
+                gyro_total += (previous_rate + rate) * 0.5 * dt
+                previous_rate = rate
+            heading = turn_scale * gyro_total
+            distance = ((new_left - left) + (new_right - right)) / 2 / ticks_per_inch
+            left, right = new_left, new_right
+            with self._lock:
+                pose = self._pose
+                # Integrate along the mid-point heading of this step
+                middle = radians(pose.heading + (heading - previous_heading) / 2)
+                self._pose = Pose(
+                    pose.x + distance * cos(middle),
+                    pose.y + distance * sin(middle),
+                    pose.heading + heading - previous_heading,
+                )
+            previous_heading = heading
+
+    def turn_to(self, heading, speed=60, tolerance=1.0):
+        """
+        Turns in place to an absolute heading, correcting any heading error accumulated by previous movements
+
+        :param heading: The heading to face, in degrees.
+
+        :param speed: The motor speed to turn at.
+
+        :param tolerance: The number of degrees of error allowed.
+
+        :return: The TurnResult of the turn, or None if the robot was already facing the heading.
+        """
+        error = _normalize(heading - self._pose.heading)
+        if abs(error) <= tolerance:
+            return None
+        speed = abs(speed)
+        if error > 0:
+            return self._controller().closed_loop_turn(-speed, speed, error, tolerance)
+        return self._controller().closed_loop_turn(speed, -speed, error, tolerance)
+
+    def drive_to(self, x, y, speed=80, turn_speed=60, max_acceleration=None):
+        """
+        Turns towards a point and drives straight to it. The distance and bearing are computed from the current pose,
+        so errors from previous movements are corrected.
+
+        :param x: The x coordinate of the point, in inches.
+
+        :param y: The y coordinate of the point, in inches.
+
+        :param speed: The speed to drive at. Negative speeds drive to the point backwards.
+
+        :param turn_speed: The speed to turn at.
+
+        :param max_acceleration: If set, the drive follows a motion profile, see straight_drive_distance().
+        """
+        pose = self._pose
+        distance = hypot(x - pose.x, y - pose.y)
+        if distance < 0.25:
+            return
+        bearing = degrees(atan2(y - pose.y, x - pose.x))
+        if speed < 0:
+            bearing += 180.0
+        self.turn_to(bearing, turn_speed)
+        pose = self._pose
+        self._controller().straight_drive_distance(speed, hypot(x - pose.x, y - pose.y),
+                                                   max_acceleration=max_acceleration)
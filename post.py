@@ -1,10 +1,126 @@
 import os
-from time import sleep
-from kipr import a_button, b_button, c_button, push_button
+from traceback import format_exception_only
+from concurrent.futures import Future
+from typing import NamedTuple, Optional, List, Dict, Callable, Tuple
+from common.inputs import inputs
+from common import hardware
+from common import gyro_movements
+from common.multitasker import worker_pool
+
+DEFAULT_CHECK_TIMEOUT = 10.0
 
 
 def msleep(milliseconds):
-    sleep(milliseconds/1000)
+    hardware.sleep(milliseconds/1000)
+
+
+class CheckResult(NamedTuple):
+    """
+    The outcome of one POST check. A check fails if it raises, returns False or does not finish within its timeout.
+    """
+    name: str
+    passed: bool
+    duration: Optional[float]
+    error: Optional[str] = None
+    timed_out: bool = False
+
+
+class PostReport(NamedTuple):
+    results: List[CheckResult]
+    duration: float
+    # The checks that timed out, which keep running on the worker pool since threads cannot be stopped from outside
+    unfinished: Tuple[Future, ...] = ()
+
+    @property
+    def passed(self):
+        return all(result.passed for result in self.results)
+
+    def failures(self):
+        return [result for result in self.results if not result.passed]
+
+    def wait(self, timeout=None):
+        """
+        Waits until every check that timed out has finished. Returns False if the timeout expired first.
+        """
+        return not hardware.wait_futures(list(self.unfinished), timeout).not_done
+
+    def as_dict(self):
+        """
+        Returns the report as plain values, so it can be stored with the robot's properties
+        """
+        return {
+            "passed": self.passed,
+            "duration": self.duration,
+            "time": hardware.time(),
+            "checks": [result._asdict() for result in self.results],
+        }
+
+    def report(self):
+        """
+        Prints one line per check and the overall result
+        """
+        for result in self.results:
+            if result.timed_out:
+                status = "TIMEOUT"
+            else:
+                status = "PASS" if result.passed else "FAIL"
+            duration = "-" if result.duration is None else f"{result.duration:.2f} s"
+            print(f"{result.name:<16} {status:<8} {duration:>9}" + (f"  {result.error}" if result.error else ""))
+        print(f"POST {'passed' if self.passed else 'FAILED'} in {self.duration:.2f} s")
+        if self.unfinished:
+            print(f"Warning, {len(self.unfinished)} check(s) that timed out are still running and may move the robot")
+
+
+def _timed_check(function):
+    start = hardware.monotonic()
+    try:
+        passed = function() is not False
+        return passed, hardware.monotonic() - start, None if passed else "returned False"
+    except Exception as e:
+        return False, hardware.monotonic() - start, format_exception_only(type(e), e)[-1].strip()
+
+
+def run_checks(checks: Dict[str, Callable[[], Optional[bool]]], timeout=DEFAULT_CHECK_TIMEOUT,
+               timeouts: Optional[Dict[str, float]] = None, parallel=True):
+    """
+    Runs POST checks and returns a PostReport. In parallel, every check runs at the same time on the shared worker
+    pool, so the POST takes as long as the slowest check instead of the sum of all of them.
+
+
+    :param checks: A dictionary of check names to functions that take no parameters. A check passes unless it raises
+        an exception or returns False.
+
+    :param timeout: How many seconds a check may take before it is reported as timed out. Defaults to 10.
+
+    :param timeouts: Timeouts for individual checks, by name, overriding timeout.
+
+    :param parallel: Runs the checks at the same time. Set to False for checks that must not overlap, for example
+        because they move the same mechanism. Defaults to True.
+    """
+    timeouts = timeouts or {}
+    start = hardware.monotonic()
+    results = []
+    unfinished = []
+    if parallel:
+        futures = {name: worker_pool.submit(_timed_check, function) for name, function in checks.items()}
+        for name, future in futures.items():
+            deadline = start + timeouts.get(name, timeout)
+            hardware.wait_futures([future], max(deadline - hardware.monotonic(), 0.0))
+            results.append(_result(name, future, unfinished))
+    else:
+        for name, function in checks.items():
+            future = worker_pool.submit(_timed_check, function)
+            hardware.wait_futures([future], timeouts.get(name, timeout))
+            results.append(_result(name, future, unfinished))
+    return PostReport(results, hardware.monotonic() - start, tuple(unfinished))
+
+
+def _result(name, future, unfinished):
+    if not future.done():
+        unfinished.append(future)
+        return CheckResult(name, False, None, "did not finish in time", True)
+    passed, duration, error = future.result()
+    return CheckResult(name, passed, duration, error)
 
 
 def post_core(
@@ -12,7 +128,10 @@ def post_core(
         test_motors,
         test_sensors,
         initial_setup=None,
-        calibration_function=None
+        calibration_function=None,
+        parallel=True,
+        check_timeout=DEFAULT_CHECK_TIMEOUT,
+        save_report=False
 ):
     """
     This function contains the core logic for the power on self test
@@ -21,6 +140,10 @@ def post_core(
     :param test_sensors: A function to test the sensors
     :param initial_setup: An optional function to run one-time initial setup
     :param calibration_function: An optional function to calibrate the robot
+    :param parallel: Runs the servo, motor and sensor tests at the same time. Defaults to True.
+    :param check_timeout: How many seconds each test may take before it is reported as timed out. Defaults to 10.
+    :param save_report: Stores the last POST report in the robot's properties as "post.last_report". Defaults to
+        False.
     """
     if initial_setup:
         print("Running initial setup.")
@@ -28,28 +151,41 @@ def post_core(
         print("Initial setup complete.")
     msleep(1500)
 
-    while not push_button():
+    report = PostReport([], 0.0)
+    # The button pressed while checks that timed out were still running, which goes ahead if it is pressed again
+    override = None
+    while not inputs.is_pressed("push"):
 
         print("Press 'A' to run the robot.\nPress 'B' to re-run the POST\nPress 'C' to calibrate drive distances.")
-        a, b, c = a_button(), b_button(), c_button()
-        while not (a or b or c or push_button()):
-            a, b, c = a_button(), b_button(), c_button()
-        while a_button() or b_button() or c_button():
-            pass
+        pressed = inputs.wait_for_press("a", "b", "c", "push")
+        inputs.wait_for_release("a", "b", "c")
+        # Checks that timed out may still be driving motors, which must not overlap with the run or a calibration
+        if pressed != override and not report.wait(0):
+            print("Waiting for the checks that timed out to finish...")
+            if not report.wait(check_timeout):
+                print(f"Warning, {sum(not future.done() for future in report.unfinished)} check(s) are still running "
+                      f"and may move the robot. Press the same button again to go ahead anyway.")
+                override = pressed
+                inputs.wait_for_release("push")
+                continue
+        override = None
+        a, b, c = pressed == "a", pressed == "b", pressed == "c"
         if a:
             break
         elif b:
-            try:
-                # Reads the straight_drive_distance_proportion from straight.txt if straight.txt exists.
-                with open(os.path.expanduser("~/straight.txt"), "r") as straight_file:
-                    print("Testing servos.")
-                    test_servos()
-                    print("Testing motors.")
-                    test_motors()
-                    print("Testing sensors.")
-                    test_sensors()
-                    print("POST complete.")
-            except FileNotFoundError:
+            # The drive distance calibration must exist before the robot can run
+            if os.path.exists(gyro_movements.controller.straight_path):
+                print("Testing servos, motors and sensors.")
+                still_running = tuple(future for future in report.unfinished if not future.done())
+                report = run_checks({"servos": test_servos, "motors": test_motors, "sensors": test_sensors},
+                                    check_timeout, parallel=parallel)
+                # Keeps waiting for checks from an earlier POST that were overridden
+                report = report._replace(unfinished=still_running + report.unfinished)
+                report.report()
+                if save_report:
+                    from common.core.robot_id import Robot
+                    Robot.store("post.last_report", report.as_dict())
+            else:
                 print("Aborting POST, straight.txt was not found.")
             print("Press 'A' to run the robot.\nPress 'B' to re-run the POST\nPress 'C' to calibrate drive distances.")
         elif c:
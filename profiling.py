@@ -0,0 +1,177 @@
+"""
+Provides opt-in, named timing hooks for the control loops, kept in fixed-size histograms
+
+Usage:
+    profiling.enable()
+    straight_drive_distance(80, 24)
+    profiling.report()
+    ...
+    profiling.profiler.summary()["straight_drive.condition"].p99
+"""
+from array import array
+from functools import wraps
+from math import log2
+from threading import Lock
+from time import perf_counter
+from typing import NamedTuple, Optional
+
+# Bucket edges grow by a factor of 2 ** (1 / BUCKETS_PER_OCTAVE), about 9%, from MIN_TIME to MIN_TIME * 2 ** OCTAVES
+MIN_TIME = 1e-6
+BUCKETS_PER_OCTAVE = 8
+OCTAVES = 24
+BUCKETS = BUCKETS_PER_OCTAVE * OCTAVES + 1
+
+
+class SectionSummary(NamedTuple):
+    count: int
+    mean: float
+    p50: float
+    p99: float
+    max: float
+
+
+class Histogram:
+    """
+    Counts durations in logarithmic buckets. It never grows, so recording a duration does not allocate.
+    """
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = array("L", bytes(array("L").itemsize * BUCKETS))
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds <= MIN_TIME:
+            index = 0
+        else:
+            index = min(int(log2(seconds / MIN_TIME) * BUCKETS_PER_OCTAVE) + 1, BUCKETS - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        """
+        Returns the upper edge of the bucket that holds the given percentile, in seconds
+        """
+        if not self.count:
+            return 0.0
+        rank = percent / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(MIN_TIME * 2 ** (index / BUCKETS_PER_OCTAVE), self.max)
+        return self.max
+
+    def summary(self):
+        return SectionSummary(self.count, self.total / self.count if self.count else 0.0, self.percentile(50),
+                              self.percentile(99), self.max)
+
+
+class Profiler:
+    """
+    Keeps one histogram per named section. Sections are usually timed by the thread that owns them, so adding to a
+    histogram is not locked.
+    """
+
+    def __init__(self):
+        self.sections = {}
+        self._lock = Lock()
+
+    def histogram(self, name):
+        histogram = self.sections.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.sections.setdefault(name, Histogram())
+        return histogram
+
+    @staticmethod
+    def start():
+        """
+        Returns the current time, to be passed to lap()
+        """
+        return perf_counter()
+
+    def lap(self, name, start):
+        """
+        Records the time since start in a section and returns the current time, so consecutive sections can be timed
+        with one call each
+        """
+        now = perf_counter()
+        self.histogram(name).add(now - start)
+        return now
+
+    def record(self, name, seconds):
+        """
+        Records a duration measured elsewhere, such as a loop period
+        """
+        self.histogram(name).add(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.sections = {}
+
+    def summary(self):
+        """
+        Returns a dictionary of section names to SectionSummary tuples, in seconds
+        """
+        return {name: histogram.summary() for name, histogram in sorted(self.sections.items())}
+
+    def report(self):
+        """
+        Prints the count and the mean, median, 99th percentile and largest duration of every section
+        """
+        print(f"{'section':<36} {'count':>8} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for name, section in self.summary().items():
+            print(f"{name:<36} {section.count:8d} {section.mean * 1000:9.3f} {section.p50 * 1000:9.3f} "
+                  f"{section.p99 * 1000:9.3f} {section.max * 1000:9.3f}")
+
+
+profiler: Optional[Profiler] = None
+
+
+def enable():
+    """
+    Starts timing the instrumented sections and returns the profiler
+    """
+    global profiler
+    profiler = Profiler()
+    return profiler
+
+
+def disable():
+    """
+    Stops timing and returns the profiler so it can still be queried
+    """
+    global profiler
+    stopped = profiler
+    profiler = None
+    return stopped
+
+
+def report():
+    """
+    Prints the current profiler's sections, if profiling is enabled
+    """
+    if profiler is not None:
+        profiler.report()
+
+
+def timed(name, function):
+    """
+    Returns a wrapper around function that records how long each call takes in the named section
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if profiler is not None:
+                profiler.record(name, perf_counter() - start)
+
+    return wrapper
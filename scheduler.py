@@ -0,0 +1,115 @@
+"""
+Provides a fixed-rate loop scheduler for control loops
+"""
+from common import profiling
+from common import hardware
+
+DEFAULT_RATE_HZ = 200
+
+
+class LoopScheduler:
+    """
+    Paces a control loop against absolute deadlines so that the period does not drift with the cost of each iteration.
+    Deadlines use hardware.monotonic(), the clock of the current hardware backend: time.monotonic() on the robot, the
+    same clock the asyncio event loop uses, and the virtual clock in a simulation. Blocking and async loops share one
+    timing source either way.
+
+    Usage:
+        scheduler = LoopScheduler(200)
+        while running:
+            dt = scheduler.wait()
+            ...
+    """
+
+    def __init__(self, rate_hz=DEFAULT_RATE_HZ, name="loop", report_overruns=False):
+        """
+        :param rate_hz: The number of iterations per second the loop should run at.
+
+        :param name: The name of the loop, used when reporting overruns and as the profiling section of its period,
+            "<name>.period".
+
+        :param report_overruns: Prints a message every time an iteration misses its deadline. Defaults to False.
+        """
+        if rate_hz <= 0:
+            raise ValueError(f"Loop rate must be positive, got {rate_hz}")
+        self.rate_hz = rate_hz
+        self.period = 1.0 / rate_hz
+        self.name = name
+        self._period_section = f"{name}.period"
+        self.report_overruns = report_overruns
+        self.start_time = None
+        self.next_deadline = None
+        self.last_tick = None
+        self.iterations = 0
+        self.overruns = 0
+        self.max_lateness = 0.0
+
+    def start(self):
+        """
+        Starts (or restarts) the schedule from the current time and returns that time
+        """
+        self.start_time = self.last_tick = hardware.monotonic()
+        self.next_deadline = self.start_time + self.period
+        self.iterations = 0
+        self.overruns = 0
+        self.max_lateness = 0.0
+        return self.start_time
+
+    def elapsed(self):
+        """
+        Returns the number of seconds since the schedule was started
+        """
+        return hardware.monotonic() - self.start_time
+
+    def wait(self):
+        """
+        Sleeps until the next deadline and returns the number of seconds since the previous tick.
+
+        If the deadline has already passed, the overrun is recorded and the schedule skips ahead to the next deadline
+        in the future instead of trying to catch up with back-to-back iterations.
+        """
+        remaining = self._due()
+        if remaining > 0:
+            hardware.sleep(remaining)
+        return self._tick()
+
+    async def wait_async(self):
+        """
+        The same as wait(), but yields to the asyncio event loop instead of blocking the thread
+        """
+        remaining = self._due()
+        if remaining > 0:
+            await hardware.async_sleep(remaining)
+        return self._tick()
+
+    def _due(self):
+        if self.next_deadline is None:
+            self.start()
+        remaining = self.next_deadline - hardware.monotonic()
+        if remaining > 0:
+            self.next_deadline += self.period
+            return remaining
+        lateness = -remaining
+        self.overruns += 1
+        self.max_lateness = max(self.max_lateness, lateness)
+        if self.report_overruns:
+            print(f"{self.name} overran its {self.period * 1000:.1f} ms period by {lateness * 1000:.1f} ms")
+        missed = int(lateness // self.period) + 1
+        self.next_deadline += missed * self.period
+        return 0.0
+
+    def _tick(self):
+        now = hardware.monotonic()
+        dt = now - self.last_tick
+        self.last_tick = now
+        self.iterations += 1
+        if profiling.profiler is not None:
+            profiling.profiler.record(self._period_section, dt)
+        return dt
+
+    def report(self):
+        """
+        Prints a summary of the loop timing
+        """
+        print(f"{self.name}: {self.iterations} iterations at {self.rate_hz} Hz, {self.overruns} overruns, "
+              f"max lateness {self.max_lateness * 1000:.1f} ms")
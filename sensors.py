@@ -0,0 +1,172 @@
+"""
+Provides a per-tick sensor snapshot layer so that each control loop iteration reads every sensor at most once
+"""
+from typing import NamedTuple, Optional, Callable, Tuple, Dict
+from common import hardware
+
+
+class SensorSnapshot(NamedTuple):
+    """
+    An immutable set of sensor readings taken at the same control tick. Read it through the methods, which count the
+    lookups for the hub's statistics. motor_positions is None unless something subscribed to the motor positions.
+    """
+    hub: "SensorHub"
+    time: float
+    gyro: Optional[float]
+    motor_positions: Optional[Tuple[int, int]]
+    analogs: Dict[int, int]
+    digitals: Dict[int, bool]
+
+    def analog(self, port):
+        """
+        Returns the analog value read for the port this tick, reading the hardware if the port is not subscribed
+        """
+        self.hub.lookups += 1
+        try:
+            return self.analogs[port]
+        except KeyError:
+            self.hub.misses += 1
+            return hardware.analog(port)
+
+    def digital(self, port):
+        """
+        Returns the digital value read for the port this tick, reading the hardware if the port is not subscribed
+        """
+        self.hub.lookups += 1
+        try:
+            return self.digitals[port]
+        except KeyError:
+            self.hub.misses += 1
+            return hardware.digital(port)
+
+    def gyroscope(self):
+        """
+        Returns the gyroscope value read this tick
+        """
+        self.hub.lookups += 1
+        return self.gyro
+
+    def positions(self):
+        """
+        Returns the left and right motor positions read this tick, reading the motors if they are not subscribed
+        """
+        self.hub.lookups += 1
+        if self.motor_positions is None:
+            self.hub.misses += 1
+            return self.hub.motor_positions_function()
+        return self.motor_positions
+
+    def left_position(self):
+        return self.positions()[0]
+
+    def right_position(self):
+        return self.positions()[1]
+
+    def total_position(self):
+        """
+        Returns the sum of the left and right motor positions
+        """
+        left, right = self.positions()
+        return left + right
+
+
+class SensorHub:
+    """
+    Reads every subscribed sensor once per call to tick() and publishes the readings as a SensorSnapshot. Conditions and
+    controllers read from hub.current instead of calling kipr directly, so every decision in a tick uses the same data.
+    """
+
+    def __init__(self, gyro_function: Optional[Callable[[], float]] = None,
+                 motor_positions_function: Optional[Callable[[], Tuple[int, int]]] = None):
+        """
+        :param gyro_function: A function that returns the gyroscope value, or None to skip reading the gyroscope.
+
+        :param motor_positions_function: A function that returns a tuple of the left and right motor positions. They
+            are only read every tick while something has subscribed with subscribe_motor_positions().
+        """
+        self.gyro_function = gyro_function
+        self.motor_positions_function = motor_positions_function
+        self.motor_position_subscribers = 0
+        self.analog_ports = []
+        self.digital_ports = []
+        self.current: Optional[SensorSnapshot] = None
+        self.ticks = 0
+        self.hardware_reads = 0
+        self.lookups = 0
+        self.misses = 0
+
+    def subscribe_analog(self, *ports):
+        """
+        Reads the given analog ports every tick
+        """
+        for port in ports:
+            if port not in self.analog_ports:
+                self.analog_ports.append(port)
+
+    def subscribe_digital(self, *ports):
+        """
+        Reads the given digital ports every tick
+        """
+        for port in ports:
+            if port not in self.digital_ports:
+                self.digital_ports.append(port)
+
+    def subscribe_motor_positions(self):
+        """
+        Reads the motor positions every tick until a matching call to unsubscribe_motor_positions()
+        """
+        self.motor_position_subscribers += 1
+
+    def unsubscribe_motor_positions(self):
+        self.motor_position_subscribers = max(self.motor_position_subscribers - 1, 0)
+
+    def unsubscribe(self, analog_ports=(), digital_ports=()):
+        """
+        Stops reading the given analog and digital ports
+        """
+        self.analog_ports = [port for port in self.analog_ports if port not in analog_ports]
+        self.digital_ports = [port for port in self.digital_ports if port not in digital_ports]
+
+    def tick(self):
+        """
+        Reads every subscribed sensor once and returns the new snapshot
+        """
+        reads = len(self.analog_ports) + len(self.digital_ports)
+        gyro = motor_positions = None
+        if self.gyro_function:
+            gyro = self.gyro_function()
+            reads += 1
+        if self.motor_positions_function and self.motor_position_subscribers:
+            motor_positions = self.motor_positions_function()
+            reads += 2
+        self.current = SensorSnapshot(
+            self,
+            hardware.monotonic(),
+            gyro,
+            motor_positions,
+            {port: hardware.analog(port) for port in self.analog_ports},
+            {port: hardware.digital(port) for port in self.digital_ports},
+        )
+        self.ticks += 1
+        self.hardware_reads += reads
+        return self.current
+
+    @property
+    def avoided_reads(self):
+        """
+        The number of snapshot lookups that were answered without calling the hardware again
+        """
+        return self.lookups - self.misses
+
+    def reset_statistics(self):
+        self.ticks = 0
+        self.hardware_reads = 0
+        self.lookups = 0
+        self.misses = 0
+
+    def report(self):
+        """
+        Prints how many hardware reads the snapshots have avoided
+        """
+        print(f"Sensor hub: {self.ticks} ticks, {self.hardware_reads} hardware reads, {self.lookups} lookups, "
+              f"{self.misses} unsubscribed reads, {self.avoided_reads} reads avoided")
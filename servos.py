@@ -0,0 +1,274 @@
+"""
+Provides a servo engine that moves any number of servos at the same time from one background thread, so arm and claw
+motions can overlap with driving
+
+Usage:
+    class Servos(ServoEnum):
+        CLAW_OPEN = 300
+        CLAW_CLOSED = 1500
+
+        @property
+        def port(self):
+            return 0
+
+    done = servo_engine.move(Servos.CLAW_CLOSED, velocity=800, easing=ease_in_out)
+    straight_drive_distance(80, 24)
+    done.result()
+"""
+from concurrent.futures import Future
+from threading import Condition
+from typing import Callable, Dict, List, NamedTuple, Optional
+from common import hardware, profiling
+from common.core.enums import ServoEnum
+from common.scheduler import LoopScheduler
+
+DEFAULT_SERVO_RATE_HZ = 50
+# Servo positions range from 0 to 2047
+MIN_SERVO_POSITION = 0
+MAX_SERVO_POSITION = 2047
+
+
+def linear(fraction):
+    return fraction
+
+
+def ease_in(fraction):
+    return fraction * fraction
+
+
+def ease_out(fraction):
+    return fraction * (2.0 - fraction)
+
+
+def ease_in_out(fraction):
+    return fraction * fraction * (3.0 - 2.0 * fraction)
+
+
+# The steepest slope of each easing function, so that velocity limits hold at the fastest point of a move
+_peak_slopes: Dict[Callable[[float], float], float] = {linear: 1.0, ease_in: 2.0, ease_out: 2.0, ease_in_out: 1.5}
+
+
+def _peak_slope(easing):
+    try:
+        return _peak_slopes[easing]
+    except KeyError:
+        steps = 200
+        slope = max(abs(easing((x + 1) / steps) - easing(x / steps)) * steps for x in range(steps))
+        _peak_slopes[easing] = slope
+        return slope
+
+
+class _ServoMove(NamedTuple):
+    start: int
+    target: int
+    started_at: float
+    duration: float
+    easing: Callable[[float], float]
+    future: Future
+
+
+class _ServoState:
+    __slots__ = ("port", "position", "velocity", "easing", "move")
+
+    def __init__(self, port, position, velocity, easing):
+        self.port = port
+        self.position = position
+        self.velocity = velocity
+        self.easing = easing
+        self.move: Optional[_ServoMove] = None
+
+
+class ServoEngine:
+    """
+    Moves servos towards their targets from a single fixed-rate thread, which only runs while a servo is moving.
+
+    Each move is limited to a velocity in servo ticks per second and follows an easing function, which maps the
+    fraction of the move's time that has passed to the fraction of the distance covered. A new target for a servo that
+    is still moving replaces the old one: the servo turns around from where it is, and the old move's Future completes
+    when the servo reaches the new target.
+    """
+
+    def __init__(self, rate_hz=DEFAULT_SERVO_RATE_HZ, velocity=None, easing=linear):
+        """
+        :param rate_hz: The number of times per second moving servos are updated. Defaults to 50, the rate at which
+            servos read their position.
+
+        :param velocity: The default velocity limit in servo ticks per second. Defaults to None, which moves servos
+            to their targets at once.
+
+        :param easing: The default easing function. Defaults to linear.
+        """
+        self.rate_hz = rate_hz
+        self.velocity = velocity
+        self.easing = easing
+        self._servos: Dict[int, _ServoState] = {}
+        self._condition = Condition()
+        self._moving = 0
+        self.running = False
+        self.thread = None
+
+    def configure(self, port, velocity=None, easing=None):
+        """
+        Sets the velocity limit, in servo ticks per second, and the easing function used for a servo's moves when the
+        move does not give its own
+        """
+        with self._condition:
+            servo = self._servo(port)
+            if velocity is not None:
+                servo.velocity = velocity
+            if easing is not None:
+                servo.easing = easing
+
+    def move(self, target: ServoEnum, velocity=None, easing=None, duration=None) -> Future:
+        """
+        Starts moving a servo to a ServoEnum position and returns a Future that completes with the position once the
+        servo gets there
+
+        :param target: A ServoEnum member, which gives the port and the position.
+
+        :param velocity: The velocity limit in servo ticks per second. Defaults to the servo's limit.
+
+        :param easing: The easing function. Defaults to the servo's easing function.
+
+        :param duration: The shortest time the move should take, in seconds. The move takes longer if the velocity
+            limit requires it.
+        """
+        return self.move_to(target.port, target.value, velocity, easing, duration)
+
+    def move_all(self, targets: List[ServoEnum], velocity=None, easing=None, duration=None) -> List[Future]:
+        """
+        Starts moving several servos at once. Returns a Future for each target, see move().
+        """
+        return [self.move(target, velocity, easing, duration) for target in targets]
+
+    def move_to(self, port, position, velocity=None, easing=None, duration=None) -> Future:
+        """
+        The same as move(), but takes a port and a position instead of a ServoEnum member
+        """
+        position = max(MIN_SERVO_POSITION, min(MAX_SERVO_POSITION, int(position)))
+        with self._condition:
+            servo = self._servo(port)
+            move = servo.move
+            if move is not None and move.target == position:
+                return move.future
+            easing = easing or servo.easing
+            velocity = velocity or servo.velocity
+            distance = abs(position - servo.position)
+            minimum = distance * _peak_slope(easing) / velocity if velocity else 0.0
+            servo.move = _ServoMove(servo.position, position, hardware.monotonic(), max(duration or 0.0, minimum),
+                                    easing, move.future if move is not None else Future())
+            if move is None:
+                self._moving += 1
+                self._condition.notify()
+            future = servo.move.future
+        self.start()
+        return future
+
+    def halt(self, port):
+        """
+        Stops a servo where it is and cancels its move
+        """
+        with self._condition:
+            servo = self._servos.get(port)
+            move = servo.move if servo else None
+            if move is None:
+                return
+            servo.move = None
+            self._moving -= 1
+        move.future.cancel()
+
+    def position(self, port):
+        """
+        Returns the position the servo was last sent to
+        """
+        with self._condition:
+            return self._servo(port).position
+
+    def moving(self, port):
+        """
+        Returns True if the servo on the given port is moving
+        """
+        servo = self._servos.get(port)
+        return servo is not None and servo.move is not None
+
+    def wait(self, timeout=None):
+        """
+        Waits until every servo has stopped moving. Returns False if the timeout expired first.
+        """
+        with self._condition:
+            futures = [servo.move.future for servo in self._servos.values() if servo.move is not None]
+        return not hardware.wait_futures(futures, timeout).not_done
+
+    def _servo(self, port):
+        # Must be called while holding self._condition
+        servo = self._servos.get(port)
+        if servo is None:
+            servo = _ServoState(port, hardware.get_servo_position(port), self.velocity, self.easing)
+            self._servos[port] = servo
+            hardware.enable_servo(port)
+        return servo
+
+    def start(self):
+        """
+        Starts the servo thread if it is not already running
+        """
+        with self._condition:
+            if self.running:
+                return
+            self.running = True
+            self.thread = hardware.start_thread(self._run, "servo_engine")
+
+    def stop(self):
+        """
+        Halts every servo, stops the servo thread and waits for it to finish
+        """
+        for port in list(self._servos):
+            self.halt(port)
+        with self._condition:
+            self.running = False
+            thread = self.thread
+            self.thread = None
+            self._condition.notify()
+        if thread:
+            hardware.join(thread)
+
+    def _run(self):
+        scheduler = LoopScheduler(self.rate_hz, "servo_engine")
+        while self.running:
+            if not self._moving:
+                # Sleeps until a servo starts moving instead of ticking while idle
+                hardware.wait_for(self._condition, lambda: self._moving or not self.running)
+                scheduler.start()
+                continue
+            self._move_servos()
+            scheduler.wait()
+
+    def _move_servos(self):
+        profiler = profiling.profiler
+        if profiler is not None:
+            mark = profiler.start()
+        finished = []
+        now = hardware.monotonic()
+        with self._condition:
+            for servo in self._servos.values():
+                move = servo.move
+                if move is None:
+                    continue
+                fraction = min((now - move.started_at) / move.duration, 1.0) if move.duration > 0 else 1.0
+                position = int(round(move.start + (move.target - move.start) * move.easing(fraction)))
+                if position != servo.position:
+                    hardware.set_servo_position(servo.port, position)
+                    servo.position = position
+                if fraction >= 1.0:
+                    servo.move = None
+                    self._moving -= 1
+                    finished.append(move)
+        # Completed outside the lock, since callbacks may start new moves
+        for move in finished:
+            if move.future.set_running_or_notify_cancel():
+                move.future.set_result(move.target)
+        if profiler is not None:
+            profiler.lap("servo_engine.update", mark)
+
+
+servo_engine = ServoEngine()
@@ -0,0 +1,493 @@
+"""
+Provides a deterministic simulated robot and a virtual clock, so routines can run without a robot and much faster than
+real time, for example in regression tests.
+
+Usage:
+    sim = simulation.start(seed=1)
+    sim.press("push", at=2.0)
+    sim.start_light(port=0, on_at=5.0)
+    gyro_init(sim.drive, sim.stop, sim.get_motor_positions, sim.push_sensor)
+    wait_4_light(0)
+    straight_drive_distance(80, 24)
+    print(sim.robot.x, sim.robot.y, sim.robot.heading)
+    simulation.stop()
+
+Threads take turns on the virtual clock: only one thread runs at a time, and time only moves forward when every thread
+that uses the clock is sleeping, so a run with the same seed always produces the same result.
+"""
+import heapq
+import os
+import shutil
+import tempfile
+from concurrent.futures import wait
+from itertools import count
+from math import cos, sin, radians, degrees
+from random import Random
+from threading import Condition, Lock, Thread, current_thread
+from time import perf_counter
+from typing import Callable, Dict
+from common import hardware
+from common import gyro_movements
+from common.calibration_store import CalibrationStore
+from common.drive_controller import DriveController
+from common.inputs import inputs
+from common.multitasker import motor_engine
+from common.servos import servo_engine
+
+# Real seconds a sleeping thread waits before checking for threads that exited without telling the clock
+STALL_CHECK = 0.05
+# Real seconds without any progress before the clock reports which threads are holding it
+STALL_WARNING = 5.0
+
+# The controller and files that start() replaced, restored by stop()
+_real_controller = None
+_directory = None
+
+
+class VirtualClock:
+    """
+    A clock that jumps straight to the next deadline instead of waiting for it. The thread that creates the clock uses
+    it from the start; other threads use it once they sleep on it or are started with start_thread().
+    """
+
+    def __init__(self, start=0.0, poll_interval=0.001):
+        """
+        :param start: The initial time in seconds.
+
+        :param poll_interval: How often, in virtual seconds, waits on events, conditions and threads check again.
+        """
+        self.now = start
+        self.poll_interval = poll_interval
+        self._lock = Lock()
+        self._sleepers = []
+        self._order = count()
+        self._running = {current_thread()}
+        self._hand_offs = 0
+        self._listeners = []
+        self.wakeups = 0
+
+    def monotonic(self):
+        return self.now
+
+    def add_listener(self, listener: Callable[[float, float], None]):
+        """
+        Calls listener with the old and the new time every time the clock moves forward, before any thread wakes
+        """
+        self._listeners.append(listener)
+
+    def sleep(self, seconds):
+        me = current_thread()
+        with self._lock:
+            woken = Condition(self._lock)
+            entry = [self.now + max(seconds, 0.0), next(self._order), me, woken, False]
+            heapq.heappush(self._sleepers, entry)
+            self._running.discard(me)
+            self._advance()
+            stalled = perf_counter()
+            while not entry[4]:
+                if not woken.wait(STALL_CHECK):
+                    self._advance()
+                    if perf_counter() - stalled > STALL_WARNING:
+                        print(f"Virtual clock stalled at {self.now:.3f} s, waiting for "
+                              f"{', '.join(thread.name for thread in self._running) or 'hand-offs'}")
+                        stalled = perf_counter()
+
+    def msleep(self, milliseconds):
+        self.sleep(milliseconds / 1000)
+
+    async def async_sleep(self, seconds):
+        # Blocks the event loop thread on the virtual clock, then yields, so coroutines take turns approximately
+        import asyncio
+        self.sleep(seconds)
+        await asyncio.sleep(0)
+
+    def start_thread(self, target, name=None):
+        """
+        Starts a daemon thread that uses the clock from its first instruction
+        """
+        def run():
+            try:
+                target()
+            finally:
+                self.release()
+
+        thread = Thread(target=run, name=name, daemon=True)
+        with self._lock:
+            self._running.add(thread)
+        thread.start()
+        return thread
+
+    def hand_off(self):
+        with self._lock:
+            self._hand_offs += 1
+
+    def take_over(self):
+        with self._lock:
+            self._running.add(current_thread())
+            self._hand_offs = max(self._hand_offs - 1, 0)
+
+    def release(self):
+        with self._lock:
+            self._running.discard(current_thread())
+            self._advance()
+
+    def _poll(self, predicate, timeout):
+        deadline = None if timeout is None else self.now + timeout
+        while True:
+            result = predicate()
+            if result or (deadline is not None and self.now >= deadline):
+                return result
+            self.sleep(self.poll_interval if deadline is None else min(self.poll_interval, deadline - self.now))
+
+    def wait_event(self, event, timeout=None):
+        return self._poll(event.is_set, timeout)
+
+    def wait_for(self, condition, predicate, timeout=None):
+        def check():
+            with condition:
+                return predicate()
+
+        return self._poll(check, timeout)
+
+    def wait_futures(self, futures, timeout=None):
+        self._poll(lambda: all(future.done() for future in futures), timeout)
+        # Returns the same done and not done sets as concurrent.futures.wait()
+        return wait(futures, 0)
+
+    def join(self, thread, timeout=None):
+        self._poll(lambda: not thread.is_alive(), timeout)
+
+    def _advance(self):
+        # Must be called while holding self._lock. Wakes the next sleeper once no other thread is running.
+        if self._hand_offs:
+            return
+        if self._running:
+            self._running = {thread for thread in self._running if thread.is_alive()}
+            if self._running:
+                return
+        if not self._sleepers:
+            return
+        entry = heapq.heappop(self._sleepers)
+        deadline, order, thread, woken = entry[:4]
+        if deadline > self.now:
+            for listener in self._listeners:
+                listener(self.now, deadline)
+            self.now = deadline
+        entry[4] = True
+        self._running.add(thread)
+        self.wakeups += 1
+        woken.notify()
+
+
+class SimulatedRobot:
+    """
+    A differential drive robot. Each motor approaches the speed set by its power with a first order lag, the wheels
+    move the robot, and the gyroscope reports the turn rate with a bias and noise. Headings are counterclockwise in
+    degrees, and a clockwise turn reads as a positive gyroscope value, which is what straight_drive corrects for.
+    """
+
+    def __init__(self, left_port=0, right_port=3, ticks_per_inch=90.0, track_width=6.0, full_speed=20.0,
+                 time_constant=0.08, left_gain=1.0, right_gain=0.98, gyro_scale=8.0, gyro_bias=3.0, gyro_noise=1.0,
+                 motor_ticks_per_second=1500.0, seed=0):
+        """
+        :param left_port: The motor port of the left wheel.
+
+        :param right_port: The motor port of the right wheel.
+
+        :param ticks_per_inch: Encoder ticks per inch of travel of each wheel.
+
+        :param track_width: The distance between the wheels in inches.
+
+        :param full_speed: How fast a wheel moves at power 100, in inches per second.
+
+        :param time_constant: How many seconds a motor takes to reach about two thirds of a new speed.
+
+        :param left_gain: Scales the speed of the left wheel, to model mismatched motors.
+
+        :param right_gain: Scales the speed of the right wheel.
+
+        :param gyro_scale: Gyroscope units per degree per second.
+
+        :param gyro_bias: The gyroscope reading while the robot is still.
+
+        :param gyro_noise: The standard deviation of the gyroscope noise.
+
+        :param motor_ticks_per_second: How fast motors on other ports turn at power 100, in ticks per second.
+
+        :param seed: Seeds the noise, so runs can be repeated exactly.
+        """
+        self.left_port = left_port
+        self.right_port = right_port
+        self.ticks_per_inch = ticks_per_inch
+        self.track_width = track_width
+        self.full_speed = full_speed
+        self.time_constant = time_constant
+        self.gains = {left_port: left_gain, right_port: right_gain}
+        self.gyro_scale = gyro_scale
+        self.gyro_bias = gyro_bias
+        self.gyro_noise = gyro_noise
+        self.motor_ticks_per_second = motor_ticks_per_second
+        self.random = Random(seed)
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        self.powers: Dict[int, int] = {}
+        self.braking = set()
+        # Motor speeds in ticks per second and positions in ticks, by port
+        self.speeds: Dict[int, float] = {}
+        self.positions: Dict[int, float] = {}
+
+    def _target_speed(self, port):
+        power = self.powers.get(port, 0)
+        if port in self.gains:
+            return power / 100 * self.full_speed * self.ticks_per_inch * self.gains[port]
+        return power / 100 * self.motor_ticks_per_second
+
+    def motor_power(self, port, power):
+        self.powers[port] = max(min(int(power), 100), -100)
+        self.braking.discard(port)
+
+    def freeze(self, port):
+        # Freezing actively brakes, so the motor stops several times faster than it speeds up
+        self.powers[port] = 0
+        self.braking.add(port)
+
+    def position(self, port):
+        return int(self.positions.get(port, 0.0))
+
+    def turn_rate(self):
+        """
+        Returns the counterclockwise turn rate in degrees per second
+        """
+        left = self.speeds.get(self.left_port, 0.0) / self.ticks_per_inch
+        right = self.speeds.get(self.right_port, 0.0) / self.ticks_per_inch
+        return degrees((right - left) / self.track_width)
+
+    def gyro_z(self):
+        return int(round(-self.turn_rate() * self.gyro_scale + self.gyro_bias + self.random.gauss(0, self.gyro_noise)))
+
+    def step(self, dt):
+        """
+        Moves the simulation forward by dt seconds
+        """
+        blend = dt / (self.time_constant + dt)
+        braking_blend = dt / (self.time_constant / 4 + dt)
+        for port in set(self.powers) | set(self.speeds):
+            speed = self.speeds.get(port, 0.0)
+            speed += (self._target_speed(port) - speed) * (braking_blend if port in self.braking else blend)
+            self.speeds[port] = speed
+            self.positions[port] = self.positions.get(port, 0.0) + speed * dt
+        left = self.speeds.get(self.left_port, 0.0) / self.ticks_per_inch
+        right = self.speeds.get(self.right_port, 0.0) / self.ticks_per_inch
+        turn = (right - left) / self.track_width
+        middle = radians(self.heading) + turn * dt / 2
+        distance = (left + right) / 2 * dt
+        self.x += distance * cos(middle)
+        self.y += distance * sin(middle)
+        self.heading += degrees(turn * dt)
+
+
+class SimulatedBackend:
+    """
+    A hardware backend that runs a SimulatedRobot on a VirtualClock. Analog and digital ports, the buttons and a start
+    light can be set directly or scripted to change at given times.
+    """
+
+    def __init__(self, robot=None, clock=None, seed=0, step=0.001, analog_noise=5.0, push_port=0):
+        """
+        :param robot: The SimulatedRobot. Defaults to one with the default settings and the same seed.
+
+        :param clock: The VirtualClock. Defaults to a new clock, so the calling thread becomes its first user.
+
+        :param seed: Seeds the sensor noise.
+
+        :param step: The longest physics step, in seconds.
+
+        :param analog_noise: The standard deviation of the analog sensor noise.
+
+        :param push_port: The digital port of the push sensor returned by push_sensor().
+        """
+        self.robot = robot or SimulatedRobot(seed=seed)
+        self.clock = clock or VirtualClock()
+        self.step = step
+        self.analog_noise = analog_noise
+        self.push_port = push_port
+        self.random = Random(seed + 1)
+        self.analogs: Dict[int, Callable[[float], float]] = {}
+        self.digitals: Dict[int, bool] = {}
+        self.buttons = {"push": False, "a": False, "b": False, "c": False}
+        # Commanded servo positions, which the simulated servos reach immediately once enabled
+        self.servos: Dict[int, int] = {}
+        self.enabled_servos = set()
+        self.console = []
+        self._events = []
+        self._order = count()
+        self.clock.add_listener(self._advance)
+        for name in ("monotonic", "sleep", "msleep", "async_sleep", "start_thread", "wait_event", "wait_for",
+                     "wait_futures", "join", "hand_off", "take_over", "release"):
+            setattr(self, name, getattr(self.clock, name))
+
+    def _advance(self, start, end):
+        # Steps the physics up to end, running scripted events at their exact times
+        now = start
+        while now < end:
+            until = min(now + self.step, end)
+            if self._events and self._events[0][0] < until:
+                until = max(self._events[0][0], now)
+            if until > now:
+                self.robot.step(until - now)
+                now = until
+            while self._events and self._events[0][0] <= now:
+                heapq.heappop(self._events)[2]()
+
+    def at(self, time, function):
+        """
+        Calls function, which must not sleep, when the virtual clock reaches time
+        """
+        heapq.heappush(self._events, (time, next(self._order), function))
+
+    def time(self):
+        return self.clock.now
+
+    # Sensors
+
+    def gyro_z(self):
+        return self.robot.gyro_z()
+
+    def set_analog(self, port, value):
+        """
+        Sets an analog port to a constant value, or to a function of the time
+        """
+        self.analogs[port] = value if callable(value) else (lambda now: value)
+
+    def analog(self, port):
+        function = self.analogs.get(port)
+        value = function(self.clock.now) if function else 0
+        return max(0, min(4095, int(round(value + self.random.gauss(0, self.analog_noise)))))
+
+    def set_digital(self, port, value):
+        self.digitals[port] = bool(value)
+
+    def digital(self, port):
+        return int(self.digitals.get(port, False))
+
+    def start_light(self, port, on_at, off_value=3000, on_value=200, rise_time=0.02):
+        """
+        Simulates a start light sensor that reads off_value until on_at and then ramps to on_value over rise_time
+        """
+        def value(now):
+            if now <= on_at:
+                return off_value
+            return off_value + (on_value - off_value) * min((now - on_at) / rise_time, 1.0)
+
+        self.set_analog(port, value)
+
+    def press(self, button, at, duration=0.2):
+        """
+        Presses a button ("push", "a", "b" or "c") at a time and releases it duration seconds later
+        """
+        self.at(at, lambda: self.buttons.__setitem__(button, True))
+        self.at(at + duration, lambda: self.buttons.__setitem__(button, False))
+
+    def push_button(self):
+        return int(self.buttons["push"])
+
+    def a_button(self):
+        return int(self.buttons["a"])
+
+    def b_button(self):
+        return int(self.buttons["b"])
+
+    def c_button(self):
+        return int(self.buttons["c"])
+
+    def console_clear(self):
+        self.console.clear()
+
+    # Motors
+
+    def motor_power(self, port, power):
+        self.robot.motor_power(port, power)
+
+    def get_motor_position_counter(self, port):
+        return self.robot.position(port)
+
+    def freeze(self, port):
+        self.robot.freeze(port)
+
+    # Servos
+
+    def set_servo_position(self, port, position):
+        self.servos[port] = max(0, min(2047, int(position)))
+
+    def get_servo_position(self, port):
+        return self.servos.get(port, 1024)
+
+    def enable_servo(self, port):
+        self.enabled_servos.add(port)
+
+    # Functions for gyro_init
+
+    def drive(self, left_speed, right_speed):
+        self.robot.motor_power(self.robot.left_port, left_speed)
+        self.robot.motor_power(self.robot.right_port, right_speed)
+
+    def stop(self):
+        self.robot.freeze(self.robot.left_port)
+        self.robot.freeze(self.robot.right_port)
+
+    def get_motor_positions(self):
+        return self.robot.position(self.robot.left_port), self.robot.position(self.robot.right_port)
+
+    def push_sensor(self):
+        return bool(self.digital(self.push_port))
+
+
+def start(seed=0, **robot_settings):
+    """
+    Creates a simulated robot on a new virtual clock, installs it as the hardware backend and returns the backend.
+
+    gyro_movements is switched to a new default controller whose calibration file and straight.txt are in a temporary
+    directory, so the simulation never reads the robot's calibration or overwrites it with simulated values. Other
+    controllers should be made with gyro_movements.controller.copy() to share those files.
+
+    :param seed: Seeds the simulation noise.
+
+    :param robot_settings: Keyword arguments for SimulatedRobot.
+    """
+    global _real_controller, _directory
+    if _directory is not None:
+        stop()
+    _stop_services()
+    _real_controller = gyro_movements.controller
+    _directory = tempfile.mkdtemp(prefix="simulation")
+    store = CalibrationStore(os.path.join(_directory, "calibration.json"), robot="simulation")
+    gyro_movements.use(DriveController(store, os.path.join(_directory, "straight.txt")))
+    return hardware.use(SimulatedBackend(SimulatedRobot(seed=seed, **robot_settings), seed=seed))
+
+
+def _stop_services():
+    # The shared services keep their threads on the clock of the backend they were started on, so they are stopped
+    # with it. Each one starts again on the current backend the next time it is used.
+    inputs.stop()
+    motor_engine.stop()
+    servo_engine.stop()
+
+
+def stop():
+    """
+    Stops the shared input, motor and servo services and the simulated controller's gyro sampler, and switches back to
+    the kipr backend, which is installed again the next time the hardware is used, and to the default controller that
+    was in use before start()
+    """
+    global _real_controller, _directory
+    _stop_services()
+    if _directory is not None:
+        gyro_movements.controller.stop_gyro_sampler()
+    hardware.backend = None
+    for name in hardware.NAMES:
+        vars(hardware).pop(name, None)
+    if _directory is not None:
+        gyro_movements.use(_real_controller)
+        shutil.rmtree(_directory, ignore_errors=True)
+        _real_controller = _directory = None
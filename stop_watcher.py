@@ -0,0 +1,196 @@
+"""
+Provides a stop condition watcher that checks a condition on its own thread, much faster than the steering loop, and
+stops the motors the moment it triggers
+"""
+from threading import Event, Lock
+from typing import Callable, Optional
+from common import hardware, profiling
+from common.scheduler import LoopScheduler
+
+DEFAULT_WATCH_RATE_HZ = 1000
+# The wheels count as stopped once the encoders have moved less than STILL_TICKS for STILL_TIME seconds
+STILL_TICKS = 2
+STILL_TIME = 0.05
+# The longest time the watcher waits for the wheels to stop after triggering, in seconds
+MAX_STOP_TIME = 1.0
+
+
+class StopWatcher:
+    """
+    Watches a condition with the same meaning as a straight_drive condition: the robot may keep moving while
+    condition() returns condition_is. As soon as it does not, the watcher calls stop_function and sets triggered.
+
+    The steering loop sends its drive commands through guard(), which shares a lock with the watcher, so a drive
+    command can never restart the motors after the watcher has stopped them.
+
+    Conditions run on the watcher thread, so they should read the hardware directly instead of the sensor hub, which is
+    only updated once per steering iteration. See the until_* functions below.
+
+    Given the motor positions, the watcher keeps reading the encoders on its thread after it triggers, to measure when
+    the wheels actually stopped and how far they moved after the condition was detected. The measurement is only
+    meaningful if nothing drives the motors again until it is done; measured is set once it is.
+    """
+
+    def __init__(self, condition: Callable[[], bool], stop_function: Callable[[], None],
+                 rate_hz=DEFAULT_WATCH_RATE_HZ, condition_is=True,
+                 get_motor_positions: Optional[Callable[[], tuple]] = None,
+                 on_measured: Optional[Callable[["StopWatcher"], None]] = None):
+        """
+        :param condition: A function that returns a boolean value, checked rate_hz times per second.
+
+        :param stop_function: The function that stops the motors.
+
+        :param rate_hz: The number of times per second the condition is checked. Defaults to 1000.
+
+        :param condition_is: The value of the condition while the robot may keep moving. Defaults to True.
+
+        :param get_motor_positions: An optional function that returns the left and right motor positions, used to
+            measure the stop. Without it latency_ms is None.
+
+        :param on_measured: An optional function that is called with the watcher, on the watcher thread, once the stop
+            has been measured.
+        """
+        self.condition = condition
+        self.stop_function = stop_function
+        self.rate_hz = rate_hz
+        self.condition_is = condition_is
+        self.get_motor_positions = get_motor_positions
+        self.on_measured = on_measured
+        self.triggered = Event()
+        self.measured = Event()
+        self.trigger_time = None
+        self.trigger_position = None
+        self.stopped_time = None
+        self.stopped_position = None
+        self.check_interval = None
+        self.running = False
+        self.thread = None
+        self._lock = Lock()
+
+    @property
+    def latency_ms(self):
+        """
+        The number of milliseconds from the condition changing to the wheels standing still, at most. The condition
+        changed up to one check interval before it was detected, so that interval is included.
+        """
+        if self.trigger_time is None or self.stopped_time is None:
+            return None
+        return (self.stopped_time - self.trigger_time + (self.check_interval or 0.0)) * 1000
+
+    @property
+    def overrun_ticks(self):
+        """
+        The number of motor ticks (left plus right) the wheels moved after the condition was detected
+        """
+        if self.trigger_position is None or self.stopped_position is None:
+            return None
+        return abs(self.stopped_position - self.trigger_position)
+
+    def start(self):
+        """
+        Checks the condition once and starts the watcher thread. Returns the watcher.
+        """
+        self.running = True
+        self._check(None)
+        if not self.triggered.is_set() or self.get_motor_positions is not None:
+            self.thread = hardware.start_thread(self._run, "stop_watcher")
+        return self
+
+    def stop(self):
+        """
+        Stops watching and waits for the thread to finish, unless the watcher has triggered, in which case the thread
+        finishes measuring the stop in the background. Does not stop the motors.
+        """
+        self.running = False
+        thread, self.thread = self.thread, None
+        if thread is not None and not self.triggered.is_set():
+            hardware.join(thread)
+
+    def guard(self, function, *args):
+        """
+        Calls function with args unless the watcher has triggered. Returns False if it has.
+        """
+        with self._lock:
+            if self.triggered.is_set():
+                return False
+            function(*args)
+            return True
+
+    def _run(self):
+        scheduler = LoopScheduler(self.rate_hz, "stop_watcher")
+        scheduler.start()
+        while self.running and not self.triggered.is_set():
+            interval = scheduler.wait()
+            # Not checked again once stop() has been called, so stop() never waits for a measurement
+            if not self.running:
+                return
+            self._check(interval)
+        if self.triggered.is_set() and self.get_motor_positions is not None:
+            self._measure_stop(scheduler)
+            self.measured.set()
+            if self.on_measured is not None:
+                self.on_measured(self)
+
+    def _check(self, interval):
+        if self.condition() == self.condition_is:
+            return
+        detected = hardware.monotonic()
+        position = sum(self.get_motor_positions()) if self.get_motor_positions is not None else None
+        with self._lock:
+            self.stop_function()
+            self.triggered.set()
+        self.trigger_time = detected
+        self.trigger_position = position
+        self.check_interval = interval
+
+    def _measure_stop(self, scheduler):
+        # The wheels stopped when the encoders last moved by more than STILL_TICKS
+        position = moved_position = self.trigger_position
+        now = moved_time = self.trigger_time
+        while now - moved_time < STILL_TIME and now - self.trigger_time < MAX_STOP_TIME:
+            scheduler.wait()
+            position = sum(self.get_motor_positions())
+            now = hardware.monotonic()
+            if abs(position - moved_position) > STILL_TICKS:
+                moved_position, moved_time = position, now
+        self.stopped_position = position
+        self.stopped_time = moved_time
+        if profiling.profiler is not None:
+            profiling.profiler.record("stop_watcher.latency", self.latency_ms / 1000)
+
+
+def until_digital(port):
+    """
+    Returns a condition that is True until the digital sensor on the port is pressed
+    """
+    return lambda: not hardware.digital(port)
+
+
+def until_analog_above(port, threshold):
+    """
+    Returns a condition that is True until the analog sensor on the port reads more than threshold, for example a line
+    sensor reaching a black line
+    """
+    return lambda: hardware.analog(port) <= threshold
+
+
+def until_analog_below(port, threshold):
+    """
+    Returns a condition that is True until the analog sensor on the port reads less than threshold
+    """
+    return lambda: hardware.analog(port) >= threshold
+
+
+def until_ticks(get_motor_positions: Callable[[], tuple], ticks, start: Optional[int] = None):
+    """
+    Returns a condition that is True until the sum of the motor positions has moved by ticks from start, which defaults
+    to the current sum
+    """
+    if start is None:
+        start = sum(get_motor_positions())
+
+    def condition():
+        left, right = get_motor_positions()
+        return abs(left + right - start) < ticks
+
+    return condition
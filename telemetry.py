@@ -0,0 +1,197 @@
+"""
+Provides an opt-in, low overhead recorder for control loop samples with a compact binary trace format
+
+Usage:
+    telemetry.enable()
+    gyro_turn(-80, 80, 90)
+    telemetry.recorder.dump("turn.trace")
+    ...
+    trace = telemetry.load("turn.trace")
+"""
+import struct
+import sys
+from array import array
+from threading import Lock
+from typing import NamedTuple, Optional
+
+SOURCE_SETTLE = 0
+SOURCE_GYRO_TURN = 1
+SOURCE_STRAIGHT_DRIVE = 2
+SOURCE_MOTOR = 3
+SOURCE_NAMES = {
+    SOURCE_SETTLE: "settle",
+    SOURCE_GYRO_TURN: "gyro_turn",
+    SOURCE_STRAIGHT_DRIVE: "straight_drive",
+    SOURCE_MOTOR: "motor",
+}
+
+# Column name and array type code. channel is the motor port for motor samples and 0 otherwise. target is the turn
+# angle for turns, the speed for drives and the target position for motors.
+FIELDS = (
+    ("time", "d"),
+    ("period", "f"),
+    ("source", "B"),
+    ("channel", "B"),
+    ("gyro", "f"),
+    ("heading", "f"),
+    ("left_command", "h"),
+    ("right_command", "h"),
+    ("left_position", "i"),
+    ("right_position", "i"),
+    ("target", "f"),
+)
+
+MAGIC = b"DRST"
+VERSION = 1
+_HEADER = struct.Struct("<4sHBBI")
+_COLUMN = struct.Struct("<16scB")
+
+
+class Sample(NamedTuple):
+    time: float
+    period: float
+    source: int
+    channel: int
+    gyro: float
+    heading: float
+    left_command: int
+    right_command: int
+    left_position: int
+    right_position: int
+    target: float
+
+
+class Recorder:
+    """
+    Records samples into preallocated, array-backed ring buffers, one per column. Recording a sample only stores
+    numbers into existing arrays, so it is cheap enough to leave on during competition runs.
+    """
+
+    def __init__(self, capacity=60000):
+        """
+        :param capacity: The number of samples kept. The oldest samples are overwritten once it is full.
+        """
+        self.capacity = capacity
+        self.columns = [array(code, bytes(array(code).itemsize * capacity)) for name, code in FIELDS]
+        self.count = 0
+        self._lock = Lock()
+
+    def record(self, time, period, source, channel, gyro, heading, left_command, right_command, left_position,
+               right_position, target):
+        """
+        Stores one sample, overwriting the oldest one if the buffer is full. The arguments are in FIELDS order.
+        """
+        (times, periods, sources, channels, gyros, headings, left_commands, right_commands,
+         left_positions, right_positions, targets) = self.columns
+        with self._lock:
+            index = self.count % self.capacity
+            times[index] = time
+            periods[index] = period
+            sources[index] = source
+            channels[index] = channel
+            gyros[index] = gyro
+            headings[index] = heading
+            left_commands[index] = int(left_command)
+            right_commands[index] = int(right_command)
+            left_positions[index] = int(left_position)
+            right_positions[index] = int(right_position)
+            targets[index] = target
+            self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def clear(self):
+        with self._lock:
+            self.count = 0
+
+    def _ordered_columns(self):
+        # Returns copies of the columns with the oldest sample first
+        with self._lock:
+            length = min(self.count, self.capacity)
+            start = self.count % self.capacity if self.count > self.capacity else 0
+            return [column[start:length] + column[:start] if start else column[:length] for column in self.columns]
+
+    def dump(self, path):
+        """
+        Writes the recorded samples to a binary trace file
+        """
+        columns = self._ordered_columns()
+        with open(path, "wb") as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, sys.byteorder == "little", len(FIELDS), len(columns[0])))
+            for (name, code), column in zip(FIELDS, columns):
+                f.write(_COLUMN.pack(name.encode(), code.encode(), column.itemsize))
+            for column in columns:
+                f.write(column.tobytes())
+
+    def samples(self):
+        """
+        Returns the recorded samples as a list, oldest first
+        """
+        return [Sample(*values) for values in zip(*self._ordered_columns())]
+
+
+class Trace:
+    """
+    A trace loaded from a file. Each column is available as an array attribute, for example trace.gyro.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        for name, column in columns.items():
+            setattr(self, name, column)
+
+    def __len__(self):
+        return len(self.columns["time"])
+
+    def samples(self):
+        return [Sample(*values) for values in zip(*(self.columns[name] for name, code in FIELDS))]
+
+
+def load(path):
+    """
+    Loads a binary trace file written by Recorder.dump()
+    """
+    with open(path, "rb") as f:
+        magic, version, little_endian, field_count, length = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a telemetry trace")
+        if version != VERSION:
+            raise ValueError(f"Unsupported telemetry trace version {version}")
+        layout = []
+        for x in range(field_count):
+            name, code, itemsize = _COLUMN.unpack(f.read(_COLUMN.size))
+            layout.append((name.rstrip(b"\0").decode(), code.decode(), itemsize))
+        columns = {}
+        for name, code, itemsize in layout:
+            column = array(code)
+            if column.itemsize != itemsize:
+                raise ValueError(f"Column {name} was written with {itemsize} byte items, this platform uses "
+                                 f"{column.itemsize}")
+            column.frombytes(f.read(itemsize * length))
+            if bool(little_endian) != (sys.byteorder == "little"):
+                column.byteswap()
+            columns[name] = column
+    return Trace(columns)
+
+
+recorder: Optional[Recorder] = None
+
+
+def enable(capacity=60000):
+    """
+    Starts recording samples from the movement functions and the motor engine, and returns the recorder
+    """
+    global recorder
+    recorder = Recorder(capacity)
+    return recorder
+
+
+def disable():
+    """
+    Stops recording samples and returns the recorder so it can still be dumped
+    """
+    global recorder
+    stopped = recorder
+    recorder = None
+    return stopped
@@ -0,0 +1,69 @@
+import threading
+import unittest
+from common import hardware
+from common.benchmarks.movement import StubBackend
+from common.multitasker import MotorEngine, _MotorState
+
+
+class RecordingBackend(StubBackend):
+    """
+    Records motor commands. Reading a position hands control to on_read, so a test can run code in the middle of a
+    motor engine update.
+    """
+
+    def __init__(self):
+        super().__init__(real_sleep=True)
+        self.calls = []
+        self.on_read = None
+
+    def get_motor_position_counter(self, port):
+        on_read, self.on_read = self.on_read, None
+        if on_read:
+            on_read()
+        return 0
+
+    def motor_power(self, port, power):
+        self.calls.append(("power", port, power))
+
+    def freeze(self, port):
+        self.calls.append(("freeze", port))
+
+
+class MotorEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.previous = hardware.backend
+        self.backend = hardware.use(RecordingBackend())
+
+    def tearDown(self):
+        if self.previous is None:
+            hardware.backend = None
+            for name in hardware.NAMES:
+                vars(hardware).pop(name, None)
+        else:
+            hardware.use(self.previous)
+
+    def test_unregister_during_update_leaves_motor_frozen(self):
+        engine = MotorEngine()
+        # Added without starting the control thread, so the test runs the updates itself
+        engine._motors[1] = _MotorState(1, 1000, 1.0, 10, 100)
+        unregistered = threading.Event()
+
+        def unregister():
+            engine.unregister(1)
+            unregistered.set()
+
+        def unregister_in_background():
+            threading.Thread(target=unregister, daemon=True).start()
+            # Gives unregister() time to run if it is not blocked by the update
+            unregistered.wait(0.2)
+
+        self.backend.on_read = unregister_in_background
+        engine._move_motors()
+        self.assertTrue(unregistered.wait(1.0))
+        self.assertEqual(self.backend.calls, [("power", 1, 100), ("freeze", 1)])
+        engine._move_motors()
+        self.assertEqual(self.backend.calls[-1], ("freeze", 1))
+
+
+if __name__ == "__main__":
+    unittest.main()